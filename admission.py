@@ -0,0 +1,108 @@
+import threading
+import time
+
+
+class ClientLimiter:
+    """Per client rate limits and connection caps.
+
+    Every client address gets a token bucket that fills at rate tokens a
+    second up to burst tokens. A request is allowed while the bucket holds a
+    whole token and takes its cost from it, a batch may take the bucket below
+    zero and the client then waits until it filled up again. The number of
+    open connections of each address is capped too.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        burst: float,
+        max_connections: int,
+        max_clients: int = 65536,
+    ):
+        """
+        :param rate: Requests a second each client may send, 0 for no limit
+        :param burst: How many requests a client may send at once
+        :param max_connections: Open connections each client may have, 0 for
+        no limit
+        :param max_clients: Buckets of idle clients are dropped once there
+        are more than this many
+        """
+        self.rate: float = rate
+        self.burst: float = max(burst, 1.0)
+        self.max_connections: int = max_connections
+        self.max_clients: int = max_clients
+        # Address -> [tokens, time the tokens were counted]
+        self._buckets: dict[str, list[float]] = {}
+        self._prune_at: int = max_clients
+        self._connections: dict[str, int] = {}
+        self._lock: threading.Lock = threading.Lock()
+
+    def connect(self, address: str) -> bool:
+        """Count a new connection of a client
+
+        :param address: The address of the client
+        :return: False if the client has too many connections, the connection
+        is then not counted
+        """
+        with self._lock:
+            count: int = self._connections.get(address, 0)
+            if self.max_connections and count >= self.max_connections:
+                return False
+            self._connections[address] = count + 1
+            return True
+
+    def disconnect(self, address: str) -> None:
+        """Count a closed connection of a client
+
+        :param address: The address of the client
+        """
+        with self._lock:
+            count: int = self._connections.get(address, 0) - 1
+            if count > 0:
+                self._connections[address] = count
+            else:
+                self._connections.pop(address, None)
+
+    def allow(self, address: str, cost: float = 1.0) -> bool:
+        """Take the cost of a request from a client's bucket
+
+        :param address: The address of the client
+        :param cost: The number of queries in the request
+        :return: False if the client sent too many requests
+        """
+        if not self.rate:
+            return True
+        now: float = time.monotonic()
+        with self._lock:
+            bucket: list[float] | None = self._buckets.get(address)
+            if bucket is None:
+                if len(self._buckets) >= self._prune_at:
+                    self._prune(now)
+                bucket = self._buckets[address] = [self.burst, now]
+            else:
+                bucket[0] = min(
+                    self.burst, bucket[0] + (now - bucket[1]) * self.rate
+                )
+                bucket[1] = now
+            if bucket[0] < 1:
+                return False
+            bucket[0] -= cost
+            return True
+
+    def _prune(self, now: float) -> None:
+        """Drop the buckets that filled up again, a new bucket is the same."""
+        self._buckets = {
+            address: bucket
+            for address, bucket in self._buckets.items()
+            if bucket[0] + (now - bucket[1]) * self.rate < self.burst
+        }
+        # Pruning again is only worth it once the clients doubled.
+        self._prune_at = max(self.max_clients, 2 * len(self._buckets))
+
+    def stats(self) -> dict:
+        """Return the number of clients with a bucket and with connections."""
+        with self._lock:
+            return {
+                "clients": len(self._buckets),
+                "connected_clients": len(self._connections),
+            }
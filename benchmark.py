@@ -0,0 +1,500 @@
+"""End to end load test of the server.
+
+Generates corpora of the requested sizes, starts server.py on each of them
+with the requested engines and drives it with concurrent SearchClients.
+Every run reports latency percentiles, throughput and the server's CPU time
+and memory as JSON, so engines and changes can be compared run for run.
+
+Runs with --tls on serve the queries over TLS with a throwaway self signed
+certificate made by the openssl command. Every run also opens fresh
+connections one at a time and reports how long connecting took, and with
+TLS how long connecting took when the last session was resumed.
+
+Closed loop runs send the next query as soon as the last one was answered.
+Open loop runs send queries at a fixed rate and measure latency from the
+time each query was due, so a slow server is not hidden by a slower load.
+
+Example::
+
+    python benchmark.py --rows 10000 1000000 --engines set mmap \\
+        --clients 1 16 --qps 0 5000 --tls off on --output results.json
+"""
+
+import argparse
+import itertools
+import json
+import math
+import os
+import random
+import socket
+import ssl
+import string
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from protocol import V2_MAGIC, encode_v2_frame
+from searchclient import SearchClient
+
+SERVER_SCRIPT: str = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "server.py"
+)
+LINE_LENGTH: int = 12
+HOST: str = "127.0.0.1"
+# How many connections are opened to time connecting, each way.
+CONNECTS: int = 200
+
+
+def generate_corpus(path: str, rows: int, seed: int = 0) -> list[str]:
+    """Write a file of random lines like the test file
+
+    :param path: Where the file is written
+    :param rows: The number of lines
+    :param seed: The seed of the random lines
+    :return: The lines of the file
+    """
+    rng: random.Random = random.Random(seed)
+    lines: list[str] = [
+        "".join(rng.choices(string.ascii_letters, k=LINE_LENGTH))
+        for _ in range(rows)
+    ]
+    with open(path, "w") as file:
+        file.write("\n".join(lines))
+    return lines
+
+
+def free_port() -> int:
+    """Return a port nothing is listening on."""
+    with socket.socket() as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def make_certificate(directory: str) -> tuple[str, str]:
+    """Make a self signed certificate for HOST with the openssl command
+
+    :param directory: Where the certificate and its key are written
+    :return: The paths to the certificate and the key
+    :raises RuntimeError: If openssl is not installed or fails
+    """
+    certificate: str = os.path.join(directory, "cert.pem")
+    key: str = os.path.join(directory, "key.pem")
+    try:
+        subprocess.run(
+            ["openssl", "req", "-x509", "-newkey", "ec", "-nodes"]
+            + ["-pkeyopt", "ec_paramgen_curve:prime256v1"]
+            + ["-keyout", key, "-out", certificate, "-days", "1"]
+            + ["-subj", f"/CN={HOST}", "-addext", f"subjectAltName=IP:{HOST}"],
+            check=True,
+            capture_output=True,
+        )
+    except (OSError, subprocess.CalledProcessError) as e:
+        raise RuntimeError(f"Could not make a certificate: {e}") from None
+    return certificate, key
+
+
+def client_context(certificate: str | None) -> ssl.SSLContext | None:
+    """Return the SSL context clients connect with, None without TLS
+
+    :param certificate: The server's self signed certificate
+    """
+    if certificate is None:
+        return None
+    context: ssl.SSLContext = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.load_verify_locations(certificate)
+    return context
+
+
+def write_config(
+    directory: str, corpus: str, port: int, options: dict
+) -> None:
+    """Write the config.ini the server reads from its working directory
+
+    :param directory: The working directory of the server
+    :param corpus: The path to the corpus
+    :param port: The port the server listens on
+    :param options: The [server] and [search] options of the run, with the
+    certificate and key when TLS is on
+    """
+    tls: bool = options.get("certificate") is not None
+    server: dict = {
+        "listen_ip": HOST,
+        "port": port,
+        "ssl_enabled": str(tls).lower(),
+        "certificate_path": "",
+        "private_key": options.get("key") or "",
+        "certificate_pem": options.get("certificate") or "",
+        "reread_on_query": options["reread"],
+        "linuxpath": corpus,
+        "engine": options["server_engine"],
+        "workers": options["workers"],
+    }
+    search: dict = {"engine": options["engine"]}
+    with open(os.path.join(directory, "config.ini"), "w") as file:
+        for section, values in (("server", server), ("search", search)):
+            file.write(f"[{section}]\n")
+            for key, value in values.items():
+                file.write(f"{key} = {value}\n")
+            file.write("\n")
+
+
+def start_server(
+    directory: str, port: int, timeout: float
+) -> subprocess.Popen:
+    """Start server.py and wait until it accepts connections
+
+    :param directory: The working directory holding its config.ini
+    :param port: The port the server listens on
+    :param timeout: The most seconds to wait for the server
+    :raises RuntimeError: If the server does not start in time
+    """
+    process: subprocess.Popen = subprocess.Popen(
+        [sys.executable, SERVER_SCRIPT],
+        cwd=directory,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline: float = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("The server exited while starting")
+        try:
+            socket.create_connection((HOST, port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("The server did not start in time")
+
+
+def process_usage(pid: int) -> dict:
+    """Return the CPU seconds and memory of a process, read from /proc
+
+    :param pid: The process id
+    :return: cpu_seconds, rss_bytes and peak_rss_bytes, None where /proc is
+    not available
+    """
+    usage: dict = {
+        "cpu_seconds": None,
+        "rss_bytes": None,
+        "peak_rss_bytes": None,
+    }
+    try:
+        with open(f"/proc/{pid}/stat") as file:
+            # The command name may hold spaces, the fields follow the ")".
+            fields: list[str] = file.read().rsplit(")", 1)[1].split()
+        ticks: int = os.sysconf("SC_CLK_TCK")
+        usage["cpu_seconds"] = (int(fields[11]) + int(fields[12])) / ticks
+        with open(f"/proc/{pid}/status") as file:
+            for line in file:
+                name, _, value = line.partition(":")
+                if name == "VmRSS":
+                    usage["rss_bytes"] = int(value.split()[0]) * 1024
+                elif name == "VmHWM":
+                    usage["peak_rss_bytes"] = int(value.split()[0]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return usage
+
+
+def percentile(ordered: list[float], fraction: float) -> float | None:
+    """Return a percentile of sorted values by the nearest rank
+
+    :param ordered: The values in ascending order
+    :param fraction: The percentile between 0 and 1
+    """
+    if not ordered:
+        return None
+    rank: int = max(1, math.ceil(fraction * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def time_connects(
+    port: int, context: ssl.SSLContext | None, resume: bool
+) -> list[float]:
+    """Open CONNECTS connections one after another and time each one
+
+    Each connection sends one query and reads the answer before it is
+    closed, so the TLS 1.3 session ticket has arrived by then.
+
+    :param port: The port of the server
+    :param context: The SSL context, None to connect without TLS
+    :param resume: Resume the session of the last connection
+    :return: The seconds from connecting until the connection was ready,
+    in ascending order
+    """
+    times: list[float] = []
+    session: ssl.SSLSession | None = None
+    for _ in range(CONNECTS):
+        start: float = time.perf_counter()
+        sock: socket.socket = socket.create_connection((HOST, port))
+        try:
+            if context is not None:
+                sock = context.wrap_socket(
+                    sock, server_hostname=HOST, session=session
+                )
+            times.append(time.perf_counter() - start)
+            sock.sendall(V2_MAGIC + encode_v2_frame(b"query"))
+            sock.recv(1)
+            if resume and context is not None:
+                session = sock.session
+        finally:
+            sock.close()
+    return sorted(times)
+
+
+def drive(
+    port: int,
+    queries: list[str],
+    clients: int,
+    qps: float,
+    duration: float,
+    protocol: int,
+    context: ssl.SSLContext | None = None,
+) -> dict:
+    """Send queries to the server from many clients for a while
+
+    :param port: The port of the server
+    :param queries: The queries to send, in turn
+    :param clients: The number of concurrent clients, one connection each
+    :param qps: The total rate of queries, 0 for a closed loop
+    :param duration: How many seconds to send queries for
+    :param protocol: The protocol version the clients speak
+    :param context: The SSL context of the clients, None without TLS
+    :return: The latencies in seconds and the counts of queries and errors
+    """
+    latencies: list[list[float]] = [[] for _ in range(clients)]
+    errors: list[int] = [0] * clients
+    start: float = time.perf_counter() + 0.1
+    stop: float = start + duration
+
+    def client(number: int) -> None:
+        times: list[float] = latencies[number]
+        with SearchClient(
+            HOST, port, pool_size=1, ssl_context=context, protocol=protocol
+        ) as sc:
+            # Connect before the clock starts.
+            sc.exists(queries[number % len(queries)])
+            time.sleep(max(0, start - time.perf_counter()))
+            sent: int = 0
+            while True:
+                if qps:
+                    # Each client takes every clients-th slot of the schedule.
+                    due: float = start + (sent * clients + number) / qps
+                    if due >= stop:
+                        return
+                    delay: float = due - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                else:
+                    due = time.perf_counter()
+                    if due >= stop:
+                        return
+                query: str = queries[(sent * clients + number) % len(queries)]
+                sent += 1
+                try:
+                    sc.exists(query)
+                except (OSError, ConnectionError):
+                    errors[number] += 1
+                    continue
+                times.append(time.perf_counter() - due)
+
+    threads: list[threading.Thread] = [
+        threading.Thread(target=client, args=(number,))
+        for number in range(clients)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed: float = max(time.perf_counter(), stop) - start
+    ordered: list[float] = sorted(t for times in latencies for t in times)
+    return {"latencies": ordered, "errors": sum(errors), "elapsed": elapsed}
+
+
+def run(
+    corpus: str,
+    lines: list[str],
+    options: dict,
+    clients: int,
+    qps: float,
+    duration: float,
+    hit_ratio: float,
+    directory: str,
+) -> dict:
+    """Benchmark one server configuration and return its results
+
+    :param corpus: The path to the corpus
+    :param lines: The lines of the corpus
+    :param options: The engine, server_engine, reread, workers, protocol,
+    and the certificate and key when TLS is on
+    :param clients: The number of concurrent clients
+    :param qps: The total rate of queries, 0 for a closed loop
+    :param duration: How many seconds to send queries for
+    :param hit_ratio: The share of queries that exist in the corpus
+    :param directory: Where the corpus and config.ini are written
+    """
+    rng: random.Random = random.Random(1)
+    # Lowercase misses can not collide with the mixed case lines.
+    queries: list[str] = [
+        (
+            rng.choice(lines)
+            if rng.random() < hit_ratio
+            else "".join(rng.choices(string.ascii_lowercase, k=LINE_LENGTH))
+        )
+        for _ in range(10000)
+    ]
+    port: int = free_port()
+    write_config(directory, corpus, port, options)
+    started: float = time.perf_counter()
+    server: subprocess.Popen = start_server(directory, port, timeout=600)
+    startup: float = time.perf_counter() - started
+    context: ssl.SSLContext | None = client_context(options.get("certificate"))
+    try:
+        full: list[float] = time_connects(port, context, resume=False)
+        resumed: list[float] = time_connects(port, context, resume=True)
+        before: dict = process_usage(server.pid)
+        result: dict = drive(
+            port,
+            queries,
+            clients,
+            qps,
+            duration,
+            options["protocol"],
+            context,
+        )
+        after: dict = process_usage(server.pid)
+    finally:
+        server.terminate()
+        server.wait()
+    latencies: list[float] = result["latencies"]
+    cpu: float | None = None
+    if after["cpu_seconds"] is not None:
+        cpu = after["cpu_seconds"] - before["cpu_seconds"]
+    return {
+        "rows": len(lines),
+        **{
+            k: v for k, v in options.items() if k not in ("certificate", "key")
+        },
+        "tls": context is not None,
+        "clients": clients,
+        "target_qps": qps or None,
+        "duration": duration,
+        "hit_ratio": hit_ratio,
+        "startup_seconds": startup,
+        "queries": len(latencies),
+        "errors": result["errors"],
+        "connect_ms": {
+            "p50": percentile(full, 0.50) * 1000,
+            "p99": percentile(full, 0.99) * 1000,
+        },
+        # Without TLS there is no session to resume.
+        "resumed_connect_ms": (
+            {
+                "p50": percentile(resumed, 0.50) * 1000,
+                "p99": percentile(resumed, 0.99) * 1000,
+            }
+            if context is not None
+            else None
+        ),
+        "throughput_qps": len(latencies) / result["elapsed"],
+        "latency_ms": {
+            name: None if value is None else value * 1000
+            for name, value in (
+                ("p50", percentile(latencies, 0.50)),
+                ("p95", percentile(latencies, 0.95)),
+                ("p99", percentile(latencies, 0.99)),
+                ("max", latencies[-1] if latencies else None),
+            )
+        },
+        "server_cpu_seconds": cpu,
+        "server_cpu_percent": (
+            None if cpu is None else 100 * cpu / result["elapsed"]
+        ),
+        "server_rss_bytes": after["rss_bytes"],
+        "server_peak_rss_bytes": after["peak_rss_bytes"],
+    }
+
+
+def main(argv: list[str] | None = None) -> list[dict]:
+    """Run every combination of the command line options and print the
+    results as JSON."""
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(
+        description="Load test the search server"
+    )
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000])
+    parser.add_argument("--engines", nargs="+", default=["set"])
+    parser.add_argument("--server-engines", nargs="+", default=["threaded"])
+    parser.add_argument("--clients", type=int, nargs="+", default=[8])
+    parser.add_argument(
+        "--qps",
+        type=float,
+        nargs="+",
+        default=[0],
+        help="total query rate of an open loop run, 0 for a closed loop",
+    )
+    parser.add_argument("--duration", type=float, default=5)
+    parser.add_argument("--hit-ratio", type=float, default=0.2)
+    parser.add_argument("--reread", action="store_true")
+    parser.add_argument("--workers", type=int, default=32)
+    parser.add_argument("--protocol", type=int, choices=[1, 2], default=2)
+    parser.add_argument(
+        "--tls",
+        nargs="+",
+        choices=["off", "on"],
+        default=["off"],
+        help="serve over TLS with a self signed certificate",
+    )
+    parser.add_argument("--output", help="write the JSON here too")
+    args: argparse.Namespace = parser.parse_args(argv)
+
+    results: list[dict] = []
+    with tempfile.TemporaryDirectory() as directory:
+        certificate: tuple[str, str] | None = None
+        if "on" in args.tls:
+            certificate = make_certificate(directory)
+        for rows in args.rows:
+            corpus: str = os.path.join(directory, f"corpus_{rows}.txt")
+            lines: list[str] = generate_corpus(corpus, rows)
+            for engine, server_engine, clients, qps, tls in itertools.product(
+                args.engines,
+                args.server_engines,
+                args.clients,
+                args.qps,
+                args.tls,
+            ):
+                options: dict = {
+                    "engine": engine,
+                    "server_engine": server_engine,
+                    "reread": str(args.reread).lower(),
+                    "workers": args.workers,
+                    "protocol": args.protocol,
+                }
+                if tls == "on":
+                    options["certificate"], options["key"] = certificate
+                results.append(
+                    run(
+                        corpus,
+                        lines,
+                        options,
+                        clients,
+                        qps,
+                        args.duration,
+                        args.hit_ratio,
+                        directory,
+                    )
+                )
+                # Progress goes to stderr so stdout is only the JSON.
+                print(json.dumps(results[-1]), file=sys.stderr)
+    output: str = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+import hashlib
+import math
+
+
+class BloomFilter:
+    """A Bloom filter of byte strings.
+
+    A lookup that returns False means the item was never added, a lookup that
+    returns True means it probably was. The filter is sized for an expected
+    number of items so that at most error_rate of the lookups for items that
+    were not added return True.
+    """
+
+    def __init__(self, capacity: int, error_rate: float):
+        """
+        :param capacity: The number of items the filter is sized for
+        :param error_rate: The false positive rate at that many items,
+        between 0 and 1
+        """
+        if not 0 < error_rate < 1:
+            raise ValueError("The error rate must be between 0 and 1")
+        capacity = max(capacity, 1)
+        self.size: int = max(
+            8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        )
+        self.hashes: int = max(1, round(self.size / capacity * math.log(2)))
+        self.bits: bytearray = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item: bytes) -> list[int]:
+        """Return the bits that stand for an item, derived from two halves of
+        one digest as in Kirsch and Mitzenmacher's double hashing.
+        """
+        digest: bytes = hashlib.blake2b(item, digest_size=16).digest()
+        first: int = int.from_bytes(digest[:8], "little")
+        second: int = int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, item: bytes) -> None:
+        """Add an item to the filter
+
+        :param item: The item being added
+        """
+        bits: bytearray = self.bits
+        for position in self._positions(item):
+            bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item: bytes) -> bool:
+        """Return False if the item was definitely never added
+
+        :param item: The item being looked up
+        """
+        bits: bytearray = self.bits
+        return all(
+            bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(item)
+        )
@@ -0,0 +1,204 @@
+import mmap
+import os
+import threading
+from typing import Callable
+
+# How many bytes before the old end of the file are compared to decide
+# whether the file was only appended to.
+EDGE_SIZE: int = 4096
+
+
+def decode_text(data: bytes, encoding: str) -> str:
+    """Decode file bytes the way a file opened in text mode reads them, with
+    CRLF and CR line endings turned into LF
+
+    :param data: The bytes read from the file
+    :param encoding: The encoding of the file
+    """
+    text: str = data.decode(encoding)
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text
+
+
+class FileReloader:
+    """Keeps the searchable copy of a file in step with the file on disk.
+
+    The file is stat'ed on every refresh and only read again when its inode,
+    size or modification time changed. When the file only grew and the bytes
+    just before the old end are untouched, only the new tail is read and added
+    to the existing engine, if it supports appending. Any other change
+    prepares a new engine, which replaces the old one once it is ready.
+    """
+
+    def __init__(
+        self,
+        file_path: str,
+        create_engine: Callable,
+        encoding: str = "utf-8",
+    ):
+        """
+        :param file_path: The path to the file that will be watched
+        :param create_engine: Returns a new, unprepared search engine
+        :param encoding: The encoding used to decode the file
+        """
+        self.file_path: str = file_path
+        self.create_engine: Callable = create_engine
+        self.encoding: str = encoding
+        self.engine = None
+        # (inode, size, mtime) of the file when it was last read
+        self._signature: tuple | None = None
+        # Byte offset where the last (possibly incomplete) line starts
+        self._tail_start: int = 0
+        self._edge: bytes = b""
+        self._lock: threading.Lock = threading.Lock()
+
+    def refresh(self) -> "FileReloader":
+        """Reread the file if it changed since the last call.
+
+        :return: The reloader itself so callers can use its engine
+        """
+        stat: os.stat_result = os.stat(self.file_path)
+        signature: tuple = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        if signature == self._signature:
+            return self
+        with self._lock:
+            # Another thread may have reloaded while we waited on the lock.
+            if signature != self._signature:
+                with open(self.file_path, "rb") as file:
+                    if not self._load_appended(file, signature):
+                        self._load_full(file, signature)
+                self._signature = signature
+        return self
+
+    @property
+    def version(self) -> tuple | None:
+        """A token that changes whenever the loaded file changed. It is
+        updated after the engine, so read it before the engine.
+        """
+        return self._signature
+
+    def _load_full(self, file, signature: tuple) -> None:
+        """Prepare a new engine from the whole file."""
+        engine = self.create_engine()
+        if not engine.needs_content:
+            engine.prepare(self.file_path)
+            self.engine = engine
+            return
+        # Only read up to the size we stat'ed so a concurrent writer can not
+        # put the signature and the loaded data out of step.
+        file.seek(0)
+        data: bytes = file.read(signature[1])
+        engine.prepare(self.file_path, decode_text(data, self.encoding))
+        self.engine = engine
+        self._remember(file, data, 0)
+
+    def _load_appended(self, file, signature: tuple) -> bool:
+        """Add only the newly appended bytes to the index.
+
+        :return: False if the change was not a pure append and a full reload
+        is required
+        """
+        if self._signature is None or not self.engine.supports_append:
+            return False
+        inode, size, _ = self._signature
+        if signature[0] != inode or signature[1] <= size:
+            return False
+        file.seek(size - len(self._edge))
+        if file.read(len(self._edge)) != self._edge:
+            return False
+        # Read from the start of the old tail so a line that was incomplete
+        # before the append is indexed as a whole.
+        file.seek(self._tail_start)
+        data: bytes = file.read(signature[1] - self._tail_start)
+        self.engine.extend(decode_text(data, self.encoding))
+        self._remember(file, data, self._tail_start)
+        return True
+
+    def _remember(self, file, data: bytes, offset: int) -> None:
+        """Record where the tail starts and the bytes before the end of file.
+
+        :param file: The open file the data was read from
+        :param data: The bytes that were just read
+        :param offset: The offset in the file where data starts
+        """
+        self._tail_start = offset + data.rfind(b"\n") + 1
+        end: int = offset + len(data)
+        if len(data) >= EDGE_SIZE or offset == 0:
+            self._edge = data[-EDGE_SIZE:]
+        else:
+            file.seek(max(0, end - EDGE_SIZE))
+            self._edge = file.read(end - max(0, end - EDGE_SIZE))
+
+
+class MmapCorpus:
+    """The file mapped into memory and searched as raw bytes.
+
+    Nothing is decoded or copied into Python objects, the operating system
+    pages the file in as it is searched. Memory use stays flat however large
+    the file is, and processes serving the same file share the page cache.
+    """
+
+    def __init__(self, file_path: str):
+        """
+        :param file_path: The path to the file that will be mapped
+        """
+        self.file_path: str = file_path
+        self.map: mmap.mmap | bytes = b""
+        # Whether the file has CR line endings, whose CR is not part of the
+        # line as in a file read in text mode.
+        self.crlf: bool = False
+        self._signature: tuple | None = None
+        self._lock: threading.Lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self) -> "MmapCorpus":
+        """Map the file again if it was replaced or its size changed.
+
+        :return: The corpus itself
+        """
+        stat: os.stat_result = os.stat(self.file_path)
+        signature: tuple = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        if signature == self._signature:
+            return self
+        with self._lock:
+            if signature != self._signature:
+                with open(self.file_path, "rb") as file:
+                    if os.fstat(file.fileno()).st_size:
+                        new_map = mmap.mmap(
+                            file.fileno(), 0, access=mmap.ACCESS_READ
+                        )
+                    else:
+                        # An empty file can not be mapped.
+                        new_map = b""
+                # The old map is not closed here because other threads may
+                # still be searching it, it is released once unreferenced.
+                self.crlf = new_map.find(b"\r") != -1
+                self.map = new_map
+                self._signature = signature
+        return self
+
+    def contains_line(self, line: bytes) -> bool:
+        """Return True if the line exists in the file as a whole line
+
+        :param line: The encoded line being searched for
+        """
+        if b"\n" in line or b"\r" in line:
+            # A line never holds a newline, nor a CR which text mode reads as
+            # one.
+            return False
+        data: mmap.mmap | bytes = self.map
+        size: int = len(line)
+        # A line ends at a newline, or with CRLF files at a CR before it.
+        ends: tuple[bytes, ...] = (b"\n", b"\r") if self.crlf else (b"\n",)
+        # The first line has no newline in front of it.
+        if data[:size] == line and data[size : size + 1] in (b"", *ends):
+            return True
+        # The last line has no newline after it.
+        tail: bytes = data[max(len(data) - size - 2, 0) :]
+        if len(data) > size and (
+            tail[-size - 1 :] == b"\n" + line
+            or (self.crlf and tail == b"\n" + line + b"\r")
+        ):
+            return True
+        return any(data.find(b"\n" + line + end) != -1 for end in ends)
@@ -0,0 +1,199 @@
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import zlib
+from array import array
+
+# Start of every index file, bumped whenever the layout changes.
+MAGIC: bytes = b"LINEIDX2"
+# magic, file size, file mtime_ns, number of slots, blake2b digest of the file
+INDEX_HEADER: struct.Struct = struct.Struct("<8sQQQ32s")
+# How much of the file is hashed at a time.
+HASH_CHUNK: int = 1 << 20
+
+
+def file_digest(data) -> bytes:
+    """Return the blake2b digest of the file's bytes
+
+    :param data: The raw bytes of the file, e.g. an mmap
+    """
+    digest = hashlib.blake2b(digest_size=32)
+    view: memoryview = memoryview(data)
+    for start in range(0, len(view), HASH_CHUNK):
+        digest.update(view[start : start + HASH_CHUNK])
+    view.release()
+    return digest.digest()
+
+
+class DiskIndex:
+    """A hash table of the file's lines kept in a sidecar file.
+
+    The table is an open addressing hash table of line offsets into the file,
+    so it holds no strings and is mapped into memory instead of being read.
+    When the server restarts and the file has not changed the index is ready
+    as soon as it is mapped, only a stale or missing index is built again.
+    The index is stale when the file's size differs, or when its modification
+    time differs and its digest does not match either.
+    """
+
+    def __init__(self, file_path: str, index_path: str | None = None):
+        """
+        :param file_path: The path to the file being indexed
+        :param index_path: The path to the sidecar index, defaults to the
+        file's path with .idx appended
+        """
+        self.file_path: str = file_path
+        self.index_path: str = index_path or file_path + ".idx"
+        with open(file_path, "rb") as file:
+            stat: os.stat_result = os.fstat(file.fileno())
+            # An empty file can not be mapped.
+            self.data: mmap.mmap | bytes = (
+                mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                if stat.st_size
+                else b""
+            )
+        self.slots = self._load(stat)
+        if self.slots is None:
+            self.slots = self._build(stat)
+        self.mask: int = len(self.slots) - 1
+
+    def contains_line(self, line: bytes) -> bool:
+        """Return True if the line exists in the file as a whole line
+
+        :param line: The encoded line being searched for
+        """
+        if b"\n" in line or b"\r" in line:
+            # A line never holds a newline, nor a CR which text mode reads as
+            # one.
+            return False
+        slot: int = zlib.crc32(line) & self.mask
+        while True:
+            # Slots hold the offset of a line plus one, 0 marks an empty slot.
+            value: int = self.slots[slot]
+            if not value:
+                return False
+            if self._line_at(value - 1, line):
+                return True
+            slot = (slot + 1) & self.mask
+
+    def _line_at(self, start: int, line: bytes) -> bool:
+        """Return True if the line of the file at an offset is the line
+
+        :param start: The offset where a line of the file starts
+        :param line: The encoded line
+        """
+        end: int = start + len(line)
+        # The CR of a CRLF line is not part of the line, as in text mode.
+        return self.data[start:end] == line and self.data[end : end + 1] in (
+            b"",
+            b"\n",
+            b"\r",
+        )
+
+    def _load(self, stat: os.stat_result):
+        """Map the sidecar index if it matches the file
+
+        :return: The slots of the table, or None if the index is missing or
+        stale
+        """
+        try:
+            with open(self.index_path, "rb") as file:
+                header: bytes = file.read(INDEX_HEADER.size)
+                if len(header) < INDEX_HEADER.size:
+                    return None
+                magic, size, mtime, slots, digest = INDEX_HEADER.unpack(header)
+                if magic != MAGIC or size != stat.st_size:
+                    return None
+                # A file that was only touched or copied is not stale, its
+                # digest is checked and the new time is saved.
+                if mtime != stat.st_mtime_ns:
+                    if digest != file_digest(self.data):
+                        return None
+                    self._touch(stat, slots, digest)
+                index: mmap.mmap = mmap.mmap(
+                    file.fileno(), 0, access=mmap.ACCESS_READ
+                )
+        except (OSError, ValueError):
+            return None
+        table: memoryview = memoryview(index)[INDEX_HEADER.size :]
+        if len(table) != slots * 8:
+            return None
+        return table.cast("Q")
+
+    def _touch(self, stat: os.stat_result, slots: int, digest: bytes) -> None:
+        """Save the file's new modification time in the index header."""
+        try:
+            with open(self.index_path, "r+b") as file:
+                file.write(
+                    INDEX_HEADER.pack(
+                        MAGIC, stat.st_size, stat.st_mtime_ns, slots, digest
+                    )
+                )
+        except OSError:
+            # The digest is checked again on the next start.
+            pass
+
+    def _build(self, stat: os.stat_result):
+        """Build the table from the file and save it next to the file
+
+        :return: The slots of the new table
+        """
+        data: mmap.mmap | bytes = self.data
+        starts: array = array("Q", [0])
+        position: int = data.find(b"\n")
+        while position != -1:
+            starts.append(position + 1)
+            position = data.find(b"\n", position + 1)
+        ends: array = array("Q", starts[1:])
+        ends.append(len(data) + 1)
+        # Keep the table at most half full so probes stay short.
+        size: int = 1
+        while size < 2 * len(starts):
+            size *= 2
+        mask: int = size - 1
+        slots: array = array("Q", bytes(8 * size))
+        for start, end in zip(starts, ends):
+            line: bytes = data[start : end - 1]
+            if line.endswith(b"\r"):
+                line = line[:-1]
+            slot: int = zlib.crc32(line) & mask
+            while slots[slot]:
+                # The same line seen again is only stored once.
+                if self._line_at(slots[slot] - 1, line):
+                    break
+                slot = (slot + 1) & mask
+            else:
+                slots[slot] = start + 1
+        self._save(stat, slots)
+        return slots
+
+    def _save(self, stat: os.stat_result, slots: array) -> None:
+        """Write the table to the sidecar file, a failure only costs a
+        rebuild on the next start.
+        """
+        temporary: str = f"{self.index_path}.{os.getpid()}.tmp"
+        try:
+            with open(temporary, "wb") as file:
+                file.write(
+                    INDEX_HEADER.pack(
+                        MAGIC,
+                        stat.st_size,
+                        stat.st_mtime_ns,
+                        len(slots),
+                        file_digest(self.data),
+                    )
+                )
+                slots.tofile(file)
+            # Replace the old index in one step so a reader never sees a
+            # half written one.
+            os.replace(temporary, self.index_path)
+        except OSError as error:
+            logging.warning(
+                f"Could not save the index {self.index_path}: {error}"
+            )
+            try:
+                os.remove(temporary)
+            except OSError:
+                pass
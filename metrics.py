@@ -0,0 +1,146 @@
+import threading
+from bisect import bisect_left
+
+# Upper bounds in seconds of the buckets of the stage timing histograms.
+BUCKETS: tuple[float, ...] = (
+    0.00001,
+    0.000025,
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+class Histogram:
+    """Counts observations in fixed buckets, like a Prometheus histogram."""
+
+    def __init__(self, buckets: tuple[float, ...] = BUCKETS):
+        """
+        :param buckets: The upper bounds of the buckets in ascending order
+        """
+        self.buckets: tuple[float, ...] = buckets
+        # One count per bucket and one for values above the last bound.
+        self.counts: list[int] = [0] * (len(buckets) + 1)
+        self.sum: float = 0.0
+        self.count: int = 0
+
+    def observe(self, value: float) -> None:
+        """Add one observation
+
+        :param value: The value observed
+        """
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """Counters, gauges and per-stage timing histograms of the server.
+
+    Counters and gauges are updated on every call. Timings are sampled, only
+    one in sample_every calls to sampled() returns True, and the caller only
+    reads the clock for those. render() writes everything in the Prometheus
+    text format.
+    """
+
+    def __init__(self, prefix: str, sample_every: int = 1):
+        """
+        :param prefix: Put in front of the name of every metric
+        :param sample_every: Time one in this many requests
+        """
+        self.prefix: str = prefix
+        self.sample_every: int = max(1, sample_every)
+        self.counters: dict[str, int] = {}
+        self.gauges: dict[str, float] = {}
+        self.stages: dict[str, Histogram] = {}
+        self._tick: int = 0
+        self._lock: threading.Lock = threading.Lock()
+
+    def sampled(self) -> bool:
+        """Return True if this request should be timed."""
+        if self.sample_every == 1:
+            return True
+        # Races between threads only shift which request is sampled.
+        self._tick += 1
+        return self._tick % self.sample_every == 0
+
+    def inc(self, name: str, amount: int = 1) -> None:
+        """Add to a counter
+
+        :param name: The name of the counter, it should end with _total
+        :param amount: How much to add
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def add(self, name: str, amount: float) -> None:
+        """Add to a gauge, a negative amount takes away from it
+
+        :param name: The name of the gauge
+        :param amount: How much to add
+        """
+        with self._lock:
+            self.gauges[name] = self.gauges.get(name, 0) + amount
+
+    def observe(self, stage: str, seconds: float) -> None:
+        """Record how long a stage of a request took
+
+        :param stage: The name of the stage, e.g. search
+        :param seconds: How long it took
+        """
+        with self._lock:
+            histogram: Histogram | None = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = Histogram()
+            histogram.observe(seconds)
+
+    def render(self, gauges: dict[str, float] | None = None) -> str:
+        """Return every metric in the Prometheus text format
+
+        :param gauges: More gauges to include, read when this is called
+        """
+        lines: list[str] = []
+        with self._lock:
+            for name, value in sorted(self.counters.items()):
+                lines.append(f"# TYPE {self.prefix}{name} counter")
+                lines.append(f"{self.prefix}{name} {value}")
+            for name, value in sorted(
+                {**self.gauges, **(gauges or {})}.items()
+            ):
+                lines.append(f"# TYPE {self.prefix}{name} gauge")
+                lines.append(f"{self.prefix}{name} {value}")
+            histogram_name: str = f"{self.prefix}stage_seconds"
+            if self.stages:
+                lines.append(f"# TYPE {histogram_name} histogram")
+            for stage, histogram in sorted(self.stages.items()):
+                label: str = f'stage="{stage}"'
+                bounds: list[str] = [repr(b) for b in histogram.buckets]
+                total: int = 0
+                for bound, count in zip(bounds + ["+Inf"], histogram.counts):
+                    # Prometheus buckets count every value up to their bound.
+                    total += count
+                    lines.append(
+                        f'{histogram_name}_bucket{{{label},le="{bound}"}} '
+                        f"{total}"
+                    )
+                lines.append(
+                    f"{histogram_name}_sum{{{label}}} {histogram.sum}"
+                )
+                lines.append(
+                    f"{histogram_name}_count{{{label}}} {histogram.count}"
+                )
+        return "\n".join(lines) + "\n"
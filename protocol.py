@@ -0,0 +1,241 @@
+import socket
+import struct
+import time
+
+# Protocol version 2 is chosen by sending this byte first on the connection.
+# A version 1 header always starts with an ASCII digit so the two can not be
+# confused.
+V2_MAGIC: bytes = b"\x02"
+# Version 2 frames start with the payload length as a 4 byte unsigned int.
+V2_LENGTH: struct.Struct = struct.Struct("!I")
+# A version 2 length with this bit set carries a batch of queries separated
+# by newlines. The reply is the number of results followed by one status
+# byte per query.
+BATCH_FLAG: int = 0x80000000
+# A version 2 length with this bit set carries a command: its name and its
+# arguments separated by newlines. The reply is a stream of frames ended by
+# a STREAM_END length.
+COMMAND_FLAG: int = 0x40000000
+LENGTH_MASK: int = 0x3FFFFFFF
+STREAM_END: int = 0xFFFFFFFF
+# Sent in place of a frame when a command fails, the frame that follows
+# holds the error message.
+STREAM_ERROR: int = 0xFFFFFFFE
+# Version 2 replies are a single status byte.
+STATUS_NOT_FOUND: int = 0
+STATUS_EXISTS: int = 1
+# Sent instead of a result when the client sent too many queries, for every
+# query of a throttled batch.
+STATUS_THROTTLED: int = 2
+# The reply of version 1 and the error of a command when throttled.
+V1_THROTTLED: bytes = b"THROTTLED\n"
+THROTTLED_MESSAGE: bytes = b"THROTTLED"
+
+V1_REPLIES: dict[bool, bytes] = {
+    True: b"STRING EXISTS\n",
+    False: b"STRING NOT FOUND\n",
+}
+V2_REPLIES: dict[bool, bytes] = {
+    True: bytes([STATUS_EXISTS]),
+    False: bytes([STATUS_NOT_FOUND]),
+}
+
+
+class FrameTooLarge(ValueError):
+    """Raised when a client announces a frame longer than the server
+    accepts."""
+
+
+def check_frame_length(length: int, limit: int) -> int:
+    """Check the length a frame header announced before the frame is read
+
+    :param length: The announced length of the payload
+    :param limit: The longest payload accepted
+    :return: The length
+    :raises FrameTooLarge: If the length is negative or over the limit
+    """
+    if not 0 <= length <= limit:
+        raise FrameTooLarge(f"Frame of {length} bytes, the limit is {limit}")
+    return length
+
+
+def encode_v1_frame(payload: bytes, header: int = 1024) -> bytes:
+    """Prefix a payload with its length padded to the version 1 header size
+
+    :param payload: The encoded message
+    :param header: The size of the header in bytes
+    :return: The frame ready to be sent
+    """
+    return str(len(payload)).encode().ljust(header) + payload
+
+
+def encode_v2_frame(payload: bytes) -> bytes:
+    """Prefix a payload with its length for protocol version 2
+
+    :param payload: The encoded message
+    :return: The frame ready to be sent
+    """
+    return V2_LENGTH.pack(len(payload)) + payload
+
+
+def encode_v2_batch(queries: list[bytes]) -> bytes:
+    """Pack several queries into one protocol version 2 batch frame
+
+    :param queries: The encoded queries, none of them may contain a newline
+    :return: The frame ready to be sent
+    :raises ValueError: If a query contains a newline, which would split it
+    """
+    payload: bytes = b"\n".join(queries)
+    if payload.count(b"\n") != max(len(queries) - 1, 0):
+        raise ValueError("Queries in a batch may not contain a newline")
+    return V2_LENGTH.pack(len(payload) | BATCH_FLAG) + payload
+
+
+def encode_v2_command(name: str, args: list[bytes]) -> bytes:
+    """Pack a command and its arguments into one protocol version 2 frame
+
+    :param name: The name of the command
+    :param args: The encoded arguments, none of them may contain a newline
+    :return: The frame ready to be sent
+    :raises ValueError: If an argument contains a newline, which would split
+    it
+    """
+    payload: bytes = b"\n".join([name.encode(), *args])
+    if payload.count(b"\n") != len(args):
+        raise ValueError("Command arguments may not contain a newline")
+    return V2_LENGTH.pack(len(payload) | COMMAND_FLAG) + payload
+
+
+def encode_batch_reply(results: list[bool]) -> bytes:
+    """Pack the results of a batch into its reply
+
+    :param results: Whether each query of the batch was found
+    :return: The result count followed by one status byte per query
+    """
+    return V2_LENGTH.pack(len(results)) + bytes(results)
+
+
+def encode_throttled_reply(
+    version2: bool, batch: int | None = None, command: bool = False
+) -> bytes:
+    """Return the reply to a throttled message
+
+    :param version2: Whether the client speaks protocol version 2
+    :param batch: The number of queries of a batch, None if not a batch
+    :param command: Whether the message was a command
+    :return: THROTTLED for version 1, otherwise STATUS_THROTTLED for each
+    query or a STREAM_ERROR for a command
+    """
+    if command:
+        return V2_LENGTH.pack(STREAM_ERROR) + encode_v2_frame(
+            THROTTLED_MESSAGE
+        )
+    if batch is not None:
+        return V2_LENGTH.pack(batch) + bytes([STATUS_THROTTLED]) * batch
+    return bytes([STATUS_THROTTLED]) if version2 else V1_THROTTLED
+
+
+class FrameReader:
+    """Reads exact sized frames from a socket through a reusable buffer.
+
+    recv() may return fewer bytes than asked for, or bytes that belong to the
+    next frame, because TCP does not keep message boundaries. The reader
+    fills one buffer with recv_into() and hands out exactly the number of
+    bytes asked for, keeping anything extra for the next read. The buffer is
+    reused for every frame so reading does not allocate.
+
+    Reads may be given a deadline on the monotonic clock. The socket timeout
+    is set to the time left before every recv, so a client that trickles its
+    bytes in can not stretch a read past the deadline.
+    """
+
+    def __init__(self, sock: socket.socket, buffer_size: int = 65536):
+        """
+        :param sock: The connected socket to read from
+        :param buffer_size: The initial size of the buffer in bytes
+        """
+        self.sock: socket.socket = sock
+        # The socket's own timeout, reads without a deadline go back to it
+        # since a deadline or a send may have left another one set.
+        self.timeout: float | None = sock.gettimeout()
+        self.buffer: bytearray = bytearray(buffer_size)
+        self.view: memoryview = memoryview(self.buffer)
+        # Unread bytes are buffer[start:end]
+        self.start: int = 0
+        self.end: int = 0
+
+    def read_exactly(
+        self, size: int, deadline: float | None = None
+    ) -> memoryview | None:
+        """Return the next size bytes received on the socket.
+
+        The returned view points into the reader's buffer and is only valid
+        until the next call, so it should be decoded or copied straight away.
+
+        :param size: The number of bytes to read
+        :param deadline: The time.monotonic() by which they must have arrived,
+        None to wait for as long as it takes
+        :return: A view of the bytes or None if the connection was closed
+        before any of them arrived
+        :raises ConnectionError: If the connection closed in the middle of
+        the frame
+        :raises TimeoutError: If the deadline passed first
+        """
+        if self.end - self.start < size:
+            self._fill(size, deadline)
+            if self.end - self.start < size:
+                if self.end == self.start:
+                    return None
+                raise ConnectionError(
+                    "Connection closed in the middle of a frame"
+                )
+        frame: memoryview = self.view[self.start : self.start + size]
+        self.start += size
+        return frame
+
+    def buffered(self) -> int:
+        """Return how many received bytes have not been read yet."""
+        return self.end - self.start
+
+    def peek(
+        self, size: int, deadline: float | None = None
+    ) -> memoryview | None:
+        """Return the next size bytes without consuming them.
+
+        :param size: The number of bytes to look at
+        :param deadline: The time.monotonic() by which they must have arrived
+        :return: A view of the bytes or None if the connection closed first
+        :raises TimeoutError: If the deadline passed first
+        """
+        if self.end - self.start < size:
+            self._fill(size, deadline)
+            if self.end - self.start < size:
+                return None
+        return self.view[self.start : self.start + size]
+
+    def _fill(self, size: int, deadline: float | None = None) -> None:
+        """Receive until at least size bytes are buffered or the peer closes."""
+        buffered: int = self.end - self.start
+        if size > len(self.buffer):
+            # Only frames larger than the buffer cause a new allocation.
+            buffer: bytearray = bytearray(size)
+            buffer[:buffered] = self.view[self.start : self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        elif self.start:
+            # Move the unread bytes to the front to make room after them.
+            self.buffer[:buffered] = self.view[self.start : self.end]
+        self.start = 0
+        self.end = buffered
+        if deadline is None and self.end < size:
+            self.sock.settimeout(self.timeout)
+        while self.end < size:
+            if deadline is not None:
+                remaining: float = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError("timed out")
+                self.sock.settimeout(remaining)
+            received: int = self.sock.recv_into(self.view[self.end :])
+            if not received:
+                return
+            self.end += received
@@ -0,0 +1,75 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class QueryCache:
+    """A bounded least recently used cache of query results.
+
+    Results are only valid for one version of the file. Every lookup passes
+    the version it is working with, and the first lookup that sees a new
+    version drops everything cached for the old one, so a changed file is
+    never answered from the cache. Entries can also expire after a time to
+    live.
+    """
+
+    def __init__(self, capacity: int, ttl: float = 0.0):
+        """
+        :param capacity: The most results kept
+        :param ttl: Seconds a result stays valid, 0 keeps it until evicted
+        """
+        self.capacity: int = capacity
+        self.ttl: float = ttl
+        self.hits: int = 0
+        self.misses: int = 0
+        self.version = None
+        # query -> (result, time it was stored)
+        self._entries: OrderedDict = OrderedDict()
+        self._lock: threading.Lock = threading.Lock()
+
+    def get(self, query: str, version=None) -> bool | None:
+        """Return the cached result of a query
+
+        :param query: The query being looked up
+        :param version: A token that changes whenever the file changes
+        :return: The result or None if it is not cached
+        """
+        with self._lock:
+            if version != self.version:
+                self._entries.clear()
+                self.version = version
+            entry: tuple | None = self._entries.get(query)
+            if entry is not None and (
+                not self.ttl or time.monotonic() - entry[1] < self.ttl
+            ):
+                self._entries.move_to_end(query)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            return None
+
+    def put(self, query: str, result: bool, version=None) -> None:
+        """Store the result of a query
+
+        :param query: The query that was searched for
+        :param result: Whether it was found
+        :param version: The version of the file the result is for, results
+        for a version that is no longer current are dropped
+        """
+        with self._lock:
+            if version != self.version:
+                return
+            self._entries[query] = (result, time.monotonic())
+            self._entries.move_to_end(query)
+            if len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        """Return the size of the cache and its hit and miss counters."""
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "capacity": self.capacity,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
@@ -0,0 +1,194 @@
+import functools
+import re
+import time
+from typing import Iterator
+
+try:
+    from re import _parser as sre_parse
+except ImportError:  # Python 3.10
+    import sre_parse
+
+# How many bytes of the file are searched between two checks of the time
+# budget. Chunks end on a newline.
+CHUNK_SIZE: int = 1 << 16
+# Patterns longer than this are rejected before they are compiled.
+MAX_PATTERN_LENGTH: int = 1000
+
+_REPEATS: tuple = (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT)
+
+
+class RegexRejected(ValueError):
+    """Raised for a pattern that is invalid or could backtrack without
+    bound."""
+
+
+class RegexTimeout(Exception):
+    """Raised when a search uses up its time budget."""
+
+
+def _repeats(tokens) -> Iterator[tuple]:
+    """Yield every repeat in a parsed pattern with its max count and body."""
+    for op, value in tokens:
+        if op in _REPEATS:
+            yield value[1], value[2]
+            yield from _repeats(value[2])
+        elif op == sre_parse.SUBPATTERN:
+            yield from _repeats(value[3])
+        elif op == sre_parse.BRANCH:
+            for branch in value[1]:
+                yield from _repeats(branch)
+        elif op == sre_parse.GROUPREF_EXISTS:
+            for branch in value[1:]:
+                if branch is not None:
+                    yield from _repeats(branch)
+        elif op == sre_parse.ASSERT or op == sre_parse.ASSERT_NOT:
+            yield from _repeats(value[1])
+
+
+def _branches(tokens) -> Iterator[list]:
+    """Yield the alternatives of every alternation in a parsed pattern."""
+    for op, value in tokens:
+        if op == sre_parse.BRANCH:
+            yield value[1]
+            for branch in value[1]:
+                yield from _branches(branch)
+        elif op in _REPEATS:
+            yield from _branches(value[2])
+        elif op == sre_parse.SUBPATTERN:
+            yield from _branches(value[3])
+
+
+def _first_literal(branch) -> int | None:
+    """Return the literal a branch starts with, if it starts with one."""
+    for op, value in branch:
+        if op == sre_parse.SUBPATTERN:
+            return _first_literal(value[3])
+        if op == sre_parse.LITERAL:
+            return value
+        return None
+    return None
+
+
+def check_pattern(pattern: str) -> None:
+    """Reject patterns known to backtrack exponentially
+
+    These are a repeat inside another repeat when either is unbounded, such
+    as (a+)+, an alternation inside a repeat whose alternatives can start
+    with the same character, such as (a|ab)*, and backreferences.
+
+    :param pattern: The regular expression
+    :raises RegexRejected: If the pattern is invalid or unsafe
+    """
+    if len(pattern) > MAX_PATTERN_LENGTH:
+        raise RegexRejected("The pattern is too long")
+    try:
+        tokens = sre_parse.parse(pattern)
+    except re.error as e:
+        raise RegexRejected(f"Invalid pattern: {e}") from None
+    for op, _ in _walk(tokens):
+        if op in (sre_parse.GROUPREF, sre_parse.GROUPREF_EXISTS):
+            raise RegexRejected("Backreferences are not allowed")
+    for outer, body in _repeats(tokens):
+        if outer <= 1:
+            continue
+        for inner, _ in _repeats(body):
+            if inner > 1 and sre_parse.MAXREPEAT in (outer, inner):
+                raise RegexRejected("Nested repeats are not allowed")
+        for branch in _branches(body):
+            firsts: list = [_first_literal(option) for option in branch]
+            if None in firsts or len(set(firsts)) < len(firsts):
+                raise RegexRejected(
+                    "Repeated alternatives must start with different "
+                    "characters"
+                )
+
+
+def _walk(tokens) -> Iterator[tuple]:
+    """Yield every token of a parsed pattern, nested ones included."""
+    for op, value in tokens:
+        yield op, value
+        if op in _REPEATS:
+            yield from _walk(value[2])
+        elif op == sre_parse.SUBPATTERN:
+            yield from _walk(value[3])
+        elif op == sre_parse.BRANCH:
+            for branch in value[1]:
+                yield from _walk(branch)
+        elif op == sre_parse.ASSERT or op == sre_parse.ASSERT_NOT:
+            yield from _walk(value[1])
+
+
+class RegexSearcher:
+    """Searches the lines of a file for a client's regular expression.
+
+    Patterns are checked with check_pattern and compiled once, the most
+    recently used compiled patterns are kept. A search checks its time
+    budget after every chunk of the file and gives up once it is spent, so
+    one slow pattern can not hold a worker for long.
+    """
+
+    def __init__(
+        self,
+        cache_size: int = 256,
+        time_budget: float = 1.0,
+        encoding: str = "utf-8",
+    ):
+        """
+        :param cache_size: The most compiled patterns kept
+        :param time_budget: The most seconds one search may take
+        :param encoding: The encoding of the file
+        """
+        self.time_budget: float = time_budget
+        self.encoding: str = encoding
+        self.compile = functools.lru_cache(maxsize=cache_size)(self._compile)
+
+    def _compile(self, pattern: str) -> re.Pattern:
+        """Check and compile a pattern
+
+        :param pattern: The regular expression
+        :raises RegexRejected: If the pattern is invalid or unsafe
+        """
+        check_pattern(pattern)
+        try:
+            return re.compile(pattern.encode(self.encoding))
+        except re.error as e:
+            raise RegexRejected(f"Invalid pattern: {e}") from None
+
+    def search_lines(
+        self,
+        data,
+        pattern: str,
+        limit: int,
+        start: int = 0,
+        stop: int | None = None,
+    ) -> Iterator[bytes]:
+        """Yield the lines of the file that the pattern matches
+
+        :param data: The raw bytes of the file, e.g. an mmap
+        :param pattern: The regular expression, it is matched against one
+        line at a time
+        :param limit: The most lines to yield
+        :param start: Where the first line starts
+        :param stop: Where the last line ends, defaults to the end of data
+        :raises RegexRejected: If the pattern is invalid or unsafe
+        :raises RegexTimeout: If the search takes longer than the budget
+        """
+        search = self.compile(pattern).search
+        deadline: float = time.monotonic() + self.time_budget
+        stop = len(data) if stop is None else stop
+        found: int = 0
+        while start <= stop and found < limit:
+            end: int = data.find(b"\n", start + CHUNK_SIZE, stop)
+            if end == -1:
+                end = stop
+            for line in data[start:end].split(b"\n"):
+                if search(line):
+                    yield line
+                    found += 1
+                    if found == limit:
+                        return
+            start = end + 1
+            if time.monotonic() > deadline:
+                raise RegexTimeout(
+                    f"The search took longer than {self.time_budget} seconds"
+                )
@@ -1,8 +1,20 @@
-import matplotlib.pyplot as plt
+from collections import deque
+from typing import Iterable, Iterator
 import random
 import string
 import time
-from tabulate import tabulate
+
+try:
+    import numpy as np
+except ImportError:  # The fast backends fall back to find() without numpy.
+    np = None
+
+# Size of the blocks the vectorized searches work through, so a match near
+# the start of a large text is found without scanning all of it.
+CHUNK_SIZE: int = 1 << 20
+# Base of the polynomial hash used by the vectorized Rabin-Karp search. The
+# hash is computed modulo 2**64 by letting uint64 arithmetic wrap around.
+RABIN_KARP_BASE: int = 1000003
 
 
 # Naive search algorithm
@@ -200,20 +212,20 @@ class AhoCorasick:
         self.out.setdefault(current_state, []).append(pattern)
 
     def build(self):
-        queue: list = []
+        queue: deque = deque()
         for char in self.goto[0]:
             state = self.goto[0][char]
             self.fail[state] = 0
             queue.append(state)
 
         while queue:
-            r = queue.pop(0)
+            r = queue.popleft()
             for char, s in self.goto[r].items():
                 queue.append(s)
                 state = self.fail[r]
                 while state and char not in self.goto[state]:
                     state = self.fail[state]
-                self.fail[s] = self.goto[state].get(char, 0) if state else 0
+                self.fail[s] = self.goto[state].get(char, 0)
                 self.out.setdefault(s, []).extend(
                     self.out.get(self.fail[s], [])
                 )
@@ -230,6 +242,401 @@ class AhoCorasick:
         return results
 
 
+class CompactAhoCorasick:
+    """Aho-Corasick automaton stored in flat numpy tables.
+
+    Patterns are matched as UTF-8 bytes. The bytes that occur in the patterns
+    are numbered into a small alphabet, every other byte shares one class
+    that always leads back to the root. The automaton is a complete DFA: one
+    dense int32 row per state gives the next state for every class, so the
+    search does a single table lookup per byte and never follows failure
+    links. Each state also records the first state on its failure chain that
+    ends a pattern, so reporting matches only visits states with output.
+
+    The tables take states * alphabet * 4 bytes. They can be pickled, or
+    written with save() and read back with load() instead of being rebuilt.
+    """
+
+    def __init__(self, patterns: Iterable[str | bytes] = ()):
+        """
+        :param patterns: Patterns to add straight away
+        """
+        if np is None:
+            raise ImportError("CompactAhoCorasick needs numpy")
+        self.patterns: list[str | bytes] = []
+        self._encoded: list[bytes] = []
+        self._built: bool = False
+        for pattern in patterns:
+            self.add_pattern(pattern)
+
+    def add_pattern(self, pattern: str | bytes) -> None:
+        """Add a pattern, this has to happen before build()
+
+        :param pattern: A non-empty string or bytes pattern
+        """
+        if self._built:
+            raise RuntimeError("Patterns can not be added after build()")
+        encoded: bytes = (
+            pattern.encode("utf-8") if isinstance(pattern, str) else pattern
+        )
+        if not encoded:
+            raise ValueError("Empty patterns can not be matched")
+        self.patterns.append(pattern)
+        self._encoded.append(encoded)
+
+    def build(self) -> None:
+        """Build the trie, then turn it into a DFA breadth first."""
+        used: list[int] = sorted(set(b"".join(self._encoded)))
+        # Class 0 stands for every byte that is not in any pattern.
+        classes = np.zeros(256, dtype=np.int32)
+        classes[used] = np.arange(1, len(used) + 1, dtype=np.int32)
+        width: int = len(used) + 1
+        most_states: int = 1 + sum(len(pattern) for pattern in self._encoded)
+        table = np.zeros((most_states, width), dtype=np.int32)
+        output = np.full(most_states, -1, dtype=np.int32)
+        class_of: list[int] = classes.tolist()
+        states: int = 1
+        for number, pattern in enumerate(self._encoded):
+            state: int = 0
+            for byte in pattern:
+                column: int = class_of[byte]
+                following: int = int(table[state, column])
+                if not following:
+                    following = states
+                    table[state, column] = following
+                    states += 1
+                state = following
+            if output[state] == -1:
+                output[state] = number
+        table = table[:states].copy()
+        output = output[:states].copy()
+
+        # Follow the failure links breadth first, one depth of the trie at a
+        # time. A state's missing transitions are copied from its failure
+        # state, whose row is already complete because it is shallower.
+        fail = np.zeros(states, dtype=np.int32)
+        # The nearest state on the failure chain that ends a pattern.
+        next_output = np.full(states, -1, dtype=np.int32)
+        level = table[0][table[0] != 0]
+        while len(level):
+            rows = table[level]
+            fail_rows = table[fail[level]]
+            has_child = rows != 0
+            children = rows[has_child]
+            child_fails = fail_rows[has_child]
+            fail[children] = child_fails
+            next_output[children] = np.where(
+                output[child_fails] != -1,
+                child_fails,
+                next_output[child_fails],
+            )
+            table[level] = np.where(has_child, rows, fail_rows)
+            level = children
+
+        self._set_tables(
+            classes,
+            table,
+            output,
+            np.where(output != -1, np.arange(states), next_output).astype(
+                np.int32
+            ),
+            next_output,
+        )
+
+    def _set_tables(self, classes, table, output, first_output, next_output):
+        """Keep the tables and the flat views the search loop reads."""
+        self.classes = classes
+        self.table = table
+        self.output = output
+        self.first_output = first_output
+        self.next_output = next_output
+        self._built = True
+        self._class_of: list[int] = classes.tolist()
+        self._width: int = table.shape[1]
+        self._flat: memoryview = memoryview(table.reshape(-1))
+        self._first: memoryview = memoryview(first_output)
+        self._next: memoryview = memoryview(next_output)
+        self._output: memoryview = memoryview(output)
+
+    def iter_matches(self, text) -> Iterator[tuple[int, int]]:
+        """Yield (end, pattern number) for every match as it is found
+
+        :param text: The text to search, strings are encoded as UTF-8. Bytes,
+        mmap objects or any iterable of byte values are searched as they are
+        :return: The byte offset just after the match and the index of the
+        pattern in self.patterns
+        """
+        if isinstance(text, str):
+            text = text.encode("utf-8")
+        try:
+            data = memoryview(text)
+        except TypeError:
+            data = text
+        flat: memoryview = self._flat
+        first: memoryview = self._first
+        following: memoryview = self._next
+        output: memoryview = self._output
+        class_of: list[int] = self._class_of
+        width: int = self._width
+        state: int = 0
+        for i, byte in enumerate(data):
+            state = flat[state * width + class_of[byte]]
+            hit: int = first[state]
+            while hit != -1:
+                yield i + 1, output[hit]
+                hit = following[hit]
+
+    def search(self, text: str | bytes) -> list:
+        """Return every match like AhoCorasick.search
+
+        :param text: The text to search
+        :return: A list of (start, pattern), where start is the byte offset
+        of the match in the UTF-8 encoded text
+        """
+        return [
+            (end - len(self._encoded[number]), self.patterns[number])
+            for end, number in self.iter_matches(text)
+        ]
+
+    def matches_any(self, text: str | bytes) -> bool:
+        """Return True as soon as any pattern is found in the text
+
+        :param text: The text to search
+        """
+        return next(self.iter_matches(text), None) is not None
+
+    def save(self, path: str) -> None:
+        """Write the built automaton to a .npz file
+
+        :param path: The file to write
+        """
+        np.savez(
+            path,
+            classes=self.classes,
+            table=self.table,
+            output=self.output,
+            first_output=self.first_output,
+            next_output=self.next_output,
+            # The patterns are stored back to back with their lengths.
+            pattern_bytes=np.frombuffer(b"".join(self._encoded), np.uint8),
+            pattern_lengths=np.array([len(p) for p in self._encoded]),
+            pattern_is_text=np.array(
+                [isinstance(pattern, str) for pattern in self.patterns]
+            ),
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "CompactAhoCorasick":
+        """Read an automaton written by save()
+
+        :param path: The file to read
+        """
+        automaton: CompactAhoCorasick = cls()
+        with np.load(path) as tables:
+            blob: bytes = tables["pattern_bytes"].tobytes()
+            ends: list[int] = np.cumsum(tables["pattern_lengths"]).tolist()
+            automaton._encoded = [
+                blob[end - length : end]
+                for end, length in zip(
+                    ends, tables["pattern_lengths"].tolist()
+                )
+            ]
+            automaton.patterns = [
+                pattern.decode("utf-8") if text else pattern
+                for pattern, text in zip(
+                    automaton._encoded, tables["pattern_is_text"].tolist()
+                )
+            ]
+            automaton._set_tables(
+                tables["classes"],
+                tables["table"],
+                tables["output"],
+                tables["first_output"],
+                tables["next_output"],
+            )
+        return automaton
+
+    def __getstate__(self) -> dict:
+        # The memoryviews can not be pickled, they are rebuilt on load.
+        return {
+            key: value
+            for key, value in self.__dict__.items()
+            if not isinstance(value, memoryview)
+        }
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        if self._built:
+            self._set_tables(
+                self.classes,
+                self.table,
+                self.output,
+                self.first_output,
+                self.next_output,
+            )
+
+
+# Fast backends
+#
+# The functions above compare one character at a time in Python. The
+# backends below keep their signatures but do the work at C speed,
+# vectorized with numpy over the code points (or bytes) of the text. KMP and
+# Boyer-Moore are sequential and have no such backend, find_search uses the
+# built-in find() instead. They accept bytes and mmap objects as well as
+# strings.
+
+
+def _as_array(data):
+    """View text as a numpy array of code points, or bytes as uint8. An
+    array, e.g. from as_code_points, is used as it is."""
+    if isinstance(data, np.ndarray):
+        return data
+    if isinstance(data, str):
+        return np.frombuffer(data.encode("utf-32-le"), dtype=np.uint32)
+    return np.frombuffer(data, dtype=np.uint8)
+
+
+def as_code_points(text: str):
+    """Convert a text that will be searched many times for the numpy backends
+    once, instead of on every search. Without numpy the text is returned as
+    it is.
+
+    :param text: The text that will be searched
+    :return: The code points of the text, to pass as the text to search
+    """
+    return text if np is None else _as_array(text)
+
+
+def _find_offsets(text, pattern, first: bool) -> list[int]:
+    """Collect match offsets, including overlapping ones, with find()."""
+    offsets: list[int] = []
+    i: int = text.find(pattern)
+    while i != -1:
+        offsets.append(i)
+        if first:
+            break
+        i = text.find(pattern, i + 1)
+    return offsets
+
+
+def _naive_offsets(text, pattern, first: bool) -> list[int]:
+    """Vectorized naive search.
+
+    Every window of the text is compared with the pattern at once, one
+    pattern position at a time, dropping out as soon as no window matches.
+    """
+    if np is None or not pattern:
+        return _find_offsets(text, pattern, first)
+    t = _as_array(text)
+    p = _as_array(pattern)
+    n: int = len(t)
+    m: int = len(p)
+    offsets: list[int] = []
+    for start in range(0, n - m + 1, CHUNK_SIZE):
+        # Windows starting in [start, stop) are checked in this block.
+        stop: int = min(start + CHUNK_SIZE, n - m + 1)
+        mask = t[start:stop] == p[0]
+        for j in range(1, m):
+            if not mask.any():
+                break
+            mask &= t[start + j : stop + j] == p[j]
+        found = np.flatnonzero(mask) + start
+        if len(found):
+            if first:
+                return [int(found[0])]
+            offsets.extend(found.tolist())
+    return offsets
+
+
+def _rabin_karp_offsets(text, pattern, first: bool) -> list[int]:
+    """Vectorized Rabin-Karp search.
+
+    The hash of every window is computed at once and only windows whose hash
+    equals the pattern's hash are compared with the pattern.
+    """
+    if np is None or not pattern:
+        return _find_offsets(text, pattern, first)
+    t = _as_array(text)
+    p = _as_array(pattern)
+    n: int = len(t)
+    m: int = len(p)
+    base = np.uint64(RABIN_KARP_BASE)
+    pattern_hash: int = 0
+    for code in p.tolist():
+        pattern_hash = (pattern_hash * RABIN_KARP_BASE + code) % 2**64
+    offsets: list[int] = []
+    for start in range(0, n - m + 1, CHUNK_SIZE):
+        stop: int = min(start + CHUNK_SIZE, n - m + 1)
+        hashes = np.zeros(stop - start, dtype=np.uint64)
+        for j in range(m):
+            hashes *= base
+            hashes += t[start + j : stop + j]
+        for i in (np.flatnonzero(hashes == pattern_hash) + start).tolist():
+            # Rule out hash collisions.
+            if np.array_equal(t[i : i + m], p):
+                if first:
+                    return [i]
+                offsets.append(i)
+    return offsets
+
+
+def _first(offsets: list[int]) -> int:
+    return offsets[0] if offsets else -1
+
+
+def fast_naive_search(text: str, pattern: str) -> int:
+    """naive_search vectorized with numpy
+
+    :param text: The text where the search will be performed
+    :param pattern: The pattern which is being searched from the text
+    :return: Either -1 if no match was found or the offset of the first match
+    """
+    return _first(_naive_offsets(text, pattern, True))
+
+
+def find_search(text: str, pattern: str) -> int:
+    """Search with the built-in str.find (or bytes.find), which is neither
+    KMP nor Boyer-Moore: CPython skips through the text with a
+    Horspool-like shift and switches to the two-way algorithm, with a
+    linear worst case, for long patterns.
+
+    :param text: The text where the search will be performed
+    :param pattern: The pattern which is being searched from the text
+    :return: Either -1 if no match was found or the offset of the first match
+    """
+    return text.find(pattern)
+
+
+def fast_rabin_karp_search(text: str, pattern: str) -> int:
+    """rabin_karp_search with the window hashes vectorized with numpy
+
+    :param text: The text where the search will be performed
+    :param pattern: The pattern which is being searched from the text
+    :return: Either -1 if no match was found or the offset of the first match
+    """
+    return _first(_rabin_karp_offsets(text, pattern, True))
+
+
+# How each algorithm collects all of its matches.
+_ALL_OFFSETS: dict = {
+    "naive": _naive_offsets,
+    "find": _find_offsets,
+    "rabin_karp": _rabin_karp_offsets,
+}
+
+
+def find_all(text: str, pattern: str, algorithm: str = "naive") -> list[int]:
+    """Return the offsets of every match of the pattern, overlapping matches
+    included, using the fast backend of an algorithm.
+
+    :param text: The text where the search will be performed
+    :param pattern: The pattern which is being searched from the text
+    :param algorithm: One of naive, find or rabin_karp
+    :return: The offsets of the matches in increasing order
+    """
+    return _ALL_OFFSETS[algorithm](text, pattern, False)
+
+
 # Function to generate random text
 
 
@@ -251,6 +658,9 @@ def measure_time(search_function, text: str, pattern: str = None) -> float:
 
 
 if __name__ == "__main__":
+    # Only needed for the benchmark report, the server does not use them.
+    import matplotlib.pyplot as plt
+    from tabulate import tabulate
 
     # Define file sizes and pattern
     file_sizes: list = [10000, 50000, 100000, 500000, 1000000]
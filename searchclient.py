@@ -0,0 +1,480 @@
+import asyncio
+import queue
+import socket
+import ssl
+import threading
+from contextlib import asynccontextmanager, contextmanager
+from typing import AsyncIterator, Iterator
+
+from protocol import (
+    STREAM_END,
+    STREAM_ERROR,
+    STATUS_EXISTS,
+    STATUS_NOT_FOUND,
+    STATUS_THROTTLED,
+    THROTTLED_MESSAGE,
+    V1_REPLIES,
+    V1_THROTTLED,
+    V2_LENGTH,
+    V2_MAGIC,
+    FrameReader,
+    encode_v1_frame,
+    encode_v2_batch,
+    encode_v2_command,
+    encode_v2_frame,
+)
+
+FORMAT: str = "utf-8"
+# Largest number of queries sent in one batch frame, bigger batches are split
+# into several frames that are pipelined on the same connection.
+BATCH_SIZE: int = 10000
+
+
+class CommandError(Exception):
+    """Raised when the server reports that a command failed."""
+
+
+class Throttled(Exception):
+    """Raised when the server refused a query because the client sent too
+    many or has too many connections open."""
+
+
+def _parse_status(status: int) -> bool:
+    """Turn a version 2 status byte into the query result
+
+    :param status: The status byte sent by the server
+    """
+    if status == STATUS_EXISTS:
+        return True
+    if status == STATUS_NOT_FOUND:
+        return False
+    if status == STATUS_THROTTLED:
+        raise Throttled("The server throttled the query")
+    raise ConnectionError(f"Unexpected status from server: {status}")
+
+
+class _Connection:
+    """One connection to the server and the reader for its replies."""
+
+    def __init__(self, sock: socket.socket, protocol: int):
+        self.sock: socket.socket = sock
+        self.reader: FrameReader = FrameReader(sock, buffer_size=4096)
+        self.protocol: int = protocol
+        if protocol == 2:
+            sock.sendall(V2_MAGIC)
+
+    def read_v1_reply(self) -> bool:
+        """Read one STRING EXISTS or STRING NOT FOUND reply."""
+        reply: bytes = b""
+        while not reply.endswith(b"\n"):
+            byte: memoryview | None = self.reader.read_exactly(1)
+            if byte is None:
+                raise ConnectionError("Connection closed by the server")
+            reply += bytes(byte)
+        if reply == V1_THROTTLED:
+            raise Throttled("The server throttled the query")
+        if reply not in (V1_REPLIES[True], V1_REPLIES[False]):
+            raise ConnectionError(f"Unexpected reply from server: {reply!r}")
+        return reply == V1_REPLIES[True]
+
+    def read_v2_status(self) -> bool:
+        """Read one status byte."""
+        status: memoryview | None = self.reader.read_exactly(1)
+        if status is None:
+            raise ConnectionError("Connection closed by the server")
+        return _parse_status(status[0])
+
+    def read_stream(self) -> Iterator[bytes]:
+        """Yield the items of a command's reply stream as they arrive."""
+        while True:
+            length: int = self.read_length()
+            if length == STREAM_END:
+                return
+            if length == STREAM_ERROR:
+                message: bytes = self.read_item(self.read_length())
+                if message == THROTTLED_MESSAGE:
+                    raise Throttled("The server throttled the command")
+                raise CommandError(message.decode(FORMAT))
+            yield self.read_item(length)
+
+    def read_length(self) -> int:
+        """Read the length that starts a version 2 frame."""
+        header: memoryview | None = self.reader.read_exactly(V2_LENGTH.size)
+        if header is None:
+            raise ConnectionError("Connection closed by the server")
+        return V2_LENGTH.unpack(header)[0]
+
+    def read_item(self, length: int) -> bytes:
+        """Read the payload of a version 2 frame."""
+        item: memoryview | None = self.reader.read_exactly(length)
+        if item is None:
+            raise ConnectionError("Connection closed by the server")
+        return bytes(item)
+
+    def close(self) -> None:
+        self.sock.close()
+
+
+class SearchClient:
+    """A reusable, thread-safe client for the search server.
+
+    Connections are kept open in a pool and reused across calls so most
+    lookups do not pay for a TCP or TLS handshake. New TLS connections resume
+    the last session the pool saw, which makes their handshake cheaper too.
+
+    Example::
+
+        client = SearchClient("127.0.0.1", 5050)
+        client.exists("Brother")
+        client.exists_many(["Brother", "Sister"])
+        client.close()
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        ssl_context: ssl.SSLContext | None = None,
+        server_hostname: str | None = None,
+        pool_size: int = 8,
+        timeout: float | None = None,
+        protocol: int = 2,
+    ):
+        """
+        :param host: The address of the server
+        :param port: The port of the server
+        :param ssl_context: The SSL context to wrap connections with, or None
+        for plain TCP
+        :param server_hostname: The name to check the server's certificate
+        against, defaults to host
+        :param pool_size: The most connections open at the same time
+        :param timeout: The socket timeout in seconds
+        :param protocol: The protocol version to speak, 1 or 2
+        """
+        self.address: tuple = (host, port)
+        self.ssl_context: ssl.SSLContext | None = ssl_context
+        self.server_hostname: str = server_hostname or host
+        self.timeout: float | None = timeout
+        self.protocol: int = protocol
+        self._idle: queue.LifoQueue = queue.LifoQueue()
+        self._slots: threading.BoundedSemaphore = threading.BoundedSemaphore(
+            pool_size
+        )
+        self._session: ssl.SSLSession | None = None
+        self._closed: bool = False
+
+    def exists(self, query: str) -> bool:
+        """Return True if the query exists as a line in the server's file
+
+        :param query: The line being searched for
+        """
+        message: bytes = query.encode(FORMAT)
+        with self._connection() as connection:
+            if self.protocol == 2:
+                connection.sock.sendall(encode_v2_frame(message))
+                return connection.read_v2_status()
+            connection.sock.sendall(encode_v1_frame(message))
+            return connection.read_v1_reply()
+
+    def exists_many(self, queries: list[str]) -> list[bool]:
+        """Look up many queries over a single connection
+
+        With protocol version 2 the queries are sent in batch frames, with
+        version 1 they are pipelined one frame each. In both cases every frame
+        is sent before the replies are read so there is no round trip per
+        query.
+
+        :param queries: The lines being searched for
+        :return: Whether each query exists, in the same order
+        :raises ValueError: If a query contains a newline
+        """
+        messages: list[bytes] = [query.encode(FORMAT) for query in queries]
+        with self._connection() as connection:
+            if self.protocol == 2:
+                batches: list[list[bytes]] = [
+                    messages[i : i + BATCH_SIZE]
+                    for i in range(0, len(messages), BATCH_SIZE)
+                ]
+                connection.sock.sendall(
+                    b"".join(encode_v2_batch(batch) for batch in batches)
+                )
+                results: list[bool] = []
+                for _ in batches:
+                    statuses: bytes = connection.read_item(
+                        connection.read_length()
+                    )
+                    results.extend(
+                        _parse_status(status) for status in statuses
+                    )
+                return results
+            connection.sock.sendall(
+                b"".join(encode_v1_frame(message) for message in messages)
+            )
+            return [connection.read_v1_reply() for _ in messages]
+
+    def match(self, patterns: list[str], mode: str = "line") -> Iterator[str]:
+        """Find which of many patterns are in the server's file in one pass
+
+        The patterns that were found are yielded as the server finds them.
+        Needs protocol version 2.
+
+        :param patterns: The patterns being searched for, none of them may
+        contain a newline
+        :param mode: "line" to match whole lines, "substring" to match the
+        patterns anywhere
+        """
+        yield from self.command("MATCH", [mode, *patterns])
+
+    def prefix_exists(self, prefix: str) -> bool:
+        """Return True if any line of the server's file starts with a prefix
+
+        :param prefix: The start of the line
+        """
+        return list(self.command("PREFIX_EXISTS", [prefix])) == ["1"]
+
+    def prefix_count(self, prefix: str) -> int:
+        """Return how many lines of the server's file start with a prefix
+
+        :param prefix: The start of the lines
+        """
+        # Unpacking reads the whole reply, so the connection goes back to
+        # the pool instead of being closed with the reply half read.
+        (count,) = self.command("PREFIX_COUNT", [prefix])
+        return int(count)
+
+    def range_list(
+        self, first: str, last: str, offset: int = 0, limit: int = 1000
+    ) -> list[str]:
+        """Return one page of the lines from first to last in sorted order
+
+        The server caps the page size, a page shorter than the limit is the
+        last one.
+
+        :param first: The smallest line, included
+        :param last: The largest line, included
+        :param offset: How many lines of the range to skip
+        :param limit: The most lines to return
+        """
+        return list(
+            self.command("RANGE", [first, last, str(offset), str(limit)])
+        )
+
+    def regex(self, pattern: str, limit: int = 1000) -> Iterator[str]:
+        """Yield the lines of the server's file that a regular expression
+        matches, as the server finds them
+
+        :param pattern: The regular expression, it is matched against one
+        line at a time
+        :param limit: The most lines to return, the server caps it too
+        :raises CommandError: If the pattern was rejected or the search took
+        too long
+        """
+        yield from self.command("REGEX", [pattern, str(limit)])
+
+    def reload(self, force: bool = False) -> bool:
+        """Ask the server to load its file again and return True once the
+        new copy answers queries, False if the file had not changed
+
+        :param force: Load the file even if it looks unchanged
+        """
+        return list(self.command("RELOAD", ["force"] if force else [])) == [
+            "1"
+        ]
+
+    def stats(self) -> str:
+        """Return the server's counters and stage timings in the Prometheus
+        text format."""
+        (stats,) = self.command("STATS", [])
+        return stats
+
+    def command(self, name: str, args: list[str]) -> Iterator[str]:
+        """Send a command and yield the items of its reply as they arrive
+
+        :param name: The name of the command
+        :param args: The arguments of the command
+        :raises CommandError: If the server reports that the command failed
+        """
+        if self.protocol != 2:
+            raise ValueError("Commands need protocol version 2")
+        with self._connection() as connection:
+            connection.sock.sendall(
+                encode_v2_command(name, [arg.encode(FORMAT) for arg in args])
+            )
+            for item in connection.read_stream():
+                yield item.decode(FORMAT)
+
+    def close(self) -> None:
+        """Close every idle connection, connections in use close on release"""
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def __enter__(self) -> "SearchClient":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    @contextmanager
+    def _connection(self) -> Iterator[_Connection]:
+        """Borrow a connection from the pool, opening one if none is idle.
+
+        A connection that failed is closed instead of being returned to the
+        pool.
+        """
+        self._slots.acquire()
+        try:
+            try:
+                connection: _Connection = self._idle.get_nowait()
+            except queue.Empty:
+                connection = self._connect()
+            try:
+                yield connection
+            except BaseException:
+                connection.close()
+                raise
+            if self._closed:
+                connection.close()
+            else:
+                self._remember_session(connection)
+                self._idle.put(connection)
+        finally:
+            self._slots.release()
+
+    def _connect(self) -> _Connection:
+        """Open a new connection, resuming the last TLS session if any."""
+        sock: socket.socket = socket.create_connection(
+            self.address, timeout=self.timeout
+        )
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.ssl_context is not None:
+            try:
+                sock = self.ssl_context.wrap_socket(
+                    sock,
+                    server_hostname=self.server_hostname,
+                    session=self._session,
+                )
+            except BaseException:
+                sock.close()
+                raise
+        return _Connection(sock, self.protocol)
+
+    def _remember_session(self, connection: _Connection) -> None:
+        """Keep the TLS session of a connection that is going back to the
+        pool so new connections can resume it.
+
+        With TLS 1.3 the server sends its session tickets after the
+        handshake and they are only read along with the first reply, so the
+        session is taken once the connection has been used, not when it was
+        opened.
+        """
+        if not isinstance(connection.sock, ssl.SSLSocket):
+            return
+        session: ssl.SSLSession | None = connection.sock.session
+        if session is not None and session.has_ticket:
+            self._session = session
+
+
+class AsyncSearchClient:
+    """The asyncio version of SearchClient.
+
+    asyncio does not expose TLS session resumption, so new TLS connections
+    always do a full handshake, but connections are pooled just the same.
+    Only protocol version 2 is spoken.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        ssl_context: ssl.SSLContext | None = None,
+        server_hostname: str | None = None,
+        pool_size: int = 8,
+    ):
+        """
+        :param host: The address of the server
+        :param port: The port of the server
+        :param ssl_context: The SSL context to wrap connections with, or None
+        for plain TCP
+        :param server_hostname: The name to check the server's certificate
+        against, defaults to host
+        :param pool_size: The most connections open at the same time
+        """
+        self.host: str = host
+        self.port: int = port
+        self.ssl_context: ssl.SSLContext | None = ssl_context
+        self.server_hostname: str = server_hostname or host
+        self._idle: list[tuple] = []
+        self._slots: asyncio.Semaphore = asyncio.Semaphore(pool_size)
+
+    async def exists(self, query: str) -> bool:
+        """Return True if the query exists as a line in the server's file
+
+        :param query: The line being searched for
+        """
+        async with self._connection() as (reader, writer):
+            writer.write(encode_v2_frame(query.encode(FORMAT)))
+            await writer.drain()
+            return _parse_status((await reader.readexactly(1))[0])
+
+    async def exists_many(self, queries: list[str]) -> list[bool]:
+        """Look up many queries in batch frames over a single connection
+
+        :param queries: The lines being searched for
+        :return: Whether each query exists, in the same order
+        :raises ValueError: If a query contains a newline
+        """
+        messages: list[bytes] = [query.encode(FORMAT) for query in queries]
+        results: list[bool] = []
+        async with self._connection() as (reader, writer):
+            batches: int = 0
+            for i in range(0, len(messages), BATCH_SIZE):
+                writer.write(encode_v2_batch(messages[i : i + BATCH_SIZE]))
+                batches += 1
+            await writer.drain()
+            for _ in range(batches):
+                count: int = V2_LENGTH.unpack(
+                    await reader.readexactly(V2_LENGTH.size)
+                )[0]
+                statuses: bytes = await reader.readexactly(count)
+                results.extend(_parse_status(status) for status in statuses)
+        return results
+
+    async def close(self) -> None:
+        """Close every idle connection"""
+        while self._idle:
+            _, writer = self._idle.pop()
+            writer.close()
+            await writer.wait_closed()
+
+    async def __aenter__(self) -> "AsyncSearchClient":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    @asynccontextmanager
+    async def _connection(self) -> AsyncIterator[tuple]:
+        """Borrow a connection from the pool, opening one if none is idle."""
+        async with self._slots:
+            if self._idle:
+                reader, writer = self._idle.pop()
+            else:
+                reader, writer = await asyncio.open_connection(
+                    self.host,
+                    self.port,
+                    ssl=self.ssl_context,
+                    server_hostname=(
+                        self.server_hostname if self.ssl_context else None
+                    ),
+                )
+                writer.write(V2_MAGIC)
+            try:
+                yield reader, writer
+            except BaseException:
+                writer.close()
+                raise
+            self._idle.append((reader, writer))
@@ -0,0 +1,403 @@
+from bloomfilter import BloomFilter
+from corpus import MmapCorpus
+from diskindex import DiskIndex
+from searchalgorithms import (
+    AhoCorasick,
+    CompactAhoCorasick,
+    as_code_points,
+    fast_rabin_karp_search,
+    find_search,
+)
+from functools import partial
+from itertools import chain
+from typing import BinaryIO, Callable, Iterator
+import io
+import re
+
+# How many characters of content are split into lines and added to a
+# LineIndex at a time. Other threads get the GIL between chunks, so queries
+# are still answered while a large index is built in the background.
+BUILD_CHUNK: int = 1 << 20
+
+
+class LineIndex:
+    """An in-memory index of every line in the file content.
+
+    The server only answers exact full-line queries, so instead of scanning
+    the whole file with a regular expression on every query we split the
+    content into lines once and store them in a hash set. Each lookup is then
+    a single O(1) membership test. Lines appended to the file later can be
+    added with extend() without rebuilding the whole index.
+    """
+
+    def __init__(self, file_content: str):
+        """
+        :param file_content: The content of the file that will be indexed
+        """
+        # The text after the last newline is kept on its own so the index
+        # matches exactly what re.search(rf"^{msg}$", ..., re.MULTILINE) would.
+        self.tail: str = ""
+        self.lines: set[str] = set()
+        self.extend(file_content)
+
+    def __contains__(self, line: str) -> bool:
+        """Return True if the line exists in the indexed content
+
+        :param line: The line being searched for
+        """
+        return line in self.lines or line == self.tail
+
+    def extend(self, text: str) -> None:
+        """Add text that was appended to the indexed content.
+
+        The text must start where the last complete line of the indexed
+        content ended, i.e. it includes the current tail.
+
+        :param text: The content from the start of the old tail to the new end
+        """
+        start: int = 0
+        end: int = text.find("\n", BUILD_CHUNK)
+        while end != -1:
+            self.lines.update(text[start:end].split("\n"))
+            start = end + 1
+            end = text.find("\n", start + BUILD_CHUNK)
+        lines: list[str] = text[start:].split("\n")
+        tail: str = lines.pop()
+        self.lines.update(lines)
+        self.tail = tail
+
+
+class SearchEngine:
+    """The interface every search engine implements.
+
+    Anything that only depends on the file, such as an index or a padded copy
+    of the text, is built once in prepare() when the file is loaded. contains()
+    then answers a single exact line query.
+    """
+
+    # Whether prepare() needs the decoded file content.
+    needs_content: bool = True
+    # Whether a lookup scans the file rather than probing an index, which
+    # decides whether the asyncio engine moves it off the event loop.
+    scans: bool = True
+    # Whether lines appended to the file can be added with extend().
+    supports_append: bool = False
+
+    def prepare(self, file_path: str, content: str | None = None) -> None:
+        """Build whatever the engine needs from the file
+
+        :param file_path: The path to the file being searched
+        :param content: The decoded content of the file, if the engine
+        needs it
+        """
+        raise NotImplementedError
+
+    def contains(self, line: str) -> bool:
+        """Return True if the line exists in the file
+
+        :param line: The line being searched for
+        """
+        raise NotImplementedError
+
+    def contains_many(self, lines: list[str]) -> list[bool]:
+        """Return whether each line exists in the file
+
+        :param lines: The lines being searched for
+        """
+        return [self.contains(line) for line in lines]
+
+    def extend(self, text: str) -> None:
+        """Add text appended to the file, see LineIndex.extend
+
+        :param text: The content from the start of the old tail to the new end
+        """
+        raise NotImplementedError
+
+
+class SetEngine(SearchEngine):
+    """Looks queries up in a LineIndex, one hash lookup per query."""
+
+    scans = False
+    supports_append = True
+
+    def prepare(self, file_path: str, content: str | None = None) -> None:
+        self.index: LineIndex = LineIndex(content)
+
+    def contains(self, line: str) -> bool:
+        return line in self.index
+
+    def extend(self, text: str) -> None:
+        self.index.extend(text)
+
+
+class RegexEngine(SearchEngine):
+    """Scans the file content with a multiline regular expression."""
+
+    def prepare(self, file_path: str, content: str | None = None) -> None:
+        self.content: str = content
+
+    def contains(self, line: str) -> bool:
+        if "\n" in line:
+            # A line never holds a newline, the pattern would match across
+            # lines.
+            return False
+        # The query is a literal line, characters such as . or * in it must
+        # not change its meaning.
+        pattern: str = rf"^{re.escape(line)}$"
+        return re.search(pattern, self.content, re.MULTILINE) is not None
+
+    def contains_many(self, lines: list[str]) -> list[bool]:
+        # One pass over the lines of the file answers every query.
+        present: set[str] = set(lines).intersection(self.content.split("\n"))
+        return [line in present for line in lines]
+
+
+class SubstringEngine(SearchEngine):
+    """Finds a line by searching for it between two newlines with one of the
+    fast backends from searchalgorithms.py.
+    """
+
+    def __init__(
+        self,
+        search: Callable[[str, str], int],
+        convert: Callable[[str], object] | None = None,
+    ):
+        """
+        :param search: The search function, it returns -1 when there is no
+        match
+        :param convert: Turns the content into the form the search function
+        works on, once when the engine is prepared instead of on every query
+        """
+        self.search: Callable[[str, str], int] = search
+        self.convert: Callable[[str], object] | None = convert
+
+    def prepare(self, file_path: str, content: str | None = None) -> None:
+        # Wrap the content in newlines once so the first and last lines need
+        # no special case.
+        self.text = f"\n{content}\n"
+        if self.convert is not None:
+            self.text = self.convert(self.text)
+
+    def contains(self, line: str) -> bool:
+        if "\n" in line:
+            # The text would match a query spanning several lines.
+            return False
+        return self.search(self.text, f"\n{line}\n") != -1
+
+
+class AhoCorasickEngine(SearchEngine):
+    """Builds an Aho-Corasick automaton whose patterns are the lines of the
+    file, so a query is answered by running it through the automaton.
+
+    The automaton is built in Python, which takes about 20 seconds for a file
+    of 200,000 lines, so prepare is slow for large files.
+    """
+
+    scans = False
+
+    def prepare(self, file_path: str, content: str | None = None) -> None:
+        self.automaton: AhoCorasick = AhoCorasick()
+        self.has_empty_line: bool = False
+        for line in set(content.split("\n")):
+            if line:
+                self.automaton.add_pattern(line)
+            else:
+                self.has_empty_line = True
+        self.automaton.build()
+
+    def contains(self, line: str) -> bool:
+        if not line:
+            return self.has_empty_line
+        # A line of the file matches the whole query only if it starts at 0
+        # and is the query itself.
+        return (0, line) in self.automaton.search(line)
+
+
+class MmapEngine(SearchEngine):
+    """Searches the raw bytes of the memory mapped file, see MmapCorpus."""
+
+    needs_content = False
+
+    def __init__(self, encoding: str = "utf-8"):
+        """
+        :param encoding: The encoding used to encode queries
+        """
+        self.encoding: str = encoding
+
+    def prepare(self, file_path: str, content: str | None = None) -> None:
+        self.corpus: MmapCorpus = MmapCorpus(file_path)
+
+    def contains(self, line: str) -> bool:
+        return self.corpus.contains_line(line.encode(self.encoding))
+
+
+class DiskIndexEngine(SearchEngine):
+    """Looks queries up in a hash table of the file's lines that is saved
+    next to the file, see DiskIndex. Restarts only map the saved table.
+    """
+
+    needs_content = False
+    scans = False
+
+    def __init__(self, encoding: str = "utf-8"):
+        """
+        :param encoding: The encoding used to encode queries
+        """
+        self.encoding: str = encoding
+
+    def prepare(self, file_path: str, content: str | None = None) -> None:
+        self.index: DiskIndex = DiskIndex(file_path)
+
+    def contains(self, line: str) -> bool:
+        return self.index.contains_line(line.encode(self.encoding))
+
+
+class BloomEngine(SearchEngine):
+    """Puts a Bloom filter of the file's lines in front of another engine.
+
+    A query the filter has never seen is answered as not found at once, only
+    queries that may be in the file are passed to the engine. This makes
+    misses cheap for engines that scan the file.
+    """
+
+    def __init__(
+        self,
+        engine: SearchEngine,
+        error_rate: float,
+        encoding: str = "utf-8",
+    ):
+        """
+        :param engine: The engine that answers queries the filter lets past
+        :param error_rate: The share of missing lines the filter lets past
+        :param encoding: The encoding of the file
+        """
+        self.engine: SearchEngine = engine
+        self.error_rate: float = error_rate
+        self.encoding: str = encoding
+        self.needs_content: bool = engine.needs_content
+        self.scans: bool = engine.scans
+        self.supports_append: bool = engine.supports_append
+
+    def prepare(self, file_path: str, content: str | None = None) -> None:
+        self.engine.prepare(file_path, content)
+        stream: BinaryIO
+        if content is not None:
+            stream = io.BytesIO(content.encode(self.encoding))
+        else:
+            # Read the file a line at a time so it is never held in memory.
+            stream = open(file_path, "rb")
+        with stream:
+            # Count the lines in a first pass to size the filter, then add
+            # them in a second so no list of the lines is built.
+            count: int = sum(
+                chunk.count(b"\n")
+                for chunk in iter(partial(stream.read, BUILD_CHUNK), b"")
+            )
+            self.filter: BloomFilter = BloomFilter(count + 1, self.error_rate)
+            stream.seek(0)
+            for line in stream:
+                # The CR of CRLF lines is not part of the line either.
+                self.filter.add(line.rstrip(b"\r\n"))
+        # The empty text after a final newline is a line too.
+        self.filter.add(b"")
+
+    def contains(self, line: str) -> bool:
+        if line.encode(self.encoding) not in self.filter:
+            return False
+        return self.engine.contains(line)
+
+    def contains_many(self, lines: list[str]) -> list[bool]:
+        maybe: list[str] = [
+            line for line in lines if line.encode(self.encoding) in self.filter
+        ]
+        found: set[str] = {
+            line
+            for line, exists in zip(maybe, self.engine.contains_many(maybe))
+            if exists
+        }
+        return [line in found for line in lines]
+
+    def extend(self, text: str) -> None:
+        self.engine.extend(text)
+        for line in text.encode(self.encoding).split(b"\n"):
+            self.filter.add(line)
+
+
+# The engines that can be chosen with [search] engine in config.ini.
+ENGINES: dict[str, Callable[[], SearchEngine]] = {
+    "set": SetEngine,
+    "regex": RegexEngine,
+    "find": lambda: SubstringEngine(find_search),
+    "rabin_karp": lambda: SubstringEngine(
+        fast_rabin_karp_search, as_code_points
+    ),
+    "aho_corasick": AhoCorasickEngine,
+    "mmap": MmapEngine,
+    "disk_index": DiskIndexEngine,
+}
+# Older names of engines, kmp and boyer_moore always searched with find.
+ENGINE_ALIASES: dict[str, str] = {"kmp": "find", "boyer_moore": "find"}
+
+
+def create_engine(name: str, bloom_error_rate: float = 0) -> SearchEngine:
+    """Create an engine by its name in ENGINES or ENGINE_ALIASES
+
+    :param name: The name of the engine
+    :param bloom_error_rate: Put a BloomEngine with this error rate in front
+    of the engine, 0 for none
+    :raises ValueError: If there is no engine with that name
+    """
+    try:
+        engine: SearchEngine = ENGINES[ENGINE_ALIASES.get(name, name)]()
+    except KeyError:
+        raise ValueError(
+            f"Unknown search engine {name!r}, choose one of "
+            + ", ".join(ENGINES)
+        ) from None
+    if bloom_error_rate:
+        return BloomEngine(engine, bloom_error_rate)
+    return engine
+
+
+def match_patterns(
+    data, patterns: list[str], whole_lines: bool, encoding: str = "utf-8"
+) -> Iterator[str]:
+    """Find which of many patterns occur in the file in a single pass.
+
+    The patterns are compiled into a CompactAhoCorasick automaton and the
+    file is scanned once. Each pattern is yielded the first time it is found
+    and the scan stops early once every pattern has been found.
+
+    :param data: The raw bytes of the file, e.g. an mmap
+    :param patterns: The patterns being searched for
+    :param whole_lines: Only match patterns that are a whole line of the
+    file, otherwise match them anywhere
+    :param encoding: The encoding of the file
+    """
+    wanted: list[str] = list(dict.fromkeys(patterns))
+    if whole_lines:
+        # A line is found by matching it between two newlines, the file is
+        # wrapped in newlines so the first and last lines are no exception.
+        wanted = [pattern for pattern in wanted if "\n" not in pattern]
+        encoded: list[bytes] = [
+            f"\n{pattern}\n".encode(encoding) for pattern in wanted
+        ]
+        text = chain(b"\n", memoryview(data), b"\n")
+    else:
+        # The empty string is in every file.
+        if "" in wanted:
+            wanted.remove("")
+            yield ""
+        encoded = [pattern.encode(encoding) for pattern in wanted]
+        text = data
+    if not wanted:
+        return
+    automaton: CompactAhoCorasick = CompactAhoCorasick(encoded)
+    automaton.build()
+    found: set[int] = set()
+    for _, number in automaton.iter_matches(text):
+        if number not in found:
+            found.add(number)
+            yield wanted[number]
+            if len(found) == len(wanted):
+                return
@@ -1,19 +1,46 @@
-# These are the different file search algorithms that we can implement in
-# our search function.
-from searchalgorithms import (
-    boyer_moore_search,
-    kmp_search,
-    naive_search,
-    AhoCorasick,
-    rabin_karp_search,
+from admission import ClientLimiter
+from corpus import FileReloader, MmapCorpus
+from metrics import Metrics
+from protocol import (
+    BATCH_FLAG,
+    COMMAND_FLAG,
+    LENGTH_MASK,
+    STREAM_END,
+    STREAM_ERROR,
+    V1_REPLIES,
+    V1_THROTTLED,
+    V2_LENGTH,
+    V2_MAGIC,
+    V2_REPLIES,
+    FrameReader,
+    FrameTooLarge,
+    check_frame_length,
+    encode_batch_reply,
+    encode_throttled_reply,
+    encode_v2_frame,
 )
+from querycache import QueryCache
+from regexsearch import RegexSearcher
+from searchengines import SearchEngine, create_engine, match_patterns
+from shards import ShardedCorpus
+from sortedindex import SortedLineIndex
+from workerpool import WorkerPool
+import asyncio
+import atexit
 import configparser
+import functools
+import gc
+import http.server
 import logging
-import re
+import os
+import queue
+import signal
 import socket
 import ssl
 import threading
 import time
+from logging.handlers import QueueHandler, QueueListener
+from typing import Callable, Iterator
 
 
 # Load configuration
@@ -30,27 +57,189 @@ SSL_ENABLED: bool = config.getboolean("server", "ssl_enabled")
 CERTIFICATE_PATH: str = config.get("server", "certificate_path")
 PRIVATE_KEY: str = config.get("server", "private_key")
 CERT_PEM: str = config.get("server", "certificate_pem")
+# The oldest TLS version accepted, TLS 1.3 is used whenever the client
+# supports it.
+TLS_MIN_VERSION: str = config.get(
+    "server", "tls_min_version", fallback="TLSv1_2"
+)
+# How many TLS 1.3 session tickets are sent after a full handshake, each
+# lets the client resume one new connection without a full handshake.
+TLS_SESSION_TICKETS: int = config.getint(
+    "server", "tls_session_tickets", fallback=2
+)
+# The most seconds a client may take to finish the TLS handshake.
+HANDSHAKE_TIMEOUT: float = config.getfloat(
+    "server", "handshake_timeout", fallback=10
+)
 REREAD_ON_QUERY: bool = config.getboolean("server", "reread_on_query")
 # REREAD_ON_QUERY = False
+# "threaded" hands connections to a pool of WORKERS threads, "asyncio"
+# serves every connection from a single event loop.
+SERVER_ENGINE: str = config.get("server", "engine", fallback="threaded")
+# Size of the threaded engine's worker pool and of the queue of accepted
+# connections waiting for a worker.
+WORKERS: int = config.getint("server", "workers", fallback=32)
+QUEUE_DEPTH: int = config.getint("server", "queue_depth", fallback=128)
+LISTEN_BACKLOG: int = config.getint("server", "listen_backlog", fallback=128)
+# "queue" waits for room in the queue, "reject" replies SERVER BUSY at once.
+BUSY_POLICY: str = config.get("server", "busy_policy", fallback="queue")
+# Queries a second each client address may send, with bursts of up to
+# RATE_BURST queries, and how many connections it may have open. Clients
+# over a limit get THROTTLED. 0 turns a limit off.
+RATE_LIMIT: float = config.getfloat("server", "rate_limit", fallback=0)
+RATE_BURST: float = config.getfloat(
+    "server", "rate_burst", fallback=max(RATE_LIMIT, 1)
+)
+MAX_CONNECTIONS_PER_CLIENT: int = config.getint(
+    "server", "max_connections_per_client", fallback=0
+)
+# The most seconds a connection may wait between messages and may take to
+# send the rest of a message once its header arrived. 0 waits forever.
+IDLE_TIMEOUT: float = config.getfloat("server", "idle_timeout", fallback=300)
+READ_TIMEOUT: float = config.getfloat("server", "read_timeout", fallback=30)
+# The longest message a client may send in bytes. Longer ones close the
+# connection before any of the message is read or buffered.
+MAX_FRAME_SIZE: int = config.getint(
+    "server", "max_frame_size", fallback=16 << 20
+)
+# More than one process pre-forks workers that each bind PORT with
+# SO_REUSEPORT so searches are spread over all cores.
+PROCESSES: int = config.getint("server", "processes", fallback=1)
+# A worker that exits within WORKER_MIN_UPTIME seconds of being started is
+# restarted after a delay that starts at WORKER_MIN_BACKOFF and doubles each
+# time, up to WORKER_MAX_BACKOFF.
+# After MAX_QUICK_RESTARTS such exits in a row the server gives up.
+MAX_QUICK_RESTARTS: int = config.getint(
+    "server", "max_quick_restarts", fallback=5
+)
+WORKER_MIN_UPTIME: float = 1.0
+WORKER_MIN_BACKOFF: float = 0.1
+WORKER_MAX_BACKOFF: float = 30.0
+# How often the pre-fork parent checks for exited workers and reloads.
+SUPERVISOR_TICK: float = 0.1
 FILE_PATH: str = config.get("server", "linuxpath")
 # FILE_PATH: str = 'test_200K.txt' # use this when running the test suite
+# One of the engines in searchengines.ENGINES: "set" answers queries from an
+# in-memory line index, "regex" scans the file, "find" searches it with
+# str.find and "rabin_karp" with that algorithm, "aho_corasick" runs queries
+# through an automaton of the file's lines, "mmap" searches the raw bytes
+# of the memory mapped file and "disk_index" maps a hash table of the lines
+# that is saved next to the file and only rebuilt when the file changed.
+SEARCH_ENGINE: str = config.get("search", "engine", fallback="set")
+# How many query results are cached for engines that scan the file, 0 turns
+# the cache off. Results expire after CACHE_TTL seconds, 0 keeps them until
+# they are evicted or the file changes.
+# A Bloom filter of the file's lines answers most misses without searching
+# the file, it lets this share of missing lines through. 0 turns it off.
+BLOOM_ERROR_RATE: float = config.getfloat(
+    "search", "bloom_error_rate", fallback=0
+)
+CACHE_SIZE: int = config.getint("search", "cache_size", fallback=10000)
+CACHE_TTL: float = config.getfloat("search", "cache_ttl", fallback=0)
+# How many compiled patterns the REGEX command keeps and how many seconds
+# one REGEX search may take.
+REGEX_CACHE_SIZE: int = config.getint(
+    "search", "regex_cache_size", fallback=256
+)
+REGEX_TIMEOUT: float = config.getfloat("search", "regex_timeout", fallback=1)
+# With SHARD_PROCESSES above 0 the MATCH and REGEX commands split the files
+# in SHARD_FILES (a comma separated list of files and glob patterns, the
+# file at linuxpath when empty) into shards of SHARD_SIZE bytes and search
+# them in parallel in that many worker processes.
+SHARD_FILES: str = config.get("search", "shards", fallback="")
+SHARD_SIZE: int = config.getint("search", "shard_size", fallback=64 << 20)
+SHARD_PROCESSES: int = config.getint("search", "shard_processes", fallback=0)
+# The most lines one RANGE or REGEX command sends back, larger ranges are
+# paged.
+RANGE_LIMIT: int = config.getint("search", "range_limit", fallback=1000)
+# How often in seconds the file is checked for changes, a changed file is
+# loaded in the background and swapped in. 0 only reloads on SIGHUP or the
+# RELOAD command.
+WATCH_INTERVAL: float = config.getfloat("search", "watch_interval", fallback=0)
+# The lowest level of messages that are logged, DEBUG logs every query.
+LOG_LEVEL: str = config.get("server", "log_level", fallback="INFO")
+# The port of the Prometheus metrics page on LISTEN_IP, 0 turns it off.
+METRICS_PORT: int = config.getint("server", "metrics_port", fallback=0)
+# Time one in this many requests, the counters always count every request.
+METRICS_SAMPLE_EVERY: int = config.getint(
+    "server", "metrics_sample_every", fallback=1
+)
 HEADER: int = 1024
 FORMAT: str = "utf-8"
 DISCONNECT_MESSAGE: str = "!DISCONNECT"
+BUSY_MESSAGE: bytes = b"SERVER BUSY\n"
 
-# Setup logging
-logging.basicConfig(
-    level=logging.DEBUG, format="%(asctime)s - %(levelname)s - %(message)s"
+# Setup logging. Request threads only put records on a queue, a listener
+# thread writes them out so a slow stderr can not stall a request.
+log_queue: queue.SimpleQueue = queue.SimpleQueue()
+log_handler: logging.Handler = logging.StreamHandler()
+log_handler.setFormatter(
+    logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
 )
+queue_handler: QueueHandler = QueueHandler(log_queue)
+# The record is formatted once, by log_handler.
+queue_handler.setFormatter(logging.Formatter("%(message)s"))
+logging.basicConfig(level=LOG_LEVEL, handlers=[queue_handler])
+log_listener: QueueListener = QueueListener(log_queue, log_handler)
+log_listener.start()
 
 
-# Set up SSL context if enabled.
-context = None
-if SSL_ENABLED:
+def restart_log_listener() -> None:
+    """Start a listener in a forked process, which only inherits the thread
+    that forked it. The records queued at the fork are the parent's to write,
+    so the child starts on a queue of its own."""
+    global log_queue, log_listener
+    log_queue = queue.SimpleQueue()
+    queue_handler.queue = log_queue
+    log_listener = QueueListener(log_queue, log_handler)
+    log_listener.start()
+
+
+os.register_at_fork(after_in_child=restart_log_listener)
+# Write out the records still queued when the server exits.
+atexit.register(lambda: log_listener.stop())
+
+# Counters and stage timings, see the STATS command and METRICS_PORT.
+METRICS: Metrics = Metrics("search_server_", METRICS_SAMPLE_EVERY)
+
+
+def create_ssl_context(certificate: str, private_key: str) -> ssl.SSLContext:
+    """Return the SSL context connections are wrapped with
+
+    :param certificate: The path to the pem file of the certificate
+    :param private_key: The path to the private key of the certificate
+    """
     context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion[TLS_MIN_VERSION]
+    context.maximum_version = ssl.TLSVersion.MAXIMUM_SUPPORTED
+    # Clients resume sessions with the tickets, TLS 1.2 clients get a ticket
+    # too as OP_NO_TICKET is not set. The ticket keys are made here, before
+    # any fork, so every worker process can resume every other's sessions.
+    context.num_tickets = TLS_SESSION_TICKETS
+    # For TLS 1.2 only forward secret AEAD ciphers are offered, in the
+    # server's order. TLS 1.3 only has such ciphers.
+    context.set_ciphers("ECDHE+AESGCM:ECDHE+CHACHA20")
+    context.options |= ssl.OP_CIPHER_SERVER_PREFERENCE
     # You can also use:
     # context.load_cert_chain(CERTIFICATE_PATH)
-    context.load_cert_chain(CERT_PEM, PRIVATE_KEY)
+    context.load_cert_chain(certificate, private_key)
+    return context
+
+
+# Set up SSL context if enabled.
+context = None
+if SSL_ENABLED:
+    context = create_ssl_context(CERT_PEM, PRIVATE_KEY)
+
+
+def file_signature(file_path: str) -> tuple:
+    """Return the inode, size and modification time of a file, which change
+    whenever the file is replaced or written to.
+
+    :param file_path: The path to the file
+    """
+    stat: os.stat_result = os.stat(file_path)
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
 
 
 def read_file(file_path: str) -> str:
@@ -66,12 +255,201 @@ def read_file(file_path: str) -> str:
     return file_content
 
 
+# The engine that answers queries, its index or tables are built once here
+# and again by reload_corpus when the file changes.
+FILE_VERSION: tuple = file_signature(FILE_PATH)
+SEARCH: SearchEngine = create_engine(SEARCH_ENGINE, BLOOM_ERROR_RATE)
+
 # This will be the file's content when the server is ran for the first time.
-Initial_file_content: str = read_file(FILE_PATH)
+# Engines such as mmap never load the file into a string.
+Initial_file_content: str | None = None
+if SEARCH.needs_content:
+    Initial_file_content = read_file(FILE_PATH)
+
+    # Check to see the file is not empty
+    if Initial_file_content is None:
+        logging.error("File content not loaded!")
+
+if not REREAD_ON_QUERY:
+    SEARCH.prepare(FILE_PATH, Initial_file_content)
+
+# The engine and the version of the file it was prepared from. They are
+# swapped together in one assignment, so a query that read them keeps
+# using that engine even if a new one is swapped in meanwhile.
+live_search: tuple[SearchEngine, tuple] = (SEARCH, FILE_VERSION)
+reload_lock: threading.Lock = threading.Lock()
+
+# The raw bytes of the file for commands that scan it whatever the engine,
+# mapped by scan_corpus on the first such command. A mapped file that is
+# truncated in place kills the process with SIGBUS, so it is only mapped
+# when needed and the file must be replaced by a rename, see the docs.
+SCAN_CORPUS: MmapCorpus | None = None
+scan_corpus_lock: threading.Lock = threading.Lock()
+
+# Repeated queries are answered from here instead of scanning the file
+# again. An index lookup is as cheap as a cache lookup so index engines skip
+# it.
+QUERY_CACHE: QueryCache | None = None
+if CACHE_SIZE > 0 and SEARCH.scans:
+    QUERY_CACHE = QueryCache(CACHE_SIZE, CACHE_TTL)
+
+# Searches the lines of SCAN_CORPUS for the REGEX command.
+REGEX_SEARCHER: RegexSearcher = RegexSearcher(
+    REGEX_CACHE_SIZE, REGEX_TIMEOUT, FORMAT
+)
+
+# The shards searched by the MATCH and REGEX commands, if sharding is on.
+SHARDS: ShardedCorpus | None = None
+if SHARD_PROCESSES > 0:
+    SHARDS = ShardedCorpus(
+        SHARD_FILES or FILE_PATH, SHARD_SIZE, SHARD_PROCESSES, FORMAT
+    )
+
+# Rate limits and connection caps of each client address, if any is set.
+LIMITER: ClientLimiter | None = None
+if RATE_LIMIT > 0 or MAX_CONNECTIONS_PER_CLIENT > 0:
+    LIMITER = ClientLimiter(RATE_LIMIT, RATE_BURST, MAX_CONNECTIONS_PER_CLIENT)
+
+# The threaded engine's worker pool, set once the server is listening.
+worker_pool: WorkerPool | None = None
+# The pre-fork parent of this worker process, None when not pre-forked.
+supervisor_pid: int | None = None
+
+# The sorted lines of SCAN_CORPUS for the prefix and range commands, built
+# on the first such command and again when the file was mapped again.
+sorted_index: SortedLineIndex | None = None
+sorted_index_lock: threading.Lock = threading.Lock()
+
+# With REREAD_ON_QUERY each file gets a reloader that only prepares a new
+# engine when the file changed, and only reads the appended part when the
+# file grew and the engine supports it.
+reloaders: dict[str, FileReloader] = {}
+reloaders_lock: threading.Lock = threading.Lock()
+
+
+def get_reloader(file_path: str) -> FileReloader:
+    """Return the reloader for a file, creating it on first use
+
+    :param file_path: The path to the file to be watched
+    """
+    reloader: FileReloader | None = reloaders.get(file_path)
+    if reloader is None:
+        with reloaders_lock:
+            reloader = reloaders.setdefault(
+                file_path,
+                FileReloader(
+                    file_path,
+                    functools.partial(
+                        create_engine, SEARCH_ENGINE, BLOOM_ERROR_RATE
+                    ),
+                    encoding=FORMAT,
+                ),
+            )
+    return reloader
+
+
+def current_engine(file_path: str) -> tuple:
+    """Return the engine that answers queries and the version of the file
+    it was prepared from.
+
+    :param file_path: This is the path to the file to be searched
+    """
+    if not REREAD_ON_QUERY:
+        # We will use the file as last loaded by the server, through the
+        # engine chosen with [search] engine in config.ini.
+        return live_search
+    # Check the file on each query, it is only read again if it changed.
+    reloader: FileReloader = get_reloader(file_path).refresh()
+    # The version is read before the engine so a result is never cached
+    # under a newer version than the engine it came from.
+    version: tuple | None = reloader.version
+    return reloader.engine, version
+
+
+def reload_corpus(force: bool = False) -> bool:
+    """Load the file into a new engine and swap it in for the old one
+
+    The new engine is built in the calling thread while queries go on being
+    answered by the old one. Queries that already started finish on the old
+    engine, which is freed once the last of them is done.
 
-# Check to see the file is not empty
-if Initial_file_content is None:
-    logging.error("File content not loaded!")
+    :param force: Load the file even if it looks unchanged
+    :return: True if a new engine was swapped in
+    """
+    global SEARCH, FILE_VERSION, Initial_file_content, live_search
+    if REREAD_ON_QUERY:
+        # The reloader already loads the file whenever it changed.
+        reloader: FileReloader = get_reloader(FILE_PATH)
+        version: tuple | None = reloader.version
+        return reloader.refresh().version != version
+    with reload_lock:
+        # The version is read before the file so a change made while it is
+        # being read is loaded again by the next reload.
+        version: tuple = file_signature(FILE_PATH)
+        if version == live_search[1] and not force:
+            return False
+        started: float = time.perf_counter()
+        engine: SearchEngine = create_engine(SEARCH_ENGINE, BLOOM_ERROR_RATE)
+        content: str | None = None
+        if engine.needs_content:
+            content = read_file(FILE_PATH)
+        engine.prepare(FILE_PATH, content)
+        live_search = (engine, version)
+        SEARCH, FILE_VERSION, Initial_file_content = engine, version, content
+        if SCAN_CORPUS is not None:
+            SCAN_CORPUS.refresh()
+        if SHARDS is not None:
+            SHARDS.refresh()
+    METRICS.inc("reloads_total")
+    logging.info(
+        f"Reloaded {FILE_PATH} in {time.perf_counter() - started:.3f} s"
+    )
+    return True
+
+
+def reload_in_background(force: bool = False) -> None:
+    """Run reload_corpus in a new thread, logging any error, so the caller
+    is not held up while the file is loaded.
+
+    :param force: Load the file even if it looks unchanged
+    """
+
+    def reload() -> None:
+        try:
+            reload_corpus(force)
+        except Exception as e:
+            METRICS.inc("errors_total")
+            logging.error(f"Reloading {FILE_PATH} failed: {e}")
+
+    threading.Thread(target=reload, daemon=True).start()
+
+
+def watch_corpus() -> None:
+    """Check the file every WATCH_INTERVAL seconds and reload it when it
+    changed. It runs in its own thread for as long as the server does."""
+    while True:
+        time.sleep(WATCH_INTERVAL)
+        try:
+            reload_corpus()
+        except Exception as e:
+            # The file may be missing for a moment while it is replaced.
+            METRICS.inc("errors_total")
+            logging.error(f"Reloading {FILE_PATH} failed: {e}")
+
+
+def start_reload_triggers() -> None:
+    """Reload the file on SIGHUP, if it changed on SIGUSR1 and, with
+    WATCH_INTERVAL set, whenever it changes."""
+    # Signal handlers can only be set from the main thread.
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(
+            signal.SIGHUP, lambda signum, frame: reload_in_background(True)
+        )
+        signal.signal(
+            signal.SIGUSR1, lambda signum, frame: reload_in_background()
+        )
+    if WATCH_INTERVAL > 0:
+        threading.Thread(target=watch_corpus, daemon=True).start()
 
 
 def search_string(msg: str, file_path: str) -> bool:
@@ -81,39 +459,368 @@ def search_string(msg: str, file_path: str) -> bool:
     :param msg: This is the message to be searched for
     :param file_path: This is the path to the file to be searched
     """
-    start: float = time.perf_counter()  # Log when the function starts
-    print(f"search query: {msg}")
-    if not REREAD_ON_QUERY:
-        # We will use the file as read when the server was started.
-        # We can implement any of our imported search methods, I have gone with the default
-        # python file search algorithm because it's the fastest.
-        """
-        if kmp_search(Initial_file_content, msg) == -1:
-            Found = False
-        else:
-            Found = True
-        """
-        Found: bool = (
-            re.search(rf"^{msg}$", Initial_file_content, re.MULTILINE)
-            is not None
-        )
-        finish: float = (
-            time.perf_counter()
-        )  # Log when the function was finished
-        # Get the total time spent on the search
-        print(f"finished in {round(finish - start, 2)} second(s)")
-        return Found
+    sample: bool = METRICS.sampled()
+    start: float = time.perf_counter() if sample else 0.0
+    logging.debug("search query: %s", msg)
+    engine, version = current_engine(file_path)
+    Found: bool | None = None
+    if "\n" in msg:
+        # A line never holds a newline, engines that scan the file would
+        # match such a query across two lines.
+        Found = False
+    elif QUERY_CACHE is not None:
+        Found = QUERY_CACHE.get(msg, version)
+    if Found is None:
+        Found = engine.contains(msg)
+        if QUERY_CACHE is not None:
+            QUERY_CACHE.put(msg, Found, version)
+    METRICS.inc("queries_total")
+    METRICS.inc("hits_total" if Found else "misses_total")
+    if sample:
+        METRICS.observe("search", time.perf_counter() - start)
+    return Found
+
+
+def search_many(queries: list[str], file_path: str) -> list[bool]:
+    """This function searches for a batch of exact lines at once and returns
+    whether each of them was found. The file is checked or reread once for
+    the whole batch and engines that scan the file answer all of the queries
+    that are not cached in one pass where they can.
+
+    :param queries: These are the lines to be searched for
+    :param file_path: This is the path to the file to be searched
+    """
+    sample: bool = METRICS.sampled()
+    start: float = time.perf_counter() if sample else 0.0
+    logging.debug("batch search of %d queries", len(queries))
+    engine, version = current_engine(file_path)
+    if QUERY_CACHE is None:
+        found: list[bool | None] = engine.contains_many(queries)
     else:
-        file_content: str = read_file(file_path)  # Reload file on each query
-        if file_content is None:
-            logging.error("File content not loaded!")
-            return False
-        Found: bool = (
-            re.search(rf"^{msg}$", file_content, re.MULTILINE) is not None
+        found = [QUERY_CACHE.get(query, version) for query in queries]
+        misses: list[str] = list(
+            dict.fromkeys(
+                query for query, hit in zip(queries, found) if hit is None
+            )
         )
-        finish: float = time.perf_counter()
-        print(f"finished in {round(finish - start, 2)} second(s)")
-        return Found
+        if misses:
+            searched: dict[str, bool] = dict(
+                zip(misses, engine.contains_many(misses))
+            )
+            for query, result in searched.items():
+                QUERY_CACHE.put(query, result, version)
+            found = [
+                searched[query] if hit is None else hit
+                for query, hit in zip(queries, found)
+            ]
+    hits: int = sum(found)
+    METRICS.inc("queries_total", len(queries))
+    METRICS.inc("hits_total", hits)
+    METRICS.inc("misses_total", len(queries) - hits)
+    if sample:
+        METRICS.observe("search", time.perf_counter() - start)
+    return found
+
+
+def command_match(args: list[str], file_path: str) -> Iterator[bytes]:
+    """The MATCH command finds which of many patterns are in the file.
+
+    The first argument is the mode, "line" matches patterns against whole
+    lines and "substring" matches them anywhere. The other arguments are the
+    patterns. Each pattern that is found is sent back as soon as it is found.
+
+    :param args: The mode followed by the patterns
+    :param file_path: This is the path to the file to be searched
+    """
+    if not args or args[0] not in ("line", "substring"):
+        raise ValueError("MATCH needs a mode of line or substring")
+    mode, patterns = args[0], args[1:]
+    logging.debug("match %d patterns by %s", len(patterns), mode)
+    engine: SearchEngine = live_search[0]
+    if mode == "line" and not REREAD_ON_QUERY and not engine.scans:
+        # An index answers each pattern without scanning the file.
+        for pattern in dict.fromkeys(patterns):
+            if engine.contains(pattern):
+                yield pattern.encode(FORMAT)
+        return
+    if SHARDS is not None:
+        # Every shard is searched in parallel, the shards still waiting for
+        # a worker are cancelled once every pattern was found.
+        shards: ShardedCorpus = SHARDS.refresh() if REREAD_ON_QUERY else SHARDS
+        for pattern in shards.match(patterns, mode == "line"):
+            yield pattern.encode(FORMAT)
+        return
+    corpus: MmapCorpus = scan_corpus()
+    for pattern in match_patterns(
+        corpus.map, patterns, mode == "line", FORMAT
+    ):
+        yield pattern.encode(FORMAT)
+
+
+def scan_corpus() -> MmapCorpus:
+    """Return SCAN_CORPUS, mapping the file on the first call and again when
+    it changed if REREAD_ON_QUERY is set.
+    """
+    global SCAN_CORPUS
+    corpus: MmapCorpus | None = SCAN_CORPUS
+    if corpus is None:
+        with scan_corpus_lock:
+            if SCAN_CORPUS is None:
+                SCAN_CORPUS = MmapCorpus(FILE_PATH)
+            return SCAN_CORPUS
+    return corpus.refresh() if REREAD_ON_QUERY else corpus
+
+
+def get_sorted_index() -> SortedLineIndex:
+    """Return the sorted line index of the file, building it if the file is
+    new or changed.
+    """
+    global sorted_index
+    corpus: MmapCorpus = scan_corpus()
+    data = corpus.map
+    index: SortedLineIndex | None = sorted_index
+    if index is None or index.data is not data:
+        with sorted_index_lock:
+            index = sorted_index
+            if index is None or index.data is not data:
+                index = sorted_index = SortedLineIndex(data)
+    return index
+
+
+def command_prefix_exists(args: list[str], file_path: str) -> Iterator[bytes]:
+    """The PREFIX_EXISTS command sends back 1 if any line starts with the
+    prefix given as its argument and 0 otherwise.
+
+    :param args: The prefix
+    :param file_path: This is the path to the file to be searched
+    """
+    if len(args) != 1:
+        raise ValueError("PREFIX_EXISTS needs a prefix")
+    first, after = get_sorted_index().prefix_range(args[0].encode(FORMAT))
+    yield b"1" if after > first else b"0"
+
+
+def command_prefix_count(args: list[str], file_path: str) -> Iterator[bytes]:
+    """The PREFIX_COUNT command sends back how many lines start with the
+    prefix given as its argument.
+
+    :param args: The prefix
+    :param file_path: This is the path to the file to be searched
+    """
+    if len(args) != 1:
+        raise ValueError("PREFIX_COUNT needs a prefix")
+    first, after = get_sorted_index().prefix_range(args[0].encode(FORMAT))
+    yield str(after - first).encode(FORMAT)
+
+
+def command_range(args: list[str], file_path: str) -> Iterator[bytes]:
+    """The RANGE command sends back the lines from a first to a last line,
+    both included, in sorted order.
+
+    At most RANGE_LIMIT lines are sent at once, the optional offset and limit
+    arguments select the page. A page shorter than the limit is the last one.
+
+    :param args: The first and last lines, then the offset and the limit
+    :param file_path: This is the path to the file to be searched
+    """
+    if not 2 <= len(args) <= 4:
+        raise ValueError("RANGE needs a first and a last line")
+    offset: int = int(args[2]) if len(args) > 2 else 0
+    limit: int = (
+        min(int(args[3]), RANGE_LIMIT) if len(args) > 3 else RANGE_LIMIT
+    )
+    if offset < 0 or limit < 0:
+        raise ValueError("RANGE needs a positive offset and limit")
+    index: SortedLineIndex = get_sorted_index()
+    first, after = index.between(
+        args[0].encode(FORMAT), args[1].encode(FORMAT)
+    )
+    for position in range(first + offset, min(after, first + offset + limit)):
+        yield index.line(position)
+
+
+def command_regex(args: list[str], file_path: str) -> Iterator[bytes]:
+    """The REGEX command sends back the lines that a regular expression
+    matches. It is the only query that treats the client's text as a
+    pattern, exact queries are always literal.
+
+    Patterns that could backtrack exponentially are rejected and the search
+    stops with an error once it takes longer than REGEX_TIMEOUT. At most the
+    optional limit argument or RANGE_LIMIT lines are sent.
+
+    :param args: The pattern, then the limit
+    :param file_path: This is the path to the file to be searched
+    """
+    if not 1 <= len(args) <= 2:
+        raise ValueError("REGEX needs a pattern")
+    limit: int = (
+        min(int(args[1]), RANGE_LIMIT) if len(args) > 1 else RANGE_LIMIT
+    )
+    logging.debug("regex query: %s", args[0])
+    if SHARDS is not None:
+        shards: ShardedCorpus = SHARDS.refresh() if REREAD_ON_QUERY else SHARDS
+        yield from shards.regex(args[0], limit, REGEX_TIMEOUT)
+        return
+    corpus: MmapCorpus = scan_corpus()
+    yield from REGEX_SEARCHER.search_lines(corpus.map, args[0], limit)
+
+
+def command_reload(args: list[str], file_path: str) -> Iterator[bytes]:
+    """The RELOAD command loads the file again if it changed and sends back
+    1 once the new copy is answering queries, or 0 if nothing changed. In the
+    pre-fork mode the reply is about the worker that got the command, the
+    others reload in the background a moment later.
+
+    :param args: "force" to load the file even if it looks unchanged
+    :param file_path: This is the path to the file to be searched
+    """
+    if args not in ([], ["force"]):
+        raise ValueError("RELOAD takes no arguments or force")
+    reloaded: bool = reload_corpus(force=bool(args))
+    if supervisor_pid is not None:
+        # Only this worker got the command, the pre-fork parent passes the
+        # reload on to itself and every other worker.
+        os.kill(supervisor_pid, signal.SIGHUP if args else signal.SIGUSR1)
+    yield b"1" if reloaded else b"0"
+
+
+def render_metrics() -> str:
+    """Return the server's metrics in the Prometheus text format, with the
+    query cache and worker pool figures read at the time of the call."""
+    gauges: dict[str, float] = {}
+    if QUERY_CACHE is not None:
+        for name, value in QUERY_CACHE.stats().items():
+            gauges[f"cache_{name}"] = value
+    if worker_pool is not None:
+        for name, value in worker_pool.stats().items():
+            gauges[f"pool_{name}"] = value
+    if LIMITER is not None:
+        for name, value in LIMITER.stats().items():
+            gauges[f"limiter_{name}"] = value
+    return METRICS.render(gauges)
+
+
+def command_stats(args: list[str], file_path: str) -> Iterator[bytes]:
+    """The STATS command sends back the server's metrics as one item in the
+    Prometheus text format.
+
+    :param args: No arguments
+    :param file_path: This is the path to the file to be searched
+    """
+    yield render_metrics().encode(FORMAT)
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the metrics to Prometheus on METRICS_PORT."""
+
+    def do_GET(self) -> None:
+        body: bytes = render_metrics().encode(FORMAT)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        logging.debug(format, *args)
+
+
+def start_metrics_server() -> None:
+    """Serve the metrics page on METRICS_PORT from a background thread."""
+    metrics_server: http.server.ThreadingHTTPServer = (
+        http.server.ThreadingHTTPServer(
+            (LISTEN_IP, METRICS_PORT), MetricsHandler
+        )
+    )
+    threading.Thread(target=metrics_server.serve_forever, daemon=True).start()
+    logging.info(f"Metrics on http://{LISTEN_IP}:{METRICS_PORT}/metrics")
+
+
+# The commands version 2 clients can send with COMMAND_FLAG. Each one takes
+# its arguments and the file path and yields the items of its reply.
+COMMANDS: dict[str, Callable[[list[str], str], Iterator[bytes]]] = {
+    "MATCH": command_match,
+    "PREFIX_EXISTS": command_prefix_exists,
+    "PREFIX_COUNT": command_prefix_count,
+    "RANGE": command_range,
+    "REGEX": command_regex,
+    "RELOAD": command_reload,
+    "STATS": command_stats,
+}
+
+
+def run_command(payload: str, file_path: str) -> Iterator[bytes]:
+    """Run a command and yield the frames of its reply stream
+
+    The stream ends with a STREAM_END length. If the command fails the stream
+    ends with a STREAM_ERROR length followed by a frame with the error.
+
+    :param payload: The command name and its arguments separated by newlines
+    :param file_path: This is the path to the file to be searched
+    """
+    name, *args = payload.split("\n")
+    METRICS.inc("commands_total")
+    try:
+        if name not in COMMANDS:
+            raise ValueError(f"Unknown command {name!r}")
+        for item in COMMANDS[name](args, file_path):
+            yield encode_v2_frame(item)
+    except Exception as e:
+        METRICS.inc("errors_total")
+        yield V2_LENGTH.pack(STREAM_ERROR) + encode_v2_frame(
+            str(e).encode(FORMAT)
+        )
+        return
+    yield V2_LENGTH.pack(STREAM_END)
+
+
+def client_address(client_socket: socket) -> str:
+    """Return the address of the client a socket is connected to, rate
+    limits and connection caps are kept per address.
+
+    :param client_socket: the socket of the client
+    """
+    try:
+        peer = client_socket.getpeername()
+    except OSError:
+        return ""
+    return peer[0] if isinstance(peer, tuple) else str(peer)
+
+
+def throttled(address: str, cost: int) -> bool:
+    """Return True if the client sent too many queries and counts it
+
+    :param address: the address of the client
+    :param cost: the number of queries in the message
+    """
+    if LIMITER is None or LIMITER.allow(address, cost):
+        return False
+    METRICS.inc("throttled_total")
+    return True
+
+
+def send_reply(client_socket: socket, data: bytes, sample: bool) -> None:
+    """Send data to the client, timing it as the send stage if sampled
+
+    :param client_socket: the socket of the client
+    :param data: the bytes to send
+    :param sample: whether this request is timed
+    """
+    start: float = time.perf_counter() if sample else 0.0
+    # A client that does not read its replies is dropped after READ_TIMEOUT,
+    # sendall counts the timeout for the whole reply.
+    client_socket.settimeout(READ_TIMEOUT or None)
+    client_socket.sendall(data)
+    if sample:
+        METRICS.observe("send", time.perf_counter() - start)
+
+
+def deadline(timeout: float) -> float | None:
+    """Return the time.monotonic() a timeout from now ends, None for 0
+
+    :param timeout: the timeout in seconds, 0 waits forever
+    """
+    return time.monotonic() + timeout if timeout else None
 
 
 def handle_client(client_socket: socket) -> None:
@@ -121,62 +828,512 @@ def handle_client(client_socket: socket) -> None:
 
     :param client_socket: this is the socket that has requested to connect
     """
+    METRICS.inc("connections_total")
+    address: str = client_address(client_socket)
+    if LIMITER is not None and not LIMITER.connect(address):
+        # The client has too many connections open, its protocol version is
+        # not known yet so it gets the version 1 reply.
+        METRICS.inc("throttled_total")
+        try:
+            client_socket.sendall(V1_THROTTLED)
+        except OSError:
+            pass
+        finally:
+            client_socket.close()
+        return
+    METRICS.add("connections_active", 1)
     try:
-        # Receive data from client in the required format and size in bytes
+        # Receive data from client in the required format and size in bytes.
+        # The reader returns whole frames however TCP splits or joins them.
+        reader: FrameReader = FrameReader(client_socket)
+        # Clients that speak protocol version 2 send V2_MAGIC first, they use
+        # a 4 byte length prefix and get a 1 byte status back.
+        # Slow or silent clients are dropped instead of holding a worker: the
+        # first byte of each message must arrive within IDLE_TIMEOUT and the
+        # rest of it within READ_TIMEOUT of that byte.
+        version2: bool = reader.peek(1, deadline(IDLE_TIMEOUT)) == V2_MAGIC
+        if version2:
+            reader.read_exactly(1)
+        replies: dict[bool, bytes] = V2_REPLIES if version2 else V1_REPLIES
+        # Replies to pipelined queries are sent together once every query
+        # that already arrived has been answered.
+        pending: bytearray = bytearray()
         connected: bool = True
         while connected:
-            msg_length: int = (
-                client_socket.recv(HEADER).decode(FORMAT).rstrip("\x00")
-            )
-            if msg_length:
-                msg_length = int(msg_length)
-                data: str = (
-                    client_socket.recv(msg_length)
-                    .decode(FORMAT)
-                    .rstrip("\x00")
+            header: memoryview | None = None
+            if reader.peek(1, deadline(IDLE_TIMEOUT)) is not None:
+                read_by: float | None = deadline(READ_TIMEOUT)
+                header = reader.read_exactly(
+                    V2_LENGTH.size if version2 else HEADER, read_by
                 )
-                if data == DISCONNECT_MESSAGE:
+            if header is None:
+                # The client closed the connection.
+                connected = False
+            else:
+                # The recv stage runs from the header to the whole message,
+                # the time waiting for the client to send it is not counted.
+                sample: bool = METRICS.sampled()
+                received: float = time.perf_counter() if sample else 0.0
+                batch: bool = False
+                command: bool = False
+                if version2:
+                    msg_length: int = V2_LENGTH.unpack(header)[0]
+                    batch = bool(msg_length & BATCH_FLAG)
+                    command = bool(msg_length & COMMAND_FLAG)
+                    msg_length &= LENGTH_MASK
+                else:
+                    msg_length: int = int(str(header, FORMAT).rstrip("\x00"))
+                check_frame_length(msg_length, MAX_FRAME_SIZE)
+                message: memoryview | None = reader.read_exactly(
+                    msg_length, read_by
+                )
+                if sample:
+                    parsed: float = time.perf_counter()
+                    METRICS.observe("recv", parsed - received)
+                data: str = str(message, FORMAT).rstrip("\x00")
+                if sample:
+                    METRICS.observe("parse", time.perf_counter() - parsed)
+                if (command or batch or data != DISCONNECT_MESSAGE) and (
+                    throttled(address, data.count("\n") + 1 if batch else 1)
+                ):
+                    # Throttled clients get a short reply and no search.
+                    pending += encode_throttled_reply(
+                        version2,
+                        data.count("\n") + 1 if batch else None,
+                        command,
+                    )
+                elif command:
+                    # Stream the reply back as it is produced.
+                    if pending:
+                        send_reply(client_socket, pending, sample)
+                        pending.clear()
+                    for frame in run_command(data, FILE_PATH):
+                        send_reply(client_socket, frame, sample)
+                elif batch:
+                    # Answer the whole batch in one pass.
+                    pending += encode_batch_reply(
+                        search_many(data.split("\n"), FILE_PATH)
+                    )
+                elif data == DISCONNECT_MESSAGE:
                     connected = False
                 else:
                     # Use the search method defined to search for the pattern
                     found: bool = search_string(data, FILE_PATH)
-                    if found:
-                        # Send message if the string is found.
-                        client_socket.send(b"STRING EXISTS\n")
-                    else:
-                        # Send message if the string is not found.
-                        client_socket.send(b"STRING NOT FOUND\n")
+                    # Send STRING EXISTS or STRING NOT FOUND, or the status
+                    # byte for version 2.
+                    pending += replies[found]
+                if pending and not reader.buffered():
+                    send_reply(client_socket, pending, sample)
+                    pending.clear()
+
+    except TimeoutError:
+        METRICS.inc("timeouts_total")
+        logging.debug("Connection from %s timed out", address)
+
+    except FrameTooLarge as e:
+        METRICS.inc("oversized_frames_total")
+        logging.warning(f"Closing connection from {address}: {e}")
 
     except Exception as e:
         # Raise an exceotion if an error such as a disconnection occurs.
-        print(f"Exception occurred: {e}")
+        METRICS.inc("errors_total")
+        logging.error(f"Exception occurred: {e}")
 
     finally:
+        METRICS.add("connections_active", -1)
+        if LIMITER is not None:
+            LIMITER.disconnect(address)
         client_socket.close()
 
 
-def main() -> None:
-    """Main server loop"""
+def handle_client_tls(client_socket: socket) -> None:
+    """Function to handle client requests over TLS. The handshake is done
+    here, in a worker thread, so a slow client does not hold up the accept
+    loop.
+
+    :param client_socket: this is the socket that has requested to connect
+    """
+    start: float = time.perf_counter()
+    try:
+        client_socket.settimeout(HANDSHAKE_TIMEOUT)
+        # The session tickets are sent in their own packet after the
+        # handshake, without TCP_NODELAY the first reply would wait for the
+        # client to acknowledge them.
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # The handshake happens in wrap_socket as the socket is connected.
+        tls_socket: ssl.SSLSocket = context.wrap_socket(
+            client_socket, server_side=True
+        )
+        tls_socket.settimeout(None)
+    except (OSError, ValueError) as e:
+        METRICS.inc("handshake_errors_total")
+        logging.debug("TLS handshake failed: %s", e)
+        client_socket.close()
+        return
+    METRICS.inc(
+        "handshakes_resumed_total"
+        if tls_socket.session_reused
+        else "handshakes_full_total"
+    )
+    METRICS.observe("handshake", time.perf_counter() - start)
+    handle_client(tls_socket)
+
+
+async def send_reply_async(
+    writer: asyncio.StreamWriter, data: bytes, sample: bool
+) -> None:
+    """Write data to the client, timing it as the send stage if sampled
+
+    :param writer: the stream the responses are written to
+    :param data: the bytes to send
+    :param sample: whether this request is timed
+    """
+    start: float = time.perf_counter() if sample else 0.0
+    writer.write(data)
+    if writer.transport.get_write_buffer_size():
+        # A client that does not read its replies is dropped after
+        # READ_TIMEOUT, like in handle_client.
+        await asyncio.wait_for(writer.drain(), READ_TIMEOUT or None)
+    if sample:
+        METRICS.observe("send", time.perf_counter() - start)
+
+
+async def handle_client_async(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+) -> None:
+    """Function to handle client requests on the asyncio engine. It speaks the
+    same protocol as handle_client.
+
+    :param reader: the stream the client's messages are read from
+    :param writer: the stream the responses are written to
+    """
+    loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+    # Lookups in an index are fast enough to run on the event loop, anything
+    # that scans or rereads the file is moved to the executor.
+    offload: bool = REREAD_ON_QUERY or SEARCH.scans
+    METRICS.inc("connections_total")
+    address: str = str((writer.get_extra_info("peername") or ("",))[0])
+    if LIMITER is not None and not LIMITER.connect(address):
+        METRICS.inc("throttled_total")
+        writer.write(V1_THROTTLED)
+        writer.close()
+        return
+    METRICS.add("connections_active", 1)
+    # Slow or silent clients are dropped when this timer fires, which makes
+    # the read that waits for them fail.
+    timer: asyncio.TimerHandle | None = None
+
+    def drop() -> None:
+        METRICS.inc("timeouts_total")
+        logging.debug("Connection from %s timed out", address)
+        writer.transport.abort()
+
+    def arm(timeout: float) -> None:
+        nonlocal timer
+        if timer is not None:
+            timer.cancel()
+        timer = loop.call_later(timeout, drop) if timeout else None
+
+    try:
+        # The first byte of each message must arrive within IDLE_TIMEOUT and
+        # the rest of it within READ_TIMEOUT of that byte.
+        arm(IDLE_TIMEOUT)
+        first: bytes = await reader.readexactly(1)
+        version2: bool = first == V2_MAGIC
+        replies: dict[bool, bytes] = V2_REPLIES if version2 else V1_REPLIES
+        if version2:
+            first = b""
+        while True:
+            if not first:
+                arm(IDLE_TIMEOUT)
+                first = await reader.readexactly(1)
+            arm(READ_TIMEOUT)
+            batch: bool = False
+            command: bool = False
+            header: bytes = first + await reader.readexactly(
+                (V2_LENGTH.size if version2 else HEADER) - len(first)
+            )
+            first = b""
+            if version2:
+                msg_length: int = V2_LENGTH.unpack(header)[0]
+                batch = bool(msg_length & BATCH_FLAG)
+                command = bool(msg_length & COMMAND_FLAG)
+                msg_length &= LENGTH_MASK
+            else:
+                msg_length: int = int(header.decode(FORMAT).rstrip("\x00"))
+            check_frame_length(msg_length, MAX_FRAME_SIZE)
+            sample: bool = METRICS.sampled()
+            received: float = time.perf_counter() if sample else 0.0
+            message: bytes = await reader.readexactly(msg_length)
+            arm(0)
+            if sample:
+                parsed: float = time.perf_counter()
+                METRICS.observe("recv", parsed - received)
+            data: str = message.decode(FORMAT).rstrip("\x00")
+            if sample:
+                METRICS.observe("parse", time.perf_counter() - parsed)
+            if (command or batch or data != DISCONNECT_MESSAGE) and (
+                throttled(address, data.count("\n") + 1 if batch else 1)
+            ):
+                # Throttled clients get a short reply and no search.
+                await send_reply_async(
+                    writer,
+                    encode_throttled_reply(
+                        version2,
+                        data.count("\n") + 1 if batch else None,
+                        command,
+                    ),
+                    sample,
+                )
+                continue
+            if command:
+                # Each frame of the reply is produced in the executor and
+                # written as soon as it is ready.
+                frames: Iterator[bytes] = run_command(data, FILE_PATH)
+                while True:
+                    frame: bytes | None = await loop.run_in_executor(
+                        None, next, frames, None
+                    )
+                    if frame is None:
+                        break
+                    await send_reply_async(writer, frame, sample)
+                continue
+            if batch:
+                await send_reply_async(
+                    writer,
+                    encode_batch_reply(
+                        await loop.run_in_executor(
+                            None, search_many, data.split("\n"), FILE_PATH
+                        )
+                    ),
+                    sample,
+                )
+                continue
+            if data == DISCONNECT_MESSAGE:
+                break
+            if offload:
+                found: bool = await loop.run_in_executor(
+                    None, search_string, data, FILE_PATH
+                )
+            else:
+                found: bool = search_string(data, FILE_PATH)
+            await send_reply_async(writer, replies[found], sample)
+
+    except asyncio.IncompleteReadError:
+        # The client closed the connection.
+        pass
+    except asyncio.TimeoutError:
+        METRICS.inc("timeouts_total")
+        logging.debug("Connection from %s timed out", address)
+    except FrameTooLarge as e:
+        METRICS.inc("oversized_frames_total")
+        logging.warning(f"Closing connection from {address}: {e}")
+    except Exception as e:
+        METRICS.inc("errors_total")
+        logging.error(f"Exception occurred: {e}")
+
+    finally:
+        arm(0)
+        METRICS.add("connections_active", -1)
+        if LIMITER is not None:
+            LIMITER.disconnect(address)
+        writer.close()
+
+
+async def main_async(reuse_port: bool = False) -> None:
+    """Main server loop for the asyncio engine
+
+    :param reuse_port: bind with SO_REUSEPORT so other processes can share PORT
+    """
+    # The SSL context is handed to asyncio which performs the handshake on
+    # each accepted connection without blocking the event loop.
+    server: asyncio.Server = await asyncio.start_server(
+        handle_client_async,
+        LISTEN_IP,
+        PORT,
+        ssl=context,
+        ssl_handshake_timeout=HANDSHAKE_TIMEOUT if context else None,
+        reuse_port=reuse_port or None,
+    )
+    logging.info(f"Server listening on {LISTEN_IP}:{PORT}")
+    async with server:
+        await server.serve_forever()
+
+
+def main_prefork() -> None:
+    """Start PROCESSES worker processes that each run the server loop.
+
+    The file is loaded before forking, so every worker shares the parent's
+    copy of the content and line index through copy-on-write pages instead of
+    reading its own. The kernel spreads new connections over the workers
+    because each one binds PORT with SO_REUSEPORT.
+    """
+    # Move everything loaded so far out of the garbage collector's reach so
+    # collections in the workers do not write to, and so copy, shared pages.
+    gc.freeze()
+    # Worker pid -> time it was started.
+    workers: dict[int, float] = {}
+
+    # Reloads asked for by SIGHUP (forced) and SIGUSR1, the loop below runs
+    # them since a handler that interrupted a reload could not take its lock.
+    reload_requests: list[bool] = []
+
+    def start_worker() -> None:
+        global supervisor_pid
+        pid: int = os.fork()
+        if pid == 0:
+            # Workers go back to the default handlers the parent replaced.
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGHUP, signal.SIG_DFL)
+            signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+            supervisor_pid = os.getppid()
+            try:
+                main(reuse_port=True)
+            finally:
+                os._exit(1)
+        workers[pid] = time.monotonic()
+
+    def request_reload(signum: int, frame) -> None:
+        reload_requests.append(signum == signal.SIGHUP)
+
+    def reload_parent(force: bool) -> None:
+        # Workers are forked with the parent's copy of the file, so it is
+        # kept as new as theirs.
+        try:
+            reload_corpus(force)
+        except Exception as e:
+            METRICS.inc("errors_total")
+            logging.error(f"Reloading {FILE_PATH} failed: {e}")
+
+    def reload_workers() -> None:
+        force: bool = False
+        while reload_requests:
+            force |= reload_requests.pop()
+        reload_parent(force)
+        # Each worker has its own copy of the file to reload.
+        for pid in workers:
+            os.kill(pid, signal.SIGHUP if force else signal.SIGUSR1)
+
+    def stop_workers(signum: int, frame) -> None:
+        for pid in workers:
+            os.kill(pid, signal.SIGTERM)
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, stop_workers)
+    signal.signal(signal.SIGINT, stop_workers)
+    signal.signal(signal.SIGHUP, request_reload)
+    signal.signal(signal.SIGUSR1, request_reload)
+    if METRICS_PORT:
+        # Each worker counts only its own connections and they can not all
+        # bind one port, so the page is not served. STATS still works.
+        logging.warning("metrics_port is ignored when processes > 1")
+    for _ in range(PROCESSES):
+        start_worker()
+    logging.info(f"Started {PROCESSES} worker processes on {LISTEN_IP}:{PORT}")
+
+    # Replace any worker that dies so the server keeps its capacity, but back
+    # off when workers die right after starting, a broken config or port
+    # would otherwise have the parent fork as fast as it can.
+    quick_exits: int = 0
+    # Workers waiting to be restarted and when. Exits are still reaped while
+    # waiting so each one is timed when it happens, not after the backoff.
+    restarts: int = 0
+    restart_at: float = 0.0
+    while True:
+        if reload_requests:
+            reload_workers()
+        if restarts and time.monotonic() >= restart_at:
+            # A worker's watcher may have loaded a newer file than the
+            # parent's, which the new workers should start with.
+            reload_parent(False)
+            for _ in range(restarts):
+                start_worker()
+            restarts = 0
+        pid, status = os.waitpid(-1, os.WNOHANG) if workers else (0, 0)
+        if not pid:
+            wait: float = SUPERVISOR_TICK
+            if restarts:
+                wait = min(wait, max(restart_at - time.monotonic(), 0.0))
+            time.sleep(wait)
+            continue
+        started: float | None = workers.pop(pid, None)
+        if started is None:
+            continue
+        if time.monotonic() - started < WORKER_MIN_UPTIME:
+            quick_exits += 1
+        else:
+            quick_exits = 0
+        if quick_exits > MAX_QUICK_RESTARTS:
+            logging.critical(
+                f"Worker {pid} exited with status {status}, workers exited "
+                f"{quick_exits} times in a row right after starting, stopping"
+            )
+            for worker in workers:
+                os.kill(worker, signal.SIGTERM)
+            raise SystemExit(1)
+        delay: float = (
+            min(
+                WORKER_MIN_BACKOFF * 2 ** (quick_exits - 1), WORKER_MAX_BACKOFF
+            )
+            if quick_exits
+            else 0.0
+        )
+        logging.error(
+            f"Worker {pid} exited with status {status}, restarting in "
+            f"{delay:.1f} seconds"
+        )
+        restarts += 1
+        restart_at = max(restart_at, time.monotonic() + delay)
+
+
+def main(reuse_port: bool = False) -> None:
+    """Main server loop
+
+    :param reuse_port: bind with SO_REUSEPORT so other processes can share PORT
+    """
+    global worker_pool
+    if PROCESSES > 1 and not reuse_port:
+        main_prefork()
+        return
+    if SHARDS is not None:
+        # Fork the shard workers before any thread is started.
+        SHARDS.start()
+    if METRICS_PORT and not reuse_port:
+        start_metrics_server()
+    start_reload_triggers()
+    if SERVER_ENGINE == "asyncio":
+        asyncio.run(main_async(reuse_port))
+        return
+
     # Set up server socket.
     server_socket: socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # Allow a restarted server to bind while old connections are in TIME_WAIT.
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     server_socket.bind((LISTEN_IP, PORT))
-    server_socket.listen()
-    if SSL_ENABLED:
-        # The wrap_socket wrapper encrypts and decrypts the data going over
-        # the soxket with SSL.
-        server_socket = context.wrap_socket(client_socket, server_side=True)
+    server_socket.listen(LISTEN_BACKLOG)
+
+    logging.info(f"Server listening on {LISTEN_IP}:{PORT}")
 
-    print(f"Server listening on {LISTEN_IP}:{PORT}")
+    # With SSL each accepted socket is wrapped by the worker that serves it,
+    # the wrapper encrypts and decrypts the data going over the socket.
+    worker_pool = WorkerPool(
+        handle_client_tls if SSL_ENABLED else handle_client,
+        WORKERS,
+        QUEUE_DEPTH,
+        reject_when_full=BUSY_POLICY == "reject",
+        # The handshake has not happened yet when a connection is rejected,
+        # so a TLS client would get the reply in cleartext and fail on it.
+        busy_reply=b"" if SSL_ENABLED else BUSY_MESSAGE,
+    )
 
-    # Accept incoming connections and spawn threads.
+    # Accept incoming connections and hand them to the worker pool.
     while True:
         client_socket, addr = server_socket.accept()
-        print("[DEBUG]")
-        print(f"Connection from {addr[0]}:{addr[1]}")
-        client_thread: threading = threading.Thread(
-            target=handle_client, args=(client_socket,)
-        )
-        client_thread.start()
+        logging.debug("Connection from %s:%s", *addr)
+        worker_pool.submit(client_socket)
 
 
 if __name__ == "__main__":
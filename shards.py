@@ -0,0 +1,257 @@
+import glob
+import mmap
+import multiprocessing
+import os
+import threading
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    wait,
+)
+from typing import Iterator
+
+from regexsearch import RegexSearcher, check_pattern
+from searchengines import match_patterns
+
+# Maps of the files opened by this worker process, by path.
+_maps: dict[str, tuple] = {}
+# The RegexSearcher of this worker process, made on its first REGEX search.
+_searcher: RegexSearcher | None = None
+
+
+def expand_paths(spec: str) -> list[str]:
+    """Turn a comma separated list of files and glob patterns into paths
+
+    :param spec: The files, e.g. "corpus/*.txt,extra.txt"
+    :raises FileNotFoundError: If nothing matches
+    """
+    paths: list[str] = []
+    for part in spec.split(","):
+        part = part.strip()
+        if part:
+            paths.extend(
+                sorted(glob.glob(part)) if glob.has_magic(part) else [part]
+            )
+    if not paths:
+        raise FileNotFoundError(f"No files match {spec!r}")
+    return list(dict.fromkeys(paths))
+
+
+def _signature(path: str) -> tuple:
+    """Return the inode, size and modification time of a file."""
+    stat: os.stat_result = os.stat(path)
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def plan_shards(paths: list[str], shard_size: int) -> list[tuple]:
+    """Split files into shards of about shard_size bytes
+
+    Shards end just after a newline so no line is split between two shards.
+
+    :param paths: The files being searched
+    :param shard_size: The size of a shard in bytes
+    :return: (path, signature, start, end) for every shard
+    """
+    shards: list[tuple] = []
+    for path in paths:
+        signature: tuple = _signature(path)
+        data = _open(path, signature)
+        start: int = 0
+        while True:
+            end: int = data.find(b"\n", start + shard_size)
+            if end == -1:
+                shards.append((path, signature, start, len(data)))
+                break
+            shards.append((path, signature, start, end + 1))
+            start = end + 1
+    return shards
+
+
+def _open(path: str, signature: tuple):
+    """Return the map of a file, mapping it again if it changed."""
+    cached: tuple | None = _maps.get(path)
+    if cached is None or cached[0] != signature:
+        with open(path, "rb") as file:
+            # An empty file can not be mapped.
+            data = (
+                mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                if os.fstat(file.fileno()).st_size
+                else b""
+            )
+        cached = _maps[path] = (signature, data)
+    return cached[1]
+
+
+def _shard_range(shard: tuple) -> tuple:
+    """Return the map of a shard's file and where the shard starts and
+    stops, leaving out the newline that ends it unless it ends the file."""
+    path, signature, start, end = shard
+    data = _open(path, signature)
+    if end < len(data):
+        end -= 1
+    return data, start, end
+
+
+def _match_shard(
+    shard: tuple, patterns: list[str], whole_lines: bool, encoding: str
+) -> list[str]:
+    """Return the patterns found in one shard, run in a worker process."""
+    data, start, stop = _shard_range(shard)
+    return list(
+        match_patterns(
+            memoryview(data)[start:stop], patterns, whole_lines, encoding
+        )
+    )
+
+
+def _regex_shard(
+    shard: tuple, pattern: str, limit: int, time_budget: float, encoding: str
+) -> list[bytes]:
+    """Return the lines of one shard a pattern matches, run in a worker
+    process."""
+    global _searcher
+    if _searcher is None or _searcher.time_budget != time_budget:
+        _searcher = RegexSearcher(time_budget=time_budget, encoding=encoding)
+    data, start, stop = _shard_range(shard)
+    return list(_searcher.search_lines(data, pattern, limit, start, stop))
+
+
+class ShardedCorpus:
+    """One or more files split into shards that are searched in parallel.
+
+    Large files are cut into shards on line boundaries so every core can
+    search a part of them. Shards are searched by a pool of worker processes
+    and their results are merged. Once a search has its answer, the shards
+    still waiting for a worker are cancelled, shards already being searched
+    run to the end.
+    """
+
+    def __init__(
+        self,
+        spec: str,
+        shard_size: int = 64 << 20,
+        processes: int | None = None,
+        encoding: str = "utf-8",
+    ):
+        """
+        :param spec: A comma separated list of files and glob patterns
+        :param shard_size: The size of a shard in bytes
+        :param processes: The number of worker processes, defaults to the
+        number of cores
+        :param encoding: The encoding of the files
+        """
+        self.spec: str = spec
+        self.shard_size: int = shard_size
+        self.processes: int = processes or os.cpu_count() or 1
+        self.encoding: str = encoding
+        self.shards: list[tuple] = []
+        self._signatures: list[tuple] | None = None
+        self._pool: ProcessPoolExecutor | None = None
+        self._lock: threading.Lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self) -> "ShardedCorpus":
+        """Split the files into shards again if any of them changed or the
+        glob patterns match other files.
+
+        :return: The corpus itself
+        """
+        paths: list[str] = expand_paths(self.spec)
+        signatures: list[tuple] = [(path, _signature(path)) for path in paths]
+        if signatures != self._signatures:
+            with self._lock:
+                if signatures != self._signatures:
+                    self.shards = plan_shards(paths, self.shard_size)
+                    self._signatures = signatures
+        return self
+
+    def match(self, patterns: list[str], whole_lines: bool) -> Iterator[str]:
+        """Yield each pattern the first time any shard finds it, see
+        match_patterns
+
+        :param patterns: The patterns being searched for
+        :param whole_lines: Only match patterns that are a whole line
+        """
+        wanted: set[str] = set(patterns)
+        futures: list[Future] = [
+            self.pool.submit(
+                _match_shard, shard, patterns, whole_lines, self.encoding
+            )
+            for shard in self.shards
+        ]
+        try:
+            pending: set[Future] = set(futures)
+            while pending and wanted:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    for pattern in future.result():
+                        if pattern in wanted:
+                            wanted.discard(pattern)
+                            yield pattern
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def regex(
+        self, pattern: str, limit: int, time_budget: float
+    ) -> Iterator[bytes]:
+        """Yield up to limit lines a pattern matches, in file order
+
+        :param pattern: The regular expression, see RegexSearcher
+        :param limit: The most lines to yield
+        :param time_budget: The most seconds the search of one shard may take
+        """
+        # Bad patterns are rejected here before any worker is asked.
+        check_pattern(pattern)
+        if limit <= 0:
+            return
+        futures: list[Future] = [
+            self.pool.submit(
+                _regex_shard,
+                shard,
+                pattern,
+                limit,
+                time_budget,
+                self.encoding,
+            )
+            for shard in self.shards
+        ]
+        try:
+            for future in futures:
+                for line in future.result():
+                    yield line
+                    limit -= 1
+                    if not limit:
+                        return
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def start(self) -> None:
+        """Start the worker processes now.
+
+        The workers are forked from the server, so they should be started
+        before the server starts its own threads.
+        """
+        self.pool.submit(os.getpid).result()
+
+    @property
+    def pool(self) -> ProcessPoolExecutor:
+        """The worker processes, started on first use."""
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    # Forked workers share the server's modules instead of
+                    # importing the server again as spawned ones would.
+                    self._pool = ProcessPoolExecutor(
+                        self.processes,
+                        mp_context=multiprocessing.get_context("fork"),
+                    )
+        return self._pool
+
+    def close(self) -> None:
+        """Stop the worker processes."""
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
@@ -0,0 +1,89 @@
+from array import array
+from bisect import bisect_left, bisect_right
+
+
+class SortedLineIndex:
+    """The lines of a file in sorted order, kept as offsets into its bytes.
+
+    Only the start (8 bytes) and length (4 bytes) of each line are stored, so
+    the index costs 12 bytes a line however long the lines are and no string
+    is kept per line. Prefix and range lookups are binary searches over the
+    offsets that slice the file's bytes as they compare, so they take
+    logarithmic time.
+    """
+
+    def __init__(self, data):
+        """
+        :param data: The raw bytes of the file, e.g. an mmap
+        """
+        self.data = data
+        starts: array = array("Q")
+        start: int = 0
+        end: int = data.find(b"\n")
+        while end != -1:
+            starts.append(start)
+            start = end + 1
+            end = data.find(b"\n", start)
+        # The text after the last newline is a line unless it is empty.
+        if start < len(data):
+            starts.append(start)
+        # Each line ends one byte before the next starts. The last one ends
+        # at its newline or, without one, at the end of the data.
+        ends: array = array("Q", starts[1:])
+        ends.append(len(data) + 1 if start < len(data) else len(data))
+        order: list[int] = sorted(
+            range(len(starts)),
+            key=lambda i: data[starts[i] : ends[i] - 1],
+        )
+        self.starts: array = array("Q", (starts[i] for i in order))
+        # Lengths fit in 4 bytes unless a line is 4 GiB or longer.
+        try:
+            self.lengths: array = array(
+                "I", (ends[i] - 1 - starts[i] for i in order)
+            )
+        except OverflowError:
+            self.lengths = array("Q", (ends[i] - 1 - starts[i] for i in order))
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def line(self, position: int) -> bytes:
+        """Return the line at a position in sorted order
+
+        :param position: The position of the line
+        """
+        start: int = self.starts[position]
+        return self.data[start : start + self.lengths[position]]
+
+    def prefix_range(self, prefix: bytes) -> tuple[int, int]:
+        """Return the positions of the lines that start with a prefix
+
+        :param prefix: The start of the lines
+        :return: The first position and the position after the last one
+        """
+        size: int = len(prefix)
+
+        def head(position: int) -> bytes:
+            start: int = self.starts[position]
+            return self.data[start : start + min(size, self.lengths[position])]
+
+        # Cutting every line to the length of the prefix keeps them sorted.
+        positions: range = range(len(self))
+        return (
+            bisect_left(positions, prefix, key=head),
+            bisect_right(positions, prefix, key=head),
+        )
+
+    def between(self, first: bytes, last: bytes) -> tuple[int, int]:
+        """Return the positions of the lines from first to last, both
+        included
+
+        :param first: The smallest line
+        :param last: The largest line
+        :return: The first position and the position after the last one
+        """
+        positions: range = range(len(self))
+        return (
+            bisect_left(positions, first, key=self.line),
+            bisect_right(positions, last, key=self.line),
+        )
@@ -0,0 +1,50 @@
+import admission
+from admission import ClientLimiter
+
+
+def test_bucket_refills_at_rate(monkeypatch):
+    """A client should get burst queries at once and rate more a second"""
+    now = [0.0]
+    monkeypatch.setattr(admission.time, "monotonic", lambda: now[0])
+    limiter = ClientLimiter(rate=10, burst=3, max_connections=0)
+    assert [limiter.allow("a") for _ in range(4)] == [True] * 3 + [False]
+    # Other clients have their own bucket.
+    assert limiter.allow("b")
+    now[0] = 0.1
+    assert limiter.allow("a")
+    assert not limiter.allow("a")
+
+
+def test_batch_takes_bucket_below_zero(monkeypatch):
+    """A large batch should be allowed once and then paid back"""
+    now = [0.0]
+    monkeypatch.setattr(admission.time, "monotonic", lambda: now[0])
+    limiter = ClientLimiter(rate=10, burst=5, max_connections=0)
+    assert limiter.allow("a", 25)
+    now[0] = 2.0
+    assert not limiter.allow("a")
+    now[0] = 2.1
+    assert limiter.allow("a")
+
+
+def test_connection_cap():
+    """Connections over the cap should be refused until one closes"""
+    limiter = ClientLimiter(rate=0, burst=0, max_connections=2)
+    assert limiter.connect("a") and limiter.connect("a")
+    assert not limiter.connect("a")
+    assert limiter.connect("b")
+    limiter.disconnect("a")
+    assert limiter.connect("a")
+    assert limiter.stats()["connected_clients"] == 2
+
+
+def test_idle_buckets_are_pruned(monkeypatch):
+    """Buckets that filled up again should be dropped when there are many"""
+    now = [0.0]
+    monkeypatch.setattr(admission.time, "monotonic", lambda: now[0])
+    limiter = ClientLimiter(rate=1, burst=1, max_connections=0, max_clients=2)
+    limiter.allow("a")
+    limiter.allow("b")
+    now[0] = 10.0
+    limiter.allow("c")
+    assert limiter.stats()["clients"] == 1
@@ -0,0 +1,41 @@
+import pytest
+
+from benchmark import main, percentile
+
+
+def test_percentile():
+    """Percentiles should use the nearest rank"""
+    values = [float(i) for i in range(1, 101)]
+    assert percentile(values, 0.5) == 50
+    assert percentile(values, 0.99) == 99
+    assert percentile([3.0], 0.95) == 3
+    assert percentile([], 0.5) is None
+
+
+@pytest.mark.parametrize("qps", ["0", "100"])
+def test_benchmark_run(qps: str):
+    """A short run should start the server and report its results"""
+    (result,) = main(
+        ["--rows", "1000", "--clients", "2", "--duration", "0.5"]
+        + ["--qps", qps]
+    )
+    assert result["rows"] == 1000
+    assert result["queries"] > 0
+    assert result["errors"] == 0
+    latency = result["latency_ms"]
+    assert latency["p50"] <= latency["p95"] <= latency["p99"]
+
+
+def test_benchmark_tls():
+    """A TLS run should report full and resumed connection times"""
+    try:
+        (result,) = main(
+            ["--rows", "1000", "--clients", "2", "--duration", "0.5"]
+            + ["--tls", "on"]
+        )
+    except RuntimeError:
+        pytest.skip("openssl is not installed")
+    assert result["tls"]
+    assert result["errors"] == 0
+    assert result["queries"] > 0
+    assert result["resumed_connect_ms"]["p50"] > 0
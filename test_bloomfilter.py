@@ -0,0 +1,29 @@
+import pytest
+
+from bloomfilter import BloomFilter
+
+
+def test_bloom_filter_has_no_false_negatives():
+    """Every item that was added should be found"""
+    items = [f"line {i}".encode() for i in range(10000)]
+    bloom = BloomFilter(len(items), 0.01)
+    for item in items:
+        bloom.add(item)
+    assert all(item in bloom for item in items)
+
+
+def test_bloom_filter_error_rate():
+    """Items that were not added should rarely be found"""
+    bloom = BloomFilter(10000, 0.01)
+    for i in range(10000):
+        bloom.add(f"line {i}".encode())
+    false_positives = sum(
+        f"missing {i}".encode() in bloom for i in range(10000)
+    )
+    assert false_positives < 200
+
+
+def test_bloom_filter_rejects_bad_error_rate():
+    """The error rate should be a probability"""
+    with pytest.raises(ValueError):
+        BloomFilter(10, 0)
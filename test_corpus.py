@@ -0,0 +1,82 @@
+import pytest
+
+from corpus import FileReloader, MmapCorpus
+from searchengines import RegexEngine, SetEngine
+
+
+def test_reloader_indexes_appended_lines(tmp_path):
+    """Appending to the file should update the index without a full reload"""
+    path = tmp_path / "file.txt"
+    path.write_text("TestString\nBro")
+    reloader = FileReloader(str(path), SetEngine)
+    engine = reloader.refresh().engine
+    assert engine.contains("Bro")
+
+    with open(path, "a") as file:
+        file.write("ther\nMother\n")
+    # The existing engine was extended rather than rebuilt
+    assert reloader.refresh().engine is engine
+    assert engine.contains("Brother")
+    assert engine.contains("Mother")
+    assert not engine.contains("Bro")
+
+
+@pytest.mark.parametrize("create_engine", [SetEngine, RegexEngine])
+def test_reloader_rereads_rewritten_file(tmp_path, create_engine):
+    """A file that was rewritten should be read again from scratch"""
+    path = tmp_path / "file.txt"
+    path.write_text("TestString\n")
+    reloader = FileReloader(str(path), create_engine)
+    assert reloader.refresh().engine.contains("TestString")
+
+    path.write_text("Father\nMother\n")
+    engine = reloader.refresh().engine
+    assert not engine.contains("TestString")
+    assert engine.contains("Mother")
+
+
+def test_mmap_corpus_matches_whole_lines(tmp_path):
+    """The mmap corpus should only match whole lines of the file"""
+    path = tmp_path / "file.txt"
+    path.write_bytes(b"TestString\nFather'\nBrother\nMother")
+    corpus = MmapCorpus(str(path))
+    for line in (b"TestString", b"Brother", b"Mother"):
+        assert corpus.contains_line(line)
+    for line in (b"Father", b"String", b"TestStr", b"tESTsTRING"):
+        assert not corpus.contains_line(line)
+
+
+@pytest.mark.parametrize("create_engine", [SetEngine, RegexEngine])
+def test_reloader_reads_crlf_like_text_mode(tmp_path, create_engine):
+    """CRLF line endings should give the same answers as the file read in
+    text mode, also for appended lines"""
+    path = tmp_path / "file.txt"
+    path.write_bytes(b"Father\r\nMother\r\nBro")
+    reloader = FileReloader(str(path), create_engine)
+    engine = reloader.refresh().engine
+    expected = create_engine()
+    expected.prepare(str(path), path.read_text())
+    for line in ("Father", "Mother", "Bro", "Father\r"):
+        assert engine.contains(line) == expected.contains(line)
+    assert engine.contains("Mother")
+
+    with open(path, "ab") as file:
+        file.write(b"ther\r\nSister\r\n")
+    engine = reloader.refresh().engine
+    assert engine.contains("Brother")
+    assert engine.contains("Sister")
+    assert not engine.contains("Sister\r")
+
+
+def test_mmap_corpus_strips_cr_of_crlf_lines(tmp_path):
+    """A CRLF file should match the lines text mode reads from it"""
+    path = tmp_path / "file.txt"
+    path.write_bytes(b"TestString\r\n\r\nBrother\r\nMother\r\n")
+    corpus = MmapCorpus(str(path))
+    expected = path.read_text().split("\n")
+    for line in ("TestString", "", "Brother", "Mother", "Moth", "Mother\r"):
+        assert corpus.contains_line(line.encode()) == (line in expected)
+    path.write_bytes(b"TestString\r\nMother\r")
+    corpus.refresh()
+    assert corpus.contains_line(b"Mother")
+    assert not corpus.contains_line(b"")
@@ -0,0 +1,48 @@
+import os
+
+from diskindex import DiskIndex
+
+
+def test_disk_index_matches_whole_lines(tmp_path):
+    """The index should only match whole lines, duplicates included"""
+    path = tmp_path / "file.txt"
+    path.write_bytes(b"TestString\nBrother\n\nBrother\nMother")
+    index = DiskIndex(str(path))
+    assert index.contains_line(b"TestString")
+    assert index.contains_line(b"Brother")
+    assert index.contains_line(b"Mother")
+    assert index.contains_line(b"")
+    assert not index.contains_line(b"String")
+    assert not index.contains_line(b"Moth")
+    assert os.path.exists(str(path) + ".idx")
+
+
+def test_disk_index_is_reused_until_stale(tmp_path, monkeypatch):
+    """A saved index should be mapped again instead of being rebuilt"""
+    path = tmp_path / "file.txt"
+    path.write_bytes(b"TestString\nBrother\n")
+    DiskIndex(str(path))
+
+    def fail(*args):
+        raise AssertionError("the index was rebuilt")
+
+    monkeypatch.setattr(DiskIndex, "_build", fail)
+    assert DiskIndex(str(path)).contains_line(b"Brother")
+    # Touching the file does not change its content
+    os.utime(path, ns=(0, 0))
+    assert DiskIndex(str(path)).contains_line(b"Brother")
+    monkeypatch.undo()
+
+    path.write_bytes(b"TestString\nMother\n")
+    index = DiskIndex(str(path))
+    assert index.contains_line(b"Mother")
+    assert not index.contains_line(b"Brother")
+
+
+def test_disk_index_without_a_writable_sidecar(tmp_path):
+    """The index should still work when it can not be saved"""
+    path = tmp_path / "file.txt"
+    path.write_bytes(b"")
+    index = DiskIndex(str(path), str(tmp_path / "missing" / "file.idx"))
+    assert index.contains_line(b"")
+    assert not index.contains_line(b"Brother")
@@ -0,0 +1,41 @@
+from metrics import Histogram, Metrics
+
+
+def test_histogram_buckets():
+    """Each value should be counted in the first bucket that holds it"""
+    histogram = Histogram((0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 2.0):
+        histogram.observe(value)
+    assert histogram.counts == [2, 1, 1]
+    assert histogram.count == 4
+    assert histogram.sum == 2.65
+
+
+def test_sampling():
+    """Only one in sample_every requests should be timed"""
+    metrics = Metrics("test_", sample_every=4)
+    assert sum(metrics.sampled() for _ in range(100)) == 25
+    assert all(Metrics("test_").sampled() for _ in range(10))
+
+
+def test_render_prometheus_text():
+    """Counters, gauges and histograms should be in the Prometheus format"""
+    metrics = Metrics("test_")
+    metrics.inc("queries_total")
+    metrics.inc("queries_total", 2)
+    metrics.add("connections_active", 1)
+    metrics.add("connections_active", -1)
+    metrics.observe("search", 0.00002)
+    metrics.observe("search", 20.0)
+    lines = metrics.render({"cache_size": 5}).splitlines()
+    assert "# TYPE test_queries_total counter" in lines
+    assert "test_queries_total 3" in lines
+    assert "test_connections_active 0" in lines
+    assert "test_cache_size 5" in lines
+    assert "# TYPE test_stage_seconds histogram" in lines
+    # Buckets are cumulative.
+    assert 'test_stage_seconds_bucket{stage="search",le="1e-05"} 0' in lines
+    assert 'test_stage_seconds_bucket{stage="search",le="2.5e-05"} 1' in lines
+    assert 'test_stage_seconds_bucket{stage="search",le="10.0"} 1' in lines
+    assert 'test_stage_seconds_bucket{stage="search",le="+Inf"} 2' in lines
+    assert 'test_stage_seconds_count{stage="search"} 2' in lines
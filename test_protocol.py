@@ -0,0 +1,46 @@
+import socket
+
+import pytest
+
+from protocol import FrameReader, encode_v2_batch, encode_v2_command
+
+
+def test_reader_joins_split_frames():
+    """Frames split over several sends should be read back whole"""
+    first, second = socket.socketpair()
+    with first, second:
+        reader = FrameReader(second, buffer_size=8)
+        first.sendall(b"12")
+        first.sendall(b"3456789")
+        assert bytes(reader.read_exactly(4)) == b"1234"
+        assert bytes(reader.read_exactly(5)) == b"56789"
+        first.sendall(b"abcdefghijklmnopqrstuvwxyz")
+        # Larger than the buffer, the reader grows to fit the frame.
+        assert bytes(reader.read_exactly(20)) == b"abcdefghijklmnopqrst"
+        assert bytes(reader.read_exactly(6)) == b"uvwxyz"
+
+
+def test_reader_reports_closed_connection():
+    """A clean close returns None, a close mid-frame raises"""
+    first, second = socket.socketpair()
+    reader = FrameReader(second)
+    first.sendall(b"abc")
+    first.close()
+    with second:
+        assert bytes(reader.read_exactly(2)) == b"ab"
+        with pytest.raises(ConnectionError):
+            reader.read_exactly(2)
+
+    first, second = socket.socketpair()
+    first.close()
+    with second:
+        assert FrameReader(second).read_exactly(2) is None
+
+
+def test_newline_in_batch_or_command_is_rejected():
+    """A newline would split a query or argument in two, so it is refused"""
+    assert encode_v2_batch([b"a", b"", b"b"]).endswith(b"a\n\nb")
+    with pytest.raises(ValueError):
+        encode_v2_batch([b"a", b"b\nc"])
+    with pytest.raises(ValueError):
+        encode_v2_command("PREFIX_EXISTS", [b"a\n"])
@@ -0,0 +1,51 @@
+import time
+
+from querycache import QueryCache
+
+
+def test_cache_counts_hits_and_misses():
+    """A stored result should be returned and counted as a hit"""
+    cache = QueryCache(10)
+    assert cache.get("Brother") is None
+    cache.put("Brother", True)
+    cache.put("Sister", False)
+    assert cache.get("Brother") is True
+    assert cache.get("Sister") is False
+    assert cache.stats() == {
+        "size": 2,
+        "capacity": 10,
+        "hits": 2,
+        "misses": 1,
+    }
+
+
+def test_cache_evicts_least_recently_used():
+    """The least recently used result should go first when full"""
+    cache = QueryCache(2)
+    cache.put("a", True)
+    cache.put("b", True)
+    cache.get("a")
+    cache.put("c", True)
+    assert cache.get("b") is None
+    assert cache.get("a") is True
+    assert cache.get("c") is True
+
+
+def test_cache_drops_results_of_old_versions():
+    """A new file version should never be answered from the cache"""
+    cache = QueryCache(10)
+    cache.get("Brother", version=1)
+    cache.put("Brother", True, version=1)
+    assert cache.get("Brother", version=2) is None
+    # A result computed from the old version arrives late and is ignored
+    cache.put("Brother", True, version=1)
+    assert cache.get("Brother", version=2) is None
+
+
+def test_cache_expires_results():
+    """Results should expire after the time to live"""
+    cache = QueryCache(10, ttl=0.05)
+    cache.put("Brother", True)
+    assert cache.get("Brother") is True
+    time.sleep(0.1)
+    assert cache.get("Brother") is None
@@ -0,0 +1,55 @@
+import pytest
+
+import regexsearch
+from regexsearch import (
+    RegexRejected,
+    RegexSearcher,
+    RegexTimeout,
+    check_pattern,
+)
+
+DATA: bytes = b"TestString\nBrother\n\nMother\nFather'"
+
+
+@pytest.mark.parametrize(
+    "pattern",
+    [r"(a+)+$", r"(\w+\s?)*x", r"(a|ab)*c", r"(.*a){20}", r"(a)\1", "(", ""],
+)
+def test_check_pattern_rejects(pattern: str):
+    """Patterns that could backtrack exponentially should be rejected"""
+    if pattern:
+        with pytest.raises(RegexRejected):
+            check_pattern(pattern)
+    else:
+        with pytest.raises(RegexRejected):
+            check_pattern("a" * (regexsearch.MAX_PATTERN_LENGTH + 1))
+
+
+@pytest.mark.parametrize(
+    "pattern", [r"^Test", r"[A-Z]\w+er$", r"(foo|bar)*baz", r"a{2,5}b+"]
+)
+def test_check_pattern_accepts(pattern: str):
+    """Ordinary patterns should be accepted"""
+    check_pattern(pattern)
+
+
+def test_search_lines():
+    """Lines the pattern matches should be returned up to the limit"""
+    searcher = RegexSearcher()
+    assert list(searcher.search_lines(DATA, r"ther$", 10)) == [
+        b"Brother",
+        b"Mother",
+    ]
+    assert list(searcher.search_lines(DATA, r"ther", 1)) == [b"Brother"]
+    assert list(searcher.search_lines(DATA, r"^$", 10)) == [b""]
+    # Compiled patterns are reused
+    assert list(searcher.search_lines(DATA, r"ther", 1)) == [b"Brother"]
+    assert searcher.compile.cache_info().hits == 1
+
+
+def test_search_lines_time_budget(monkeypatch):
+    """A search that takes too long should be stopped"""
+    monkeypatch.setattr(regexsearch, "CHUNK_SIZE", 1)
+    searcher = RegexSearcher(time_budget=0)
+    with pytest.raises(RegexTimeout):
+        list(searcher.search_lines(DATA, r"nothing", 10))
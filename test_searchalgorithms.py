@@ -0,0 +1,81 @@
+import pickle
+
+import pytest
+
+from searchalgorithms import (
+    AhoCorasick,
+    CompactAhoCorasick,
+    as_code_points,
+    fast_naive_search,
+    fast_rabin_karp_search,
+    find_all,
+    find_search,
+    naive_search,
+)
+
+TEXT: str = "abracadabra, said the brother to his other brother"
+
+
+@pytest.mark.parametrize(
+    "search",
+    [
+        fast_naive_search,
+        find_search,
+        fast_rabin_karp_search,
+    ],
+)
+@pytest.mark.parametrize("pattern", ["abra", "brother", "other", "sister"])
+def test_fast_backends_match_naive_search(search, pattern: str):
+    """The fast backends should find the same first match, for strings and
+    bytes"""
+    assert search(TEXT, pattern) == naive_search(TEXT, pattern)
+    assert search(TEXT.encode(), pattern.encode()) == naive_search(
+        TEXT, pattern
+    )
+
+
+@pytest.mark.parametrize("search", [fast_naive_search, fast_rabin_karp_search])
+def test_numpy_backends_search_converted_text(search):
+    """A text converted once with as_code_points should give the same
+    matches as the text itself"""
+    text = as_code_points("naïve " + TEXT)
+    for pattern in ("ïve", "brother", "sister"):
+        assert search(text, pattern) == naive_search("naïve " + TEXT, pattern)
+
+
+@pytest.mark.parametrize("algorithm", ["naive", "find", "rabin_karp"])
+def test_find_all_returns_overlapping_matches(algorithm: str):
+    """Every match should be returned, overlapping ones included"""
+    assert find_all(TEXT, "abra", algorithm) == [0, 7]
+    assert find_all("aaaa", "aa", algorithm) == [0, 1, 2]
+    assert find_all(TEXT, "sister", algorithm) == []
+
+
+PATTERNS: list[str] = ["he", "she", "his", "hers", "brother", "other"]
+
+
+def test_compact_aho_corasick_matches_aho_corasick():
+    """Both automatons should report the same matches"""
+    automaton = AhoCorasick()
+    for pattern in PATTERNS:
+        automaton.add_pattern(pattern)
+    automaton.build()
+    compact = CompactAhoCorasick(PATTERNS)
+    compact.build()
+    assert sorted(compact.search(TEXT)) == sorted(automaton.search(TEXT))
+    assert compact.matches_any(TEXT)
+    assert not compact.matches_any("abracadabra")
+
+
+def test_compact_aho_corasick_save_and_load(tmp_path):
+    """A saved or pickled automaton should not need to be built again"""
+    compact = CompactAhoCorasick(PATTERNS)
+    compact.build()
+    path = str(tmp_path / "automaton.npz")
+    compact.save(path)
+    for copy in (
+        CompactAhoCorasick.load(path),
+        pickle.loads(pickle.dumps(compact)),
+    ):
+        assert copy.patterns == PATTERNS
+        assert copy.search(TEXT) == compact.search(TEXT)
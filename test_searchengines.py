@@ -0,0 +1,131 @@
+import re
+
+import pytest
+
+import searchengines
+from bloomfilter import BloomFilter
+from searchengines import ENGINES, LineIndex, create_engine, match_patterns
+
+CONTENT: str = "TestString\nFather'\nBrother\n\nMother"
+
+
+@pytest.mark.parametrize(
+    "query",
+    ["TestString", "Brother", "Mother", "", "Father", "String", "tESTsTRING"],
+)
+def test_line_index_matches_regex(query: str):
+    """The line index should give the same answer as the regex search"""
+    expected = (
+        re.search(rf"^{re.escape(query)}$", CONTENT, re.MULTILINE) is not None
+    )
+    assert (query in LineIndex(CONTENT)) == expected
+
+
+def test_line_index_trailing_newline():
+    """A file ending with a newline should still match its last line"""
+    index = LineIndex("first\nlast\n")
+    assert "last" in index
+    assert "las" not in index
+
+
+def test_line_index_built_in_chunks(monkeypatch):
+    """Building the index a chunk at a time should not split any line"""
+    monkeypatch.setattr(searchengines, "BUILD_CHUNK", 3)
+    index = LineIndex(CONTENT)
+    assert index.lines == set(CONTENT.split("\n")[:-1])
+    assert index.tail == "Mother"
+
+
+@pytest.mark.parametrize("name", list(ENGINES))
+@pytest.mark.parametrize(
+    "query",
+    [
+        "TestString",
+        "Brother",
+        "Mother",
+        "",
+        "Father",
+        "String",
+        "tESTsTRING",
+        "Test.*",
+        "(Brother)",
+        "Brother\n\nMother",
+        "Father'\nBrother",
+    ],
+)
+def test_engines_match_line_index(tmp_path, name: str, query: str):
+    """Every engine should give the same answer as the line index"""
+    path = tmp_path / "file.txt"
+    path.write_text(CONTENT)
+    engine = create_engine(name)
+    engine.prepare(str(path), CONTENT)
+    assert engine.contains(query) == (query in LineIndex(CONTENT))
+    assert engine.contains_many([query, "Mother"]) == [
+        query in LineIndex(CONTENT),
+        True,
+    ]
+
+
+@pytest.mark.parametrize("bloom_error_rate", [0, 0.001])
+@pytest.mark.parametrize("name", list(ENGINES))
+def test_engines_read_crlf_like_text_mode(tmp_path, name, bloom_error_rate):
+    """On a CRLF file every engine should find the lines text mode reads,
+    without their CR"""
+    path = tmp_path / "file.txt"
+    path.write_bytes(CONTENT.replace("\n", "\r\n").encode() + b"\r\n")
+    content = path.read_text()
+    engine = create_engine(name, bloom_error_rate)
+    engine.prepare(str(path), content if engine.needs_content else None)
+    for query in ["TestString", "Brother", "Mother", "", "Mother\r", "Moth"]:
+        assert engine.contains(query) == (query in LineIndex(content))
+
+
+@pytest.mark.parametrize("name", ["set", "regex", "mmap"])
+def test_bloom_engine(tmp_path, monkeypatch, name: str):
+    """The Bloom filter should answer misses without asking the engine"""
+    path = tmp_path / "file.txt"
+    path.write_text(CONTENT)
+    # Lines are counted over several chunks.
+    monkeypatch.setattr(searchengines, "BUILD_CHUNK", 16)
+    engine = create_engine(name, bloom_error_rate=0.001)
+    engine.prepare(str(path), CONTENT if engine.needs_content else None)
+    assert (
+        engine.filter.size == BloomFilter(len(CONTENT.split("\n")), 0.001).size
+    )
+    asked = []
+    contains = engine.engine.contains
+    engine.engine.contains = lambda line: asked.append(line) or contains(line)
+    for query in ["TestString", "Mother", "", "String", "tESTsTRING"]:
+        assert engine.contains(query) == (query in LineIndex(CONTENT))
+    assert asked == ["TestString", "Mother", ""]
+    assert engine.contains_many(["Brother", "Sister"]) == [True, False]
+
+
+def test_engine_aliases():
+    """The old kmp and boyer_moore names should pick the find engine"""
+    for name in ("kmp", "boyer_moore"):
+        engine = create_engine(name)
+        assert engine.search is searchengines.find_search
+        assert name not in ENGINES
+
+
+def test_unknown_engine():
+    """An unknown engine name should be reported"""
+    with pytest.raises(ValueError):
+        create_engine("grep")
+
+
+def test_match_patterns():
+    """Patterns should be matched against whole lines or anywhere"""
+    data = CONTENT.encode()
+    patterns = ["Brother", "Mother", "Father", "other", "Sister"]
+    assert set(match_patterns(data, patterns, whole_lines=True)) == {
+        "Brother",
+        "Mother",
+    }
+    assert set(match_patterns(data, patterns, whole_lines=False)) == {
+        "Brother",
+        "Mother",
+        "Father",
+        "other",
+    }
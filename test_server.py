@@ -1,18 +1,47 @@
+import asyncio
+import gc
+import os
+import signal
 import socket
 import threading
 import time
 import pytest
 
+from admission import ClientLimiter
+from benchmark import client_context, make_certificate
+from corpus import MmapCorpus
+from protocol import (
+    STATUS_EXISTS,
+    STATUS_NOT_FOUND,
+    STATUS_THROTTLED,
+    V1_THROTTLED,
+    V2_LENGTH,
+    V2_MAGIC,
+    encode_v2_batch,
+    encode_v2_frame,
+)
+from querycache import QueryCache
+from searchclient import AsyncSearchClient, CommandError, SearchClient
+import server as server_module
+
 # we will import the clone of our original server that will be used for testing purposes
 # we will also import the required constants that will be used to format
 # our messages
 from server import (
     main as server_main,
+    create_ssl_context,
+    handle_client,
+    handle_client_async,
+    handle_client_tls,
+    reload_corpus,
+    search_many,
+    search_string,
     DISCONNECT_MESSAGE,
     HEADER,
     FORMAT,
     LISTEN_IP,
     PORT,
+    RANGE_LIMIT,
 )
 
 
@@ -89,3 +118,499 @@ def test_disconnect_message(server):
         send_message(sock, DISCONNECT_MESSAGE)
         response = sock.recv(HEADER)
         assert response == b""
+
+
+def test_asyncio_engine_responses():
+    """handle_client_async should answer version 1 and 2 queries and
+    batches like the threaded engine, and close on the disconnect message"""
+
+    def v1_frame(message: str) -> bytes:
+        encoded = message.encode(FORMAT)
+        return str(len(encoded)).encode(FORMAT).ljust(HEADER) + encoded
+
+    async def talk() -> None:
+        server = await asyncio.start_server(handle_client_async, LISTEN_IP, 0)
+        address = server.sockets[0].getsockname()
+        async with server:
+            reader, writer = await asyncio.open_connection(*address)
+            for query, reply in (
+                ("TestString", b"STRING EXISTS\n"),
+                ("Brother", b"STRING EXISTS\n"),
+                ("Mother", b"STRING EXISTS\n"),
+                ("String", b"STRING NOT FOUND\n"),
+                ("tESTsTRING", b"STRING NOT FOUND\n"),
+            ):
+                writer.write(v1_frame(query))
+                assert await reader.readexactly(len(reply)) == reply
+            writer.write(v1_frame(DISCONNECT_MESSAGE))
+            assert await asyncio.wait_for(reader.read(), 5) == b""
+            writer.close()
+
+            reader, writer = await asyncio.open_connection(*address)
+            writer.write(
+                V2_MAGIC
+                + encode_v2_frame(b"TestString")
+                + encode_v2_frame(b"TestStr")
+                + encode_v2_batch([b"Brother", b"Sister", b"Mother"])
+            )
+            assert await reader.readexactly(2) == bytes(
+                [STATUS_EXISTS, STATUS_NOT_FOUND]
+            )
+            assert await reader.readexactly(V2_LENGTH.size + 3) == (
+                V2_LENGTH.pack(3)
+                + bytes([STATUS_EXISTS, STATUS_NOT_FOUND, STATUS_EXISTS])
+            )
+            writer.write(encode_v2_frame(DISCONNECT_MESSAGE.encode(FORMAT)))
+            assert await asyncio.wait_for(reader.read(), 5) == b""
+            writer.close()
+
+    asyncio.run(talk())
+
+
+def test_protocol_v2(server):
+    """A client that sends V2_MAGIC should get a status byte per query"""
+    with socket.create_connection((LISTEN_IP, PORT)) as sock:
+        sock.sendall(
+            V2_MAGIC
+            + encode_v2_frame(b"TestString")
+            + encode_v2_frame(b"TestStr")
+        )
+        response = b""
+        while len(response) < 2:
+            response += sock.recv(2 - len(response))
+        assert response == bytes([STATUS_EXISTS, STATUS_NOT_FOUND])
+
+
+def test_protocol_v2_batch_and_pipeline(server):
+    """A batch frame gets one packed reply and pipelined frames are all
+    answered in order"""
+    with socket.create_connection((LISTEN_IP, PORT)) as sock:
+        sock.sendall(
+            V2_MAGIC
+            + encode_v2_batch([b"TestString", b"String", b"Mother"])
+            + encode_v2_frame(b"Brother")
+            + encode_v2_frame(b"Broth")
+        )
+        expected = V2_LENGTH.pack(3) + bytes(
+            [STATUS_EXISTS, STATUS_NOT_FOUND, STATUS_EXISTS]
+        )
+        expected += bytes([STATUS_EXISTS, STATUS_NOT_FOUND])
+        response = b""
+        while len(response) < len(expected):
+            response += sock.recv(len(expected) - len(response))
+        assert response == expected
+
+
+@pytest.mark.parametrize("protocol", [1, 2])
+def test_search_client(server, protocol: int):
+    """The client library should reuse its connections between lookups"""
+    with SearchClient(LISTEN_IP, PORT, pool_size=2, protocol=protocol) as c:
+        assert c.exists("TestString")
+        assert not c.exists("TestStr")
+        assert c.exists_many(["Brother", "Father", "Mother"]) == [
+            True,
+            False,
+            True,
+        ]
+        # Every call above went over the same connection.
+        assert c._idle.qsize() == 1
+
+
+def test_async_search_client(server):
+    """The asyncio client should give the same answers"""
+
+    async def lookups() -> list:
+        async with AsyncSearchClient(LISTEN_IP, PORT) as client:
+            return [
+                await client.exists("Mother"),
+                await client.exists_many(["TestString", "String"]),
+            ]
+
+    assert asyncio.run(lookups()) == [True, [True, False]]
+
+
+@pytest.mark.parametrize(
+    "mode, expected",
+    [
+        ("line", {"TestString", "Mother"}),
+        ("substring", {"TestString", "Mother", "String", "Fath"}),
+    ],
+)
+def test_match_command(server, mode: str, expected: set):
+    """The MATCH command should stream back the patterns that were found"""
+    patterns = ["TestString", "Mother", "String", "Fath", "NonExistentString"]
+    with SearchClient(LISTEN_IP, PORT) as client:
+        assert set(client.match(patterns, mode)) == expected
+        with pytest.raises(CommandError):
+            list(client.command("NOSUCHCOMMAND", []))
+
+
+def test_prefix_and_range_commands(server):
+    """Prefix and range lookups should use the sorted lines of the file"""
+    with open("test_200k.txt", encoding="utf-8") as file:
+        lines = sorted(file.read().split("\n"))
+    with SearchClient(LISTEN_IP, PORT) as client:
+        assert client.prefix_exists("TestStr")
+        assert not client.prefix_exists("tESTsTR")
+        assert client.prefix_count("Moth") == sum(
+            line.startswith("Moth") for line in lines
+        )
+        # The reply was read to its end, so the connection was pooled.
+        assert client._idle.qsize() == 1
+        expected = [line for line in lines if "A" <= line <= "B"]
+        found = []
+        while True:
+            page = client.range_list("A", "B", len(found), 1000)
+            found.extend(page)
+            if len(page) < 1000:
+                break
+        assert found == expected
+        # Pages are capped at RANGE_LIMIT
+        assert len(client.range_list("A", "B", limit=10**6)) == RANGE_LIMIT
+
+
+def test_regex_command(server):
+    """Regular expressions should only be used by the REGEX command"""
+    with SearchClient(LISTEN_IP, PORT) as client:
+        assert not client.exists("Test.*")
+        assert list(client.regex(r"^Test\w+$")) == ["TestString"]
+        assert len(list(client.regex("^[a-z]", limit=5))) == 5
+        with pytest.raises(CommandError):
+            list(client.regex(r"(a+)+$"))
+
+
+def test_stats_command(server):
+    """STATS should count the queries and time each stage of them"""
+    with SearchClient(LISTEN_IP, PORT, protocol=2) as client:
+        client.exists("TestString")
+        stats = client.stats()
+        # The reply was read to its end, so the connection was pooled.
+        assert client._idle.qsize() == 1
+    assert "search_server_queries_total " in stats
+    assert "search_server_hits_total " in stats
+    for stage in ("recv", "parse", "search", "send"):
+        assert f'stage="{stage}",le="+Inf"' in stats
+
+
+def test_tls_handshake_in_worker(tmp_path, monkeypatch):
+    """The worker should do the TLS handshake and let the client resume its
+    session on the next connection"""
+    try:
+        certificate, key = make_certificate(str(tmp_path))
+    except RuntimeError:
+        pytest.skip("openssl is not installed")
+    monkeypatch.setattr(
+        server_module, "context", create_ssl_context(certificate, key)
+    )
+    context = client_context(certificate)
+    session = None
+    with socket.create_server((LISTEN_IP, 0)) as listener:
+        for resumed in (False, True):
+            thread = threading.Thread(
+                target=lambda: handle_client_tls(listener.accept()[0])
+            )
+            thread.start()
+            with context.wrap_socket(
+                socket.create_connection(listener.getsockname()),
+                server_hostname=LISTEN_IP,
+                session=session,
+            ) as sock:
+                assert sock.version() == "TLSv1.3"
+                sock.sendall(V2_MAGIC + encode_v2_frame(b"TestString"))
+                assert sock.recv(1) == bytes([STATUS_EXISTS])
+                assert sock.session_reused == resumed
+                session = sock.session
+            thread.join()
+
+
+def test_client_resumes_tls_session(tmp_path, monkeypatch):
+    """New connections of a SearchClient should resume the TLS session of a
+    connection that was already used"""
+    try:
+        certificate, key = make_certificate(str(tmp_path))
+    except RuntimeError:
+        pytest.skip("openssl is not installed")
+    monkeypatch.setattr(
+        server_module, "context", create_ssl_context(certificate, key)
+    )
+    with socket.create_server((LISTEN_IP, 0)) as listener:
+
+        def serve() -> None:
+            for _ in range(2):
+                threading.Thread(
+                    target=handle_client_tls, args=(listener.accept()[0],)
+                ).start()
+
+        thread = threading.Thread(target=serve)
+        thread.start()
+        with SearchClient(
+            *listener.getsockname(), ssl_context=client_context(certificate)
+        ) as client:
+            assert client.exists("TestString")
+            # The idle connection is taken first, so the second one is new.
+            with client._connection() as first, client._connection() as new:
+                assert not first.sock.session_reused
+                assert new.sock.session_reused
+        thread.join()
+
+
+def test_rate_limit_and_connection_cap(monkeypatch):
+    """Clients over their rate or connection limit should get THROTTLED"""
+    monkeypatch.setattr(
+        server_module, "LIMITER", ClientLimiter(0.001, 2, max_connections=1)
+    )
+    first, second = socket.socketpair()
+    other, other_server = socket.socketpair()
+    thread = threading.Thread(target=handle_client, args=(second,))
+    thread.start()
+    with first, other:
+        first.sendall(
+            V2_MAGIC
+            + encode_v2_frame(b"TestString") * 2
+            + encode_v2_batch([b"TestString", b"Brother"])
+        )
+        assert first.recv(1) == bytes([STATUS_EXISTS])
+        assert first.recv(1) == bytes([STATUS_EXISTS])
+        assert (
+            first.recv(6) == V2_LENGTH.pack(2) + bytes([STATUS_THROTTLED]) * 2
+        )
+        # The same client may not open a second connection meanwhile.
+        handle_client(other_server)
+        assert other.recv(1024) == V1_THROTTLED
+    thread.join()
+
+
+def test_idle_connection_is_closed(monkeypatch):
+    """A client that sends nothing should be dropped after IDLE_TIMEOUT"""
+    monkeypatch.setattr(server_module, "IDLE_TIMEOUT", 0.1)
+    first, second = socket.socketpair()
+    with first:
+        started = time.perf_counter()
+        handle_client(second)
+        assert time.perf_counter() - started < 1
+        assert first.recv(1) == b""
+
+
+def test_idle_timeout_zero_waits_forever(monkeypatch):
+    """With IDLE_TIMEOUT 0 a client may stay idle between queries for longer
+    than READ_TIMEOUT, which only applies once a message started"""
+    monkeypatch.setattr(server_module, "IDLE_TIMEOUT", 0)
+    monkeypatch.setattr(server_module, "READ_TIMEOUT", 0.2)
+    first, second = socket.socketpair()
+    thread = threading.Thread(target=handle_client, args=(second,))
+    thread.start()
+    with first:
+        first.settimeout(5)
+        first.sendall(V2_MAGIC)
+        for _ in range(2):
+            first.sendall(encode_v2_frame(b"TestString"))
+            assert first.recv(1) == bytes([STATUS_EXISTS])
+            time.sleep(0.6)
+            assert thread.is_alive()
+    thread.join(3)
+    assert not thread.is_alive()
+
+
+def test_trickling_client_is_closed(monkeypatch):
+    """A client that sends a header byte now and then should be dropped
+    once READ_TIMEOUT passed since the first byte"""
+    monkeypatch.setattr(server_module, "IDLE_TIMEOUT", 0.5)
+    monkeypatch.setattr(server_module, "READ_TIMEOUT", 0.5)
+    first, second = socket.socketpair()
+    thread = threading.Thread(target=handle_client, args=(second,))
+    started = time.perf_counter()
+    thread.start()
+    with first:
+        try:
+            while thread.is_alive() and time.perf_counter() - started < 3:
+                first.send(b"1")
+                time.sleep(0.2)
+        except OSError:
+            pass
+        thread.join(3)
+        assert not thread.is_alive()
+        assert time.perf_counter() - started < 1.5
+
+
+def test_trickling_client_is_closed_async(monkeypatch):
+    """The asyncio engine should drop a trickling client the same way"""
+    monkeypatch.setattr(server_module, "IDLE_TIMEOUT", 0.5)
+    monkeypatch.setattr(server_module, "READ_TIMEOUT", 0.5)
+
+    async def trickle() -> float:
+        server = await asyncio.start_server(handle_client_async, LISTEN_IP, 0)
+        async with server:
+            reader, writer = await asyncio.open_connection(
+                *server.sockets[0].getsockname()
+            )
+            started = time.perf_counter()
+            while time.perf_counter() - started < 3:
+                writer.write(b"1")
+                try:
+                    if not await asyncio.wait_for(reader.read(1), 0.2):
+                        break
+                except asyncio.TimeoutError:
+                    pass
+            writer.close()
+            return time.perf_counter() - started
+
+    assert asyncio.run(trickle()) < 1.5
+
+
+@pytest.mark.parametrize(
+    "header", [V2_MAGIC + V2_LENGTH.pack(1 << 29), b"536870912".ljust(HEADER)]
+)
+def test_oversized_frame_is_rejected(monkeypatch, header):
+    """A frame longer than MAX_FRAME_SIZE should close the connection right
+    after its header, without waiting for or buffering the payload"""
+    monkeypatch.setattr(server_module, "MAX_FRAME_SIZE", 1024)
+    first, second = socket.socketpair()
+    thread = threading.Thread(target=handle_client, args=(second,))
+    thread.start()
+    with first:
+        first.sendall(header)
+        thread.join(3)
+        assert not thread.is_alive()
+        first.settimeout(3)
+        assert first.recv(1024) == b""
+
+
+def test_oversized_frame_is_rejected_async(monkeypatch):
+    """The asyncio engine should reject an oversized frame the same way"""
+    monkeypatch.setattr(server_module, "MAX_FRAME_SIZE", 1024)
+
+    async def send_header() -> bytes:
+        server = await asyncio.start_server(handle_client_async, LISTEN_IP, 0)
+        async with server:
+            reader, writer = await asyncio.open_connection(
+                *server.sockets[0].getsockname()
+            )
+            writer.write(V2_MAGIC + V2_LENGTH.pack(1 << 29))
+            reply = await asyncio.wait_for(reader.read(), 3)
+            writer.close()
+            return reply
+
+    assert asyncio.run(send_header()) == b""
+
+
+def test_scan_corpus_is_mapped_on_first_use(tmp_path, monkeypatch):
+    """The file should only be mapped once a command scans it, queries do
+    not need the map"""
+    path = tmp_path / "file.txt"
+    path.write_bytes(b"Brother\n")
+    monkeypatch.setattr(server_module, "FILE_PATH", str(path))
+    monkeypatch.setattr(server_module, "SCAN_CORPUS", None)
+    search_string("TestString", server_module.FILE_PATH)
+    assert server_module.SCAN_CORPUS is None
+    corpus = server_module.scan_corpus()
+    assert corpus.map[:] == b"Brother\n"
+    assert server_module.scan_corpus() is corpus
+
+
+def test_reload_swaps_engine(tmp_path, monkeypatch):
+    """A reload should swap in the new file while queries that already hold
+    the old engine go on using it"""
+    path = tmp_path / "file.txt"
+    path.write_text("Brother\n")
+    monkeypatch.setattr(server_module, "FILE_PATH", str(path))
+    monkeypatch.setattr(server_module, "SCAN_CORPUS", MmapCorpus(str(path)))
+    monkeypatch.setattr(server_module, "REREAD_ON_QUERY", False)
+    monkeypatch.setattr(server_module, "SHARDS", None)
+    monkeypatch.setattr(server_module, "live_search", (None, None))
+    # Put back what the reload replaces once the test is done.
+    for name in ("SEARCH", "FILE_VERSION", "Initial_file_content"):
+        monkeypatch.setattr(server_module, name, getattr(server_module, name))
+    assert reload_corpus()
+    assert not reload_corpus()
+    old_engine, _ = server_module.current_engine(str(path))
+    assert search_string("Brother", str(path))
+
+    path.write_text("Sister\n")
+    assert reload_corpus()
+    assert search_many(["Brother", "Sister"], str(path)) == [False, True]
+    assert old_engine.contains("Brother")
+    assert reload_corpus(force=True)
+
+
+def test_reload_command(server):
+    """RELOAD should only load the file again when it changed or is forced"""
+    with SearchClient(LISTEN_IP, PORT, protocol=2) as client:
+        assert not client.reload()
+        assert client.exists("TestString")
+
+
+def test_reload_command_reaches_prefork_parent(monkeypatch):
+    """In a pre-forked worker RELOAD should also be passed to the parent,
+    which reloads every other worker"""
+    received = []
+    previous = signal.signal(signal.SIGUSR1, lambda *args: received.append(1))
+    try:
+        monkeypatch.setattr(server_module, "supervisor_pid", os.getpid())
+        monkeypatch.setattr(
+            server_module, "reload_corpus", lambda force: False
+        )
+        assert list(server_module.command_reload([], "")) == [b"0"]
+    finally:
+        signal.signal(signal.SIGUSR1, previous)
+    assert received == [1]
+
+
+def test_prefork_backs_off_and_gives_up(monkeypatch):
+    """Workers that exit right after starting should be restarted after a
+    doubling delay until the parent gives up with status 1"""
+    forked = []
+    fork = os.fork
+
+    def timed_fork():
+        forked.append(time.monotonic())
+        return fork()
+
+    # Workers exit as soon as they start, main_prefork's handlers are put
+    # back and nothing is reloaded.
+    monkeypatch.setattr(server_module, "main", lambda reuse_port: None)
+    monkeypatch.setattr(server_module, "reload_corpus", lambda force: False)
+    monkeypatch.setattr(os, "fork", timed_fork)
+    monkeypatch.setattr(server_module, "PROCESSES", 1)
+    monkeypatch.setattr(server_module, "METRICS_PORT", 0)
+    monkeypatch.setattr(server_module, "MAX_QUICK_RESTARTS", 3)
+    monkeypatch.setattr(server_module, "WORKER_MIN_BACKOFF", 0.05)
+    monkeypatch.setattr(server_module, "SUPERVISOR_TICK", 0.005)
+    handlers = {
+        signum: signal.getsignal(signum)
+        for signum in (
+            signal.SIGTERM,
+            signal.SIGINT,
+            signal.SIGHUP,
+            signal.SIGUSR1,
+        )
+    }
+    try:
+        with pytest.raises(SystemExit) as exit_info:
+            server_module.main_prefork()
+    finally:
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
+        gc.unfreeze()
+    assert exit_info.value.code == 1
+    # The first worker and three restarts, the fourth exit gives up.
+    assert len(forked) == 4
+    gaps = [later - earlier for earlier, later in zip(forked, forked[1:])]
+    for gap, delay in zip(gaps, (0.05, 0.1, 0.2)):
+        assert delay <= gap < delay + 0.5
+    assert gaps[0] < gaps[1] < gaps[2]
+
+
+def test_query_cache_follows_file_version(tmp_path, monkeypatch):
+    """Cached results should be dropped as soon as the file changes"""
+    cache = QueryCache(10)
+    monkeypatch.setattr(server_module, "REREAD_ON_QUERY", True)
+    monkeypatch.setattr(server_module, "QUERY_CACHE", cache)
+    path = tmp_path / "file.txt"
+    path.write_text("Brother\n")
+    assert search_string("Brother", str(path))
+    assert search_many(["Brother", "Sister"], str(path)) == [True, False]
+    assert cache.stats()["hits"] == 1
+
+    path.write_text("Sister\n")
+    assert not search_string("Brother", str(path))
+    assert search_many(["Brother", "Sister"], str(path)) == [False, True]
@@ -0,0 +1,58 @@
+import pytest
+
+from searchengines import match_patterns
+from shards import ShardedCorpus, expand_paths, plan_shards
+
+LINES: list[bytes] = [f"line {i}".encode() for i in range(1000)]
+
+
+@pytest.fixture(scope="module")
+def corpus(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("shards")
+    (directory / "a.txt").write_bytes(b"\n".join(LINES[:500]) + b"\n")
+    (directory / "b.txt").write_bytes(b"\n".join(LINES[500:]))
+    sharded = ShardedCorpus(
+        str(directory / "*.txt"), shard_size=512, processes=2
+    )
+    yield sharded
+    sharded.close()
+
+
+def test_expand_paths(tmp_path):
+    """Globs should be expanded in order and plain paths kept"""
+    for name in ["b.txt", "a.txt", "c.log"]:
+        (tmp_path / name).write_text("")
+    assert expand_paths(f"{tmp_path}/*.txt, {tmp_path}/c.log") == [
+        f"{tmp_path}/a.txt",
+        f"{tmp_path}/b.txt",
+        f"{tmp_path}/c.log",
+    ]
+    with pytest.raises(FileNotFoundError):
+        expand_paths(f"{tmp_path}/*.csv")
+
+
+def test_shards_end_on_newlines(tmp_path):
+    """Every line should be in exactly one shard"""
+    path = tmp_path / "file.txt"
+    path.write_bytes(b"\n".join(LINES))
+    shards = plan_shards([str(path)], 100)
+    assert len(shards) > 1
+    data = path.read_bytes()
+    assert b"".join(data[start:end] for _, _, start, end in shards) == data
+    assert all(data[end - 1 : end] == b"\n" for *_, end in shards[:-1])
+
+
+@pytest.mark.parametrize("whole_lines", [True, False])
+def test_sharded_match(corpus, whole_lines: bool):
+    """The shards should find the same patterns as one scan of the files"""
+    patterns = ["line 0", "line 499", "line 500", "line 999", "ine 7", "x"]
+    data = b"\n".join(LINES)
+    assert set(corpus.match(patterns, whole_lines)) == set(
+        match_patterns(data, patterns, whole_lines)
+    )
+
+
+def test_sharded_regex(corpus):
+    """Matching lines should be merged in file order up to the limit"""
+    assert list(corpus.regex(r"^line 9\d$", 100, 1)) == LINES[90:100]
+    assert list(corpus.regex(r"^line", 3, 1)) == LINES[:3]
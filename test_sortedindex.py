@@ -0,0 +1,78 @@
+import pytest
+
+from sortedindex import SortedLineIndex
+
+DATA: bytes = b"banana\napple\ncherry\napricot\n\napple\navocado"
+
+
+def test_sorted_index_orders_lines():
+    """The lines should be kept in sorted order, duplicates included"""
+    index = SortedLineIndex(DATA)
+    lines = [index.line(i) for i in range(len(index))]
+    assert lines == sorted(DATA.split(b"\n"))
+
+
+@pytest.mark.parametrize(
+    "prefix, expected",
+    [
+        (b"a", 4),
+        (b"ap", 3),
+        (b"apple", 2),
+        (b"apples", 0),
+        (b"b", 1),
+        (b"c", 1),
+        (b"d", 0),
+        (b"", 7),
+    ],
+)
+def test_sorted_index_prefix_range(prefix: bytes, expected: int):
+    """Every line starting with the prefix should be in the range"""
+    first, after = SortedLineIndex(DATA).prefix_range(prefix)
+    assert after - first == expected
+
+
+def test_sorted_index_between():
+    """Lines from first to last should be found, both included"""
+    index = SortedLineIndex(DATA)
+    first, after = index.between(b"apple", b"banana")
+    assert [index.line(i) for i in range(first, after)] == [
+        b"apple",
+        b"apple",
+        b"apricot",
+        b"avocado",
+        b"banana",
+    ]
+
+
+def test_sorted_index_trailing_newline():
+    """A final newline should not add an empty line or be part of the last
+    one"""
+    index = SortedLineIndex(b"b\na\n")
+    assert [index.line(i) for i in range(len(index))] == [b"a", b"b"]
+    assert index.between(b"a", b"a") == (0, 1)
+    assert index.prefix_range(b"b") == (1, 2)
+    assert len(SortedLineIndex(b"")) == 0
+
+
+class HugeLine:
+    """Two lines, the first too long for a 4 byte length, without the
+    memory they would take"""
+
+    size: int = 1 << 33
+
+    def __len__(self) -> int:
+        return self.size + 2
+
+    def find(self, sub: bytes, start: int = 0) -> int:
+        return self.size if start == 0 else -1
+
+    def __getitem__(self, key: slice) -> bytes:
+        return b"b" if key.start == 0 else b"a"
+
+
+def test_sorted_index_lengths():
+    """Lengths should take 4 bytes a line, and 8 when a line is longer"""
+    assert SortedLineIndex(DATA).lengths.itemsize == 4
+    index = SortedLineIndex(HugeLine())
+    assert list(index.starts) == [HugeLine.size + 1, 0]
+    assert list(index.lengths) == [1, HugeLine.size]
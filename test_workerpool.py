@@ -0,0 +1,37 @@
+import socket
+import threading
+
+import pytest
+
+from workerpool import WorkerPool
+
+
+@pytest.mark.parametrize("busy_reply", [b"SERVER BUSY\n", b""])
+def test_pool_rejects_when_full(busy_reply: bytes):
+    """A full pool should reply busy instead of queueing the connection, or
+    only close it with an empty reply as the server does with TLS"""
+    started = threading.Event()
+    release = threading.Event()
+
+    def handler(sock):
+        started.set()
+        release.wait()
+
+    pool = WorkerPool(
+        handler, 1, 1, reject_when_full=True, busy_reply=busy_reply
+    )
+    pairs = [socket.socketpair() for _ in range(3)]
+    try:
+        assert pool.submit(pairs[0][0])  # picked up by the only worker
+        # Wait until the worker took the first connection off the queue.
+        assert started.wait(5)
+        assert pool.submit(pairs[1][0])  # waits in the queue
+        assert not pool.submit(pairs[2][0])  # rejected
+        pairs[2][1].settimeout(5)
+        assert pairs[2][1].recv(1024) == busy_reply
+        assert pool.stats()["rejected"] == 1
+    finally:
+        release.set()
+        for first, second in pairs:
+            first.close()
+            second.close()
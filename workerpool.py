@@ -0,0 +1,111 @@
+import logging
+import queue
+import socket
+import threading
+import time
+from typing import Callable
+
+
+class WorkerPool:
+    """A fixed number of worker threads serving accepted connections.
+
+    Accepted sockets are put on a bounded queue and picked up by the workers.
+    When every worker is busy and the queue is full the pool either blocks
+    the caller, which pushes the backpressure back into the listen backlog,
+    or rejects the connection straight away with a busy reply.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[socket.socket], None],
+        workers: int,
+        queue_depth: int,
+        reject_when_full: bool = False,
+        busy_reply: bytes = b"SERVER BUSY\n",
+    ):
+        """
+        :param handler: The function that serves one client socket
+        :param workers: The number of worker threads
+        :param queue_depth: How many accepted connections may wait for a worker
+        :param reject_when_full: Reject new connections when the queue is full
+        instead of waiting for room
+        :param busy_reply: The reply sent to rejected connections, empty to
+        close them without a reply
+        """
+        self.handler: Callable[[socket.socket], None] = handler
+        self.reject_when_full: bool = reject_when_full
+        self.busy_reply: bytes = busy_reply
+        self.queue: queue.Queue = queue.Queue(maxsize=queue_depth)
+        self._lock: threading.Lock = threading.Lock()
+        self.handled: int = 0
+        self.rejected: int = 0
+        self.queue_wait_total: float = 0.0
+        self.queue_wait_max: float = 0.0
+        self.threads: list[threading.Thread] = [
+            threading.Thread(target=self._work, daemon=True)
+            for _ in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, client_socket: socket.socket) -> bool:
+        """Hand an accepted connection to the workers.
+
+        :param client_socket: The socket that was accepted
+        :return: False if the connection was rejected because the pool is full
+        """
+        item: tuple = (client_socket, time.perf_counter())
+        if not self.reject_when_full:
+            self.queue.put(item)
+            return True
+        try:
+            self.queue.put_nowait(item)
+            return True
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            try:
+                if self.busy_reply:
+                    client_socket.send(self.busy_reply)
+            except OSError:
+                pass
+            finally:
+                client_socket.close()
+            return False
+
+    def stats(self) -> dict:
+        """Return the counters used to size the pool.
+
+        :return: The number of handled and rejected connections, the current
+        queue length and the average and maximum queue wait in seconds
+        """
+        with self._lock:
+            return {
+                "workers": len(self.threads),
+                "queued": self.queue.qsize(),
+                "handled": self.handled,
+                "rejected": self.rejected,
+                "queue_wait_avg": (
+                    self.queue_wait_total / self.handled
+                    if self.handled
+                    else 0.0
+                ),
+                "queue_wait_max": self.queue_wait_max,
+            }
+
+    def _work(self) -> None:
+        """Worker loop, serves connections from the queue one at a time."""
+        while True:
+            client_socket, queued_at = self.queue.get()
+            wait: float = time.perf_counter() - queued_at
+            with self._lock:
+                self.handled += 1
+                self.queue_wait_total += wait
+                self.queue_wait_max = max(self.queue_wait_max, wait)
+            logging.debug(
+                f"Connection waited {wait * 1000:.3f} ms for a worker"
+            )
+            try:
+                self.handler(client_socket)
+            except Exception as e:
+                logging.error(f"Exception occurred: {e}")